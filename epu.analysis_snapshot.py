@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Pack an EPU analysis into one file that can be browsed without the EPU storage
+# Run from the directory containing EPU_analysis. The snapshot holds the analysis files, the
+# metadata of every linked xml and every linked jpg reduced for display, and is opened with
+#
+# epu.analysis_snapshot.py export -o session.zip
+# epu.analysis_snapshot.py info -i session.zip
+# epu.star_to_epu_browser_inspect.py session.zip
+
+import argparse
+import os
+import time
+
+from epuanalysis import analysis, snapshot, storage
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Single file snapshots of an EPU analysis')
+sub = parser.add_subparsers(dest='command', required=True)
+exp = sub.add_parser('export', help='write a snapshot of EPU_analysis')
+exp.add_argument('-o', dest='out', required=True, help='snapshot file to write')
+exp.add_argument('-m', dest='max', type=int, default=snapshot.MAX_FILE >> 20, help='leave out analysis files larger than this in MB (default 64)')
+exp.add_argument('-j', dest='workers', type=int, default=None, help='parallel workers (default all cores)')
+exp.add_argument('-t', dest='threads', type=int, default=None, help='concurrent file reads (default 16, or EPU_IO_THREADS)')
+info = sub.add_parser('info', help='describe a snapshot')
+info.add_argument('-i', dest='snapshot', required=True, help='snapshot file')
+args = parser.parse_args()
+
+if args.command == 'export':
+    storage.configure(threads=args.threads)
+    start = time.time()
+    counts = snapshot.export(args.out, analysis.ANALYSIS_DIR, workers=args.workers, max_file=args.max << 20)
+    for path in counts['skipped']:
+        print('Left out '+path+', larger than '+str(args.max)+' MB')
+    print('Packed %d files, %d images and %d xml into %s (%.1f MB) in %.1f s' % (
+        counts['files'], counts['images'], counts['xml'], args.out, os.path.getsize(args.out)/1e6, time.time()-start))
+
+elif args.command == 'info':
+    if not snapshot.is_snapshot(args.snapshot):
+        parser.error(args.snapshot+' is not a snapshot')
+    snap = snapshot.Snapshot(args.snapshot)
+    m = snap.manifest
+    print('Snapshot of '+m['analysis']+' written '+m['created'])
+    print('%d files, %d images at %s px, %d xml' % (m['files'], m['images'], ', '.join(str(l) for l in m['levels']), m['xml']))
+    for key in ['Star', 'EPU', 'Total', 'Used', 'Not']:
+        if m['settings'].get(key):
+            print('  %-6s %s' % (key+':', m['settings'][key]))
@@ -93,8 +93,8 @@ def run():
         print('Using epu.epu_tracking.sh')
         subprocess.call('epu.epu_tracking.sh -e '+epu+' -i '+star+' -s '+suffix+' -c '+column, shell=True)
     else:
-        print('Using epu.star_to_epu_tracking.sh')
-        subprocess.call('epu.star_to_epu_tracking_v2.sh -e '+epu+' -i '+star+' -s '+suffix+' -c '+column, shell=True)
+        print('Running the analysis stages with epu.pipeline.py')
+        subprocess.call('epu.pipeline.py -e '+epu+' -i '+star+' -s '+suffix+' -c '+column, shell=True)
     popAnalysisFields()
 
 def popAnalysisFields():
@@ -178,13 +178,16 @@ def openTotal():
     # Browse to dir
     open_file('./EPU_analysis/squares_all')
 
+def openSheets(subset, directory):
+    # First contact sheet from epu.montages.py, the directory of square links if none were made
+    sheet = './EPU_analysis/montages/'+subset+'/squares_001.jpg'
+    open_file(sheet if os.path.isfile(sheet) else directory)
+
 def openUsed():
-    # Browse to dir
-    open_file('./EPU_analysis/squares_used')
+    openSheets('used', './EPU_analysis/squares_used')
 
 def openNotUsed():
-    # Browse to dir
-    open_file('./EPU_analysis/squares_not_used')
+    openSheets('not', './EPU_analysis/squares_not_used')
 
 def inspect():
     # Browse to dir
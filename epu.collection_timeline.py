@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Collection timeline of an EPU session from the acquisition time in the exposure names
+# Run from the directory containing EPU_analysis, writes csv files and a plot to EPU_analysis/timeline
+#
+# exposures_per_hour.csv    exposures and particles in each hour of collection
+# square_dwell.csv          first and last exposure, dwell time and visits per square
+# stalls.csv                gaps between exposures longer than -g minutes
+# yield_rolling.csv         particles per exposure in rolling windows of -w minutes
+# timeline.png              exposures per hour and rolling yield, stalls shaded red
+
+import argparse
+import os
+
+from epuanalysis import analysis, index, layers, timeline
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Exposure rate, square dwell, stalls and particle yield over collection time')
+parser.add_argument('-l', dest='layer', default=None, help='particle layer (default the star file of the analysis)')
+parser.add_argument('-w', dest='window', type=float, default=60, help='rolling window in minutes (default 60)')
+parser.add_argument('-g', dest='gap', type=float, default=10, help='gap in minutes counted as a stall (default 10)')
+parser.add_argument('-o', dest='out', default=os.path.join(analysis.ANALYSIS_DIR, timeline.TIMELINE_DIR), help='output directory')
+args = parser.parse_args()
+
+if args.layer is not None and args.layer not in layers.layer_names():
+    parser.error('No layer '+args.layer+', see epu.particle_layers.py list')
+
+idx = index.load()
+layer = layers.load(args.layer) if args.layer else layers.default_layer()
+particles = layer.join(idx)[0] if layer else idx.per_exposure({})
+
+tl = timeline.Timeline(idx, particles)
+if not len(tl):
+    print('No exposure names with acquisition times found')
+    raise SystemExit(1)
+if tl.undated:
+    print(str(tl.undated)+' exposures without an acquisition time in their name were left out')
+
+for path in timeline.export(tl, args.out, args.window, args.gap):
+    print('Written '+path)
+stalls = tl.stalls(args.gap)
+print('Collection from '+str(tl.times[0])+' to '+str(tl.times[-1])+', '+str(len(tl))+' exposures, '+str(len(stalls))+' stalls over '+str(args.gap)+' minutes')
+for start, end, minutes, _, _ in sorted(stalls, key=lambda s: -s[2])[:10]:
+    print('  %s to %s  %6.1f min' % (start, end, minutes))
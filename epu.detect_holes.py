@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Holes found on the GridSquare images, compared with the FoilHoles EPU acquired on each square
+# Run from the directory containing EPU_analysis. Writes EPU_analysis/detected_holes.npz and
+# EPU_analysis/squares_coverage.csv with, per square, the holes detected, acquired and matched, the
+# fraction of detected holes acquired and the holes not acquired whose ice looks like the acquired holes
+# that gave particles (those of epu.particle_attributes.py when it has been run)
+#
+# epu.detect_holes.py
+# epu.detect_holes.py -r 1024 -p dark -j 16
+
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+
+from epuanalysis import analysis, attributes, holefinder, holemap, index, session
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Detect holes on the square images and report acquisition coverage')
+parser.add_argument('-r', dest='size', type=int, default=holefinder.SIZE, help='size in px the squares are reduced to (default 512)')
+parser.add_argument('-p', dest='polarity', default='bright', choices=['bright', 'dark'], help='holes brighter or darker than the carbon (default bright)')
+parser.add_argument('-k', dest='threshold', type=float, default=holefinder.THRESHOLD, help='peak threshold in robust deviations (default 4)')
+parser.add_argument('-j', dest='workers', type=int, default=None, help='parallel workers (default all cores)')
+args = parser.parse_args()
+
+if args.size < 64:
+    parser.error('Squares must be reduced to at least 64 px')
+
+start = time.time()
+idx = index.load()
+squares = list(idx.squares)
+if not squares:
+    parser.error('No squares in the analysis, run epu.star_to_epu_tracking_v2.sh first')
+stored = session.load_holes()
+diameters = []
+for sq in squares:
+    # Hole diameter from the stored targets, otherwise from the lattice spacing
+    targets = stored.of_square(sq) if stored is not None else None
+    diameter = np.nanmedian(targets[0]['diameter']) if targets is not None else np.nan
+    diameters.append(float(diameter) if np.isfinite(diameter) and diameter > 0 else None)
+
+results = holefinder.detect_all(squares, diameters, args.size, args.threshold, args.polarity == 'dark', workers=args.workers)
+print('Detected '+str(sum(len(r[1]) for r in results))+' holes on '+str(len(squares))+' squares in '+'%.1f' % (time.time()-start)+' s')
+
+attrs = attributes.load_attributes(idx)
+acquired = []
+rows = []
+for sq, result in zip(squares, results):
+    holes = holemap.load(sq)
+    particles = attrs.of_foilhole(attrs.particles('foilhole'), holes.ids) if attrs is not None else None
+    foilhole, counts = holefinder.coverage(result, holes, particles)
+    acquired.append(foilhole)
+    rows.append([analysis.square_name(sq)]+[counts[k] for k in holefinder.COVERAGE])
+
+out = holefinder.save_detected(squares, results, acquired)
+table = os.path.join(analysis.ANALYSIS_DIR, 'squares_coverage.csv')
+with open(table, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(['square']+holefinder.COVERAGE)
+    for row in rows:
+        writer.writerow(row[:1]+['%.4g' % v if isinstance(v, float) else v for v in row[1:]])
+matched = sum(r[3] for r in rows)
+missed = sum(r[5] for r in rows)
+print(str(matched)+' detected holes acquired, '+str(missed)+' with good ice not acquired')
+print('Written '+out+' and '+table+' in '+'%.1f' % (time.time()-start)+' s')
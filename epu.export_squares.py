@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Export the raw files of selected squares, movies included, for collaborators or reprocessing
+# Run from the directory containing EPU_analysis. Unlike copying the EPU_analysis links this copies
+# the EPU files themselves, keeping the EPU directory layout under the output directory. Files already
+# exported with the same size and mtime are skipped, so an interrupted export can be run again.
+#
+# epu.export_squares.py -o /scratch/session                      the used squares
+# epu.export_squares.py -o /scratch/session -u all -x            all squares but those excluded in the inspector
+# epu.export_squares.py -o /scratch/session -w 'ctf_resolution<4' -k hardlink
+# epu.export_squares.py -o /scratch/session -u all -f 'foilhole_particles > 100 or square_score > 1.5'
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from epuanalysis import analysis, export, filters, index, selection, storage
+
+###############################################################################
+
+settings = analysis.read_settings()
+
+parser = argparse.ArgumentParser(description='Copy the raw files of selected squares and exposures')
+parser.add_argument('-o', dest='out', required=True, help='output directory')
+parser.add_argument('-e', dest='epu', default=settings.get('EPU'), help='EPU directory (default from settings.dat)')
+parser.add_argument('-m', dest='movies', default=None, help='directory of the movies when not in the EPU directory, in the same layout')
+parser.add_argument('-u', dest='subset', default='used', choices=list(analysis.SQUARE_LISTS), help='squares to export (default used)')
+parser.add_argument('-q', dest='squares', nargs='+', default=[], help='only these GridSquare names')
+parser.add_argument('-H', dest='holes', nargs='+', type=int, default=[], help='only these FoilHole ids')
+parser.add_argument('-w', dest='conditions', action='append', default=[], help="only exposures meeting a metadata or quality condition, e.g. 'defocus<-2.5'")
+parser.add_argument('-f', dest='filter', default=None, help="only exposures meeting a filter expression, e.g. 'particles > 50 and defocus < -2.0'")
+parser.add_argument('-x', dest='excluded', action='store_true', help='leave out the squares and FoilHoles excluded in the inspector')
+parser.add_argument('-k', dest='mode', default='auto', choices=export.MODES, help='reflink where possible then copy (auto), or force a method (default auto)')
+parser.add_argument('-z', dest='checksum', action='store_true', help='compare contents of existing files whose mtime differs')
+parser.add_argument('-n', dest='dry', action='store_true', help='list what would be exported')
+parser.add_argument('-j', dest='workers', type=int, default=export.WORKERS, help='parallel copies (default 8)')
+parser.add_argument('-t', dest='threads', type=int, default=None, help='concurrent file reads (default 16, or EPU_IO_THREADS)')
+args = parser.parse_args()
+
+if not args.epu:
+    parser.error('No EPU directory given and none found in EPU_analysis/settings.dat')
+try:
+    conditions = [selection.parse_condition(c) for c in args.conditions]
+except ValueError as e:
+    parser.error(str(e))
+
+storage.configure(threads=args.threads)
+
+start = time.time()
+idx = index.load()
+mask = selection.select(idx, analysis.square_images(args.subset))
+try:
+    if args.squares:
+        mask &= selection.select(idx, args.squares)
+    if args.holes:
+        mask &= selection.select(idx, foilholes=args.holes)
+    if conditions:
+        mask &= selection.condition_mask(idx, conditions)
+    if args.filter:
+        table = filters.Table(idx)
+        mask &= filters.Filter(args.filter, table).mask(table)
+except ValueError as e:
+    parser.error(str(e))
+if args.excluded:
+    marked_squares, marked_holes = selection.read_excluded()
+    mask &= ~selection.select(idx, marked_squares, marked_holes)
+print('Selected '+str(int(mask.sum()))+' exposures on '+str(len(np.unique(idx.square[mask])))+' squares')
+
+files = export.exposure_files(idx, mask, args.epu, args.movies)
+size = sum(storage.storage().map(os.path.getsize, [f for f, _ in files]))
+print('Found '+str(len(files))+' files, %.2f GB, in %.1f s' % (size/1e9, time.time()-start))
+if args.dry:
+    for source, rel in files:
+        print(rel)
+    raise SystemExit
+
+totals, seconds = export.export(files, args.out, args.mode, args.checksum, args.workers)
+print('Copied %d, reflinked %d, hard linked %d, unchanged %d, failed %d' %
+      tuple(totals[k] for k in ('copied', 'reflinked', 'linked', 'skipped', 'failed')))
+print('%.2f GB in %.1f s, %.0f MB/s' % (totals['bytes']/1e9, seconds, totals['bytes']/1e6/max(seconds, 1e-6)))
+print('Written '+args.out)
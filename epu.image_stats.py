@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Greyscale statistics for every square, FoilHole and micrograph jpg of an EPU analysis
+# Run from the directory containing EPU_analysis, after epu.star_to_epu_tracking_v2.sh
+# Writes EPU_analysis/image_stats.npz, read by epu.star_to_epu_browser_inspect.py and epu.rank_squares.py
+
+import argparse
+import time
+
+import numpy as np
+
+from epuanalysis import analysis, images, storage
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Greyscale statistics for all EPU images of an analysis')
+parser.add_argument('-r', dest='size', type=int, default=images.THUMBNAIL, help='decode images at up to this size in px (default 256)')
+parser.add_argument('-j', dest='workers', type=int, default=None, help='parallel workers (default all cores)')
+parser.add_argument('-t', dest='threads', type=int, default=None, help='concurrent file reads (default 16, or EPU_IO_THREADS)')
+args = parser.parse_args()
+
+storage.configure(threads=args.threads)
+
+start = time.time()
+squares = analysis.square_images('all')
+paths = list(squares)
+kind = [0]*len(squares)
+for holes, mics in zip(analysis.listing(squares, '_FoilHoles/*.jpg'), analysis.listing(squares, '_Data/*.jpg')):
+    paths += holes + mics
+    kind += [1]*len(holes) + [2]*len(mics)
+kind = np.array(kind)
+print('Found '+', '.join(str(np.sum(kind == k))+' '+name for k, name in enumerate(images.KINDS))+' images')
+
+values = images.statistics_all(paths, args.size, args.workers)
+out = images.save_stats(analysis.ANALYSIS_DIR, paths, kind, values)
+
+for k, name in enumerate(images.KINDS):
+    sel = kind == k
+    if sel.any():
+        print('  %-10s  mean greyscale %.1f  std %.1f' % (name, np.nanmean(values[sel, 0]), np.nanmean(values[sel, 1])))
+print('Written '+out+' in '+'%.1f' % (time.time()-start)+' s')
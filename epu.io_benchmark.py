@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Measure file read throughput against concurrency, to choose EPU_IO_THREADS for a mount
+# Reads the xml files of an EPU directory (or EPU_analysis) at increasing thread counts;
+# throughput should rise near linearly until the storage saturates
+
+import argparse
+import glob
+import os
+import time
+
+from epuanalysis import storage
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='File read throughput against concurrency')
+parser.add_argument('-e', dest='epu', default='EPU_analysis', help='EPU or EPU_analysis directory (default EPU_analysis)')
+parser.add_argument('-n', dest='number', type=int, default=2000, help='files to read per test (default 2000)')
+parser.add_argument('-m', dest='maximum', type=int, default=64, help='largest thread count (default 64)')
+args = parser.parse_args()
+
+files = sorted(glob.glob(os.path.join(args.epu, '**', '*.xml'), recursive=True))
+if not files:
+    parser.error('No xml files found in '+args.epu)
+print('Found '+str(len(files))+' xml files in '+args.epu)
+print('Note repeated reads may be served from the page cache, use a different -n or drop caches between runs')
+print('')
+print('threads   files/s   speedup')
+
+threads = 1
+base = None
+offset = 0
+while threads <= args.maximum:
+    # Fresh files for each test where there are enough of them
+    sample = [files[(offset+i) % len(files)] for i in range(min(args.number, len(files)))]
+    offset += len(sample)
+    io = storage.configure(threads=threads)
+    start = time.time()
+    io.map(os.stat, sample)
+    io.read(sample)
+    rate = len(sample)/(time.time()-start)
+    base = base or rate
+    print('%7d  %8.0f  %8.1f' % (threads, rate, rate/base))
+    threads *= 2
+io.shutdown()
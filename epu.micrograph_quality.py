@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Per micrograph CTF and motion quality from Relion, joined to the exposures of an EPU analysis
+# Run from the directory containing EPU_analysis. Writes EPU_analysis/quality.npz, shown per square,
+# FoilHole and micrograph in epu.star_to_epu_browser_inspect.py and added to epu.rank_squares.py,
+# and EPU_analysis/squares_quality.csv with the mean of each column over every square.
+# Without -x or -m the newest CtfFind and MotionCorr jobs of the Relion project are used.
+#
+# epu.micrograph_quality.py -x CtfFind/job004/micrographs_ctf.star -m MotionCorr/job002/corrected_micrographs.star
+
+import argparse
+import csv
+import glob
+import os
+import time
+
+import numpy as np
+
+from epuanalysis import analysis, index, quality
+
+###############################################################################
+
+settings = analysis.read_settings()
+
+def newest(pattern):
+    # Most recent Relion job output in the working directory or the project of the star file
+    roots = ['.']
+    if settings.get('Star'):
+        roots.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(settings['Star'])))))
+    found = [p for root in roots for p in glob.glob(os.path.join(root, pattern))]
+    return max(found, key=os.path.getmtime) if found else None
+
+parser = argparse.ArgumentParser(description='CTF and motion quality per micrograph, square and FoilHole')
+parser.add_argument('-x', dest='ctf', default=None, help='CtfFind micrographs_ctf.star (default the newest CtfFind job)')
+parser.add_argument('-m', dest='motion', default=None, help='MotionCorr corrected_micrographs.star (default the newest MotionCorr job)')
+parser.add_argument('-s', dest='suffix', default=settings.get('Suffix'), help='suffix to remove')
+parser.add_argument('-n', dest='top', type=int, default=10, help='number of worst squares to report (default 10)')
+args = parser.parse_args()
+
+ctf = args.ctf or newest('CtfFind/job*/micrographs_ctf.star')
+motion = args.motion or newest('MotionCorr/job*/corrected_micrographs.star')
+if ctf is None and motion is None:
+    parser.error('No CtfFind or MotionCorr star file given or found')
+
+start = time.time()
+idx = index.load()
+columns = {}
+sources = []
+for path, read in [(ctf, quality.read_ctf), (motion, quality.read_motion)]:
+    if path is None:
+        continue
+    try:
+        names, values = read(path)
+    except (IOError, ValueError) as e:
+        parser.error(str(e))
+    joined, matched = quality.join(idx, names, values, args.suffix)
+    columns.update(joined)
+    sources.append(os.path.abspath(path))
+    print(path+': '+str(len(names))+' micrographs, '+str(matched)+' matched to '+str(len(idx))+' exposures')
+out = quality.save_quality(idx, columns, sources)
+
+# Mean over every square
+squares = [analysis.square_name(sq) for sq in idx.squares]
+means = {c: quality.nanmean(idx.square, v, len(squares)) for c, v in columns.items()}
+names = [c for c in quality.COLUMNS if c in columns]
+with open(os.path.join(analysis.ANALYSIS_DIR, 'squares_quality.csv'), 'w', newline='') as f:
+    table = csv.writer(f)
+    table.writerow(['square']+names)
+    for i, sq in enumerate(squares):
+        table.writerow([sq]+['%.4g' % means[c][i] for c in names])
+
+if 'ctf_resolution' in means and args.top:
+    print('')
+    print('Worst squares by CTF resolution:')
+    order = np.argsort(-np.nan_to_num(means['ctf_resolution'], nan=-np.inf), kind='stable')
+    for i in order[:args.top]:
+        print('  '+squares[i]+'  '+', '.join(quality.describe(c, means[c][i]) for c in names))
+print('')
+print('Written '+out+' in '+'%.3f' % (time.time()-start)+' s')
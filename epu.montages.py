@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Paged contact sheets of the used and not used squares of an EPU analysis, and of the FoilHoles
+# of every square, each annotated with its particles. Run from the directory containing EPU_analysis,
+# writes EPU_analysis/montages, opened by the View used and View not used buttons of epu.browser.py
+#
+# epu.montages.py                   squares and FoilHoles of both subsets
+# epu.montages.py -e n -n 10x8      squares only, 80 to a sheet
+
+import argparse
+import time
+
+from epuanalysis import analysis, index, layers, montage, storage
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Contact sheets of used and not used squares and FoilHoles')
+parser.add_argument('-l', dest='layer', default=None, help='particle layer to count (default the analysis star file)')
+parser.add_argument('-n', dest='grid', default=str(montage.COLUMNS)+'x'+str(montage.ROWS), help='tiles per sheet as columns x rows (default 8x5)')
+parser.add_argument('-r', dest='size', type=int, default=montage.TILE, help='tile size in px (default 192)')
+parser.add_argument('-e', dest='holes', default='y', choices=['y', 'n'], help='also FoilHole sheets of every square (default y)')
+parser.add_argument('-j', dest='workers', type=int, default=None, help='parallel workers (default all cores)')
+parser.add_argument('-t', dest='threads', type=int, default=None, help='concurrent file reads (default 16, or EPU_IO_THREADS)')
+args = parser.parse_args()
+
+try:
+    columns, rows = [int(n) for n in args.grid.lower().split('x')]
+except ValueError:
+    parser.error('Tiles per sheet must be given as columns x rows, e.g. 8x5')
+if args.layer is not None and args.layer not in layers.layer_names():
+    parser.error('No layer '+args.layer+', see epu.particle_layers.py list')
+
+storage.configure(threads=args.threads)
+
+start = time.time()
+idx = index.load()
+layer = layers.load(args.layer) if args.layer else layers.default_layer()
+if layer is None:
+    parser.error('No star file in the analysis settings, add a layer with epu.particle_layers.py')
+exposure = layer.join(idx)[0]
+
+for subset in montage.SUBSETS:
+    written = montage.square_sheets(idx, exposure, subset, columns=columns, rows=rows, size=args.size, workers=args.workers)
+    print(subset+': '+str(len(written))+' square sheets')
+    if args.holes == 'y':
+        written = montage.foilhole_sheets(idx, exposure, subset, columns=columns, rows=rows, size=args.size, workers=args.workers)
+        print(subset+': '+str(len(written))+' FoilHole sheets')
+print('Written '+analysis.ANALYSIS_DIR+'/'+montage.MONTAGE_DIR+' in '+'%.1f' % (time.time()-start)+' s')
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Aggregate particle attributes of a star file per micrograph, FoilHole and square
+# Run from the directory containing EPU_analysis. Writes EPU_analysis/particle_attributes.npz, shown
+# as per square values and FoilHole colour maps in epu.star_to_epu_browser_inspect.py, and
+# EPU_analysis/squares_attributes.csv and foilholes_attributes.csv
+#
+# epu.particle_attributes.py -i Class2D/job020/run_it025_data.star -a class maxprob loglike
+
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+
+from epuanalysis import analysis, attributes, index
+
+###############################################################################
+
+settings = analysis.read_settings()
+
+parser = argparse.ArgumentParser(description='Per square and FoilHole aggregates of particle attributes')
+parser.add_argument('-i', dest='star', default=settings.get('Star'), help='input star file (default from settings.dat)')
+parser.add_argument('-c', dest='column', default=settings.get('Column') or '_rlnMicrographName', help='star column name')
+parser.add_argument('-s', dest='suffix', default=settings.get('Suffix'), help='suffix to remove')
+parser.add_argument('-a', dest='attributes', nargs='+', default=list(attributes.ATTRIBUTES), choices=list(attributes.ATTRIBUTES),
+                    help='attributes to aggregate, those missing from the star file are skipped (default all)')
+args = parser.parse_args()
+
+if not args.star:
+    parser.error('No star file given and none found in EPU_analysis/settings.dat')
+
+start = time.time()
+idx = index.load()
+try:
+    totals, unmatched = attributes.accumulate(idx, args.star, args.attributes, args.column, args.suffix)
+except (IOError, ValueError) as e:
+    parser.error(str(e))
+out = attributes.save_attributes(idx, totals, args.star)
+attrs = attributes.load_attributes(idx)
+print('Aggregated '+', '.join(attrs.present)+' of '+str(int(totals['particles'].sum()))+' particles, '+
+      str(unmatched)+' on micrographs outside the analysis, in '+'%.1f' % (time.time()-start)+' s')
+
+def write_table(path, level, keys):
+    columns = ['particles']
+    values = [attrs.particles(level)]
+    for a in attrs.present:
+        if a in attributes.CATEGORIES:
+            columns += [a, a+'_fraction']
+            values += [attrs.mean(level, a), attrs.fractions(level, a).max(axis=1)]
+        else:
+            columns += [a+'_mean', a+'_std']
+            values += [attrs.mean(level, a), attrs.std(level, a)]
+    with open(path, 'w', newline='') as f:
+        table = csv.writer(f)
+        table.writerow(list(keys)+columns)
+        for i, key in enumerate(zip(*keys.values())):
+            table.writerow(list(key)+['%.4g' % v[i] for v in values])
+    return path
+
+squares = {'square': [analysis.square_name(sq) for sq in idx.squares]}
+holes = {'foilhole': attrs.foilholes}
+if len(idx):
+    square_of = np.zeros(len(attrs.foilholes), dtype=int)
+    square_of[np.unique(idx.foilhole, return_inverse=True)[1]] = idx.square
+    holes['square'] = [squares['square'][s] for s in square_of]
+print('Written '+out+', '+write_table(os.path.join(analysis.ANALYSIS_DIR, 'squares_attributes.csv'), 'square', squares)+
+      ' and '+write_table(os.path.join(analysis.ANALYSIS_DIR, 'foilholes_attributes.csv'), 'foilhole', holes))
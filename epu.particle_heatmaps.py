@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Render particle density heatmaps onto every GridSquare image of an EPU analysis
+# Run from the directory containing EPU_analysis, after epu.star_to_epu_tracking_v2.sh
+# Overlays are written to EPU_analysis/heatmaps and shown by epu.star_to_epu_browser_inspect.py
+
+import argparse
+import time
+
+from epuanalysis import analysis, heatmap, star, storage
+
+###############################################################################
+
+settings = analysis.read_settings()
+
+parser = argparse.ArgumentParser(description='Particle density heatmaps on GridSquare images')
+parser.add_argument('-i', dest='star', default=settings.get('Star'), help='input star file (default from settings.dat)')
+parser.add_argument('-c', dest='column', default=settings.get('Column') or '_rlnMicrographName', help='star column name')
+parser.add_argument('-s', dest='suffix', default=settings.get('Suffix'), help='suffix to remove')
+parser.add_argument('-b', dest='bins', type=int, default=32, help='histogram bins across a square (default 32)')
+parser.add_argument('-j', dest='workers', type=int, default=None, help='parallel workers (default all cores)')
+parser.add_argument('-t', dest='threads', type=int, default=None, help='concurrent file reads (default 16, or EPU_IO_THREADS)')
+args = parser.parse_args()
+
+storage.configure(threads=args.threads)
+
+if not args.star:
+    parser.error('No star file given and none found in EPU_analysis/settings.dat')
+
+start = time.time()
+counts = star.particle_counts(args.star, args.column, args.suffix)
+print('Particles counted on '+str(len(counts))+' micrographs')
+done = heatmap.render_all(counts, bins=args.bins, workers=args.workers)
+print('Rendered '+str(len(done))+' square heatmaps to '+analysis.ANALYSIS_DIR+'/'+heatmap.HEATMAP_DIR+' in '+'%.1f' % (time.time()-start)+' s')
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Attach Relion star files to an EPU analysis as particle layers and compare them
+# Run from the directory containing EPU_analysis, the EPU index is built once by
+# epu.star_to_epu_tracking_v2.sh and every layer is joined against it without rerunning tracking
+#
+# epu.particle_layers.py add -i Class2D/job020/particles.star -n class2d
+# epu.particle_layers.py list
+# epu.particle_layers.py compare -a class2d -b refine3d
+# epu.particle_layers.py remove -n class2d
+
+import argparse
+import csv
+import os
+
+import numpy as np
+
+from epuanalysis import analysis, index, layers
+
+###############################################################################
+
+settings = analysis.read_settings()
+
+parser = argparse.ArgumentParser(description='Particle layers of an EPU analysis')
+sub = parser.add_subparsers(dest='command', required=True)
+add = sub.add_parser('add', help='attach a star file as a layer')
+add.add_argument('-i', dest='star', required=True, help='input star file')
+add.add_argument('-n', dest='name', default=None, help='layer name (default from the star file path)')
+add.add_argument('-c', dest='column', default=settings.get('Column') or '_rlnMicrographName', help='star column name')
+add.add_argument('-s', dest='suffix', default=settings.get('Suffix'), help='suffix to remove')
+sub.add_parser('list', help='list layers with particles per layer')
+rm = sub.add_parser('remove', help='remove a layer')
+rm.add_argument('-n', dest='name', required=True, help='layer name')
+cmp = sub.add_parser('compare', help='per square differential yield between two layers')
+cmp.add_argument('-a', dest='a', required=True, help='first layer')
+cmp.add_argument('-b', dest='b', required=True, help='second layer')
+cmp.add_argument('-o', dest='out', default=None, help='csv output (default EPU_analysis/layers/<a>_vs_<b>.csv)')
+args = parser.parse_args()
+
+for name in [getattr(args, 'a', None), getattr(args, 'b', None), args.name if args.command == 'remove' else None]:
+    if name is not None and name not in layers.layer_names():
+        parser.error('No layer '+name+', see epu.particle_layers.py list')
+
+if args.command == 'add':
+    layer = layers.attach(args.star, args.name, args.column, args.suffix)
+    _, _, unmatched = layer.join(index.load())
+    print('Layer '+layer.name+': '+str(layer.particles())+' particles on '+str(len(layer.counts))+' micrographs, '+str(unmatched)+' not matched to an EPU exposure')
+
+elif args.command == 'list':
+    idx = index.load()
+    layers.default_layer()
+    for name, layer in layers.load_all().items():
+        _, square, _ = layer.join(idx)
+        print('%-40s %9d particles  %5d squares used  %s' % (name, layer.particles(), np.sum(square > 0), layer.star))
+
+elif args.command == 'remove':
+    layers.remove(args.name)
+    print('Removed layer '+args.name)
+
+elif args.command == 'compare':
+    idx = index.load()
+    a, b = layers.load(args.a), layers.load(args.b)
+    sqa, sqb, diff = layers.differential(idx, a, b)
+    out = args.out or os.path.join(layers.layer_dir(), args.a+'_vs_'+args.b+'.csv')
+    with open(out, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['square', args.a, args.b, 'change', 'retained'])
+        for i in np.argsort(diff, kind='stable'):
+            retained = '%.3f' % (sqb[i]/sqa[i]) if sqa[i] > 0 else ''
+            writer.writerow([analysis.square_name(idx.squares[i]), int(sqa[i]), int(sqb[i]), int(diff[i]), retained])
+    print('Particles '+args.a+': '+str(int(sqa.sum()))+'  '+args.b+': '+str(int(sqb.sum())))
+    print('Squares losing most particles:')
+    for i in np.argsort(diff, kind='stable')[:10]:
+        print('  %-40s %8d -> %8d' % (analysis.square_name(idx.squares[i]), sqa[i], sqb[i]))
+    print('Written '+out)
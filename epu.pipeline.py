@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Run the analysis as a graph of stages, each rerun only when the files and settings it reads
+# have changed, and restored from an earlier run when they are back to what they were then.
+# Run from the directory that will contain EPU_analysis, settings default to those of the last
+# analysis. Stages are tracking, index, holes, heatmaps, image_stats, rank, montages and warehouse,
+# the last only when EPU_WAREHOUSE is set.
+#
+# epu.pipeline.py -e /dls/m02/data/2021/bi23047-76/EPU -i Extract/job010/particles.star -s _fractions
+# epu.pipeline.py -s _Fractions -n      show what a new suffix would rerun
+# epu.pipeline.py -f heatmaps           rerun heatmaps and every stage after it
+
+import argparse
+import time
+
+from epuanalysis import analysis, pipeline
+
+###############################################################################
+
+settings = analysis.read_settings()
+names = [s.name for s in pipeline.STAGES]
+
+parser = argparse.ArgumentParser(description='Run the EPU analysis stages whose inputs have changed')
+parser.add_argument('-e', dest='epu', default=settings.get('EPU'), help='EPU directory (default from settings.dat)')
+parser.add_argument('-i', dest='star', default=settings.get('Star'), help='input star file (default from settings.dat)')
+parser.add_argument('-s', dest='suffix', default=settings.get('Suffix'), help='suffix to remove (default from settings.dat)')
+parser.add_argument('-c', dest='column', default=settings.get('Column'), help='star column name (default from settings.dat)')
+parser.add_argument('-f', dest='force', nargs='+', default=[], choices=names, help='stages to run even if current, with those after them')
+parser.add_argument('-n', dest='dry', action='store_true', help='only show what would be run')
+parser.add_argument('-j', dest='workers', type=int, default=pipeline.WORKERS, help='stages run at once (default 4)')
+args = parser.parse_args()
+
+if not args.epu or not args.star:
+    parser.error('An EPU directory and star file are needed, none found in EPU_analysis/settings.dat')
+
+start = time.time()
+done = pipeline.run({'Star': args.star, 'EPU': args.epu, 'Column': args.column, 'Suffix': args.suffix},
+                    force=args.force, workers=args.workers, dry=args.dry)
+if args.dry:
+    print('Would run '+(', '.join(n for n in names if done.get(n, ('',))[0] == 'run') or 'nothing')+
+          ', restore '+(', '.join(n for n in names if done.get(n, ('',))[0] == 'restored') or 'nothing'))
+else:
+    ran = [n for n in names if done.get(n, ('',))[0] == 'run']
+    failed = [n for n in names if done.get(n, ('',))[0] == 'failed']
+    print('Ran '+str(len(ran))+' of '+str(len(names))+' stages in '+'%.1f' % (time.time()-start)+' s'+
+          (', failed: '+', '.join(failed) if failed else ''))
@@ -5,31 +5,16 @@
 
 import os
 import sys
-import xml.etree.ElementTree as ET
 
 import matplotlib
 import matplotlib.pyplot as plt
 
-# FEI EPU xml stuff
-ns = {'p': 'http://schemas.datacontract.org/2004/07/Applications.Epu.Persistence'}  # TODO: versioning
-ns['system'] = 'http://schemas.datacontract.org/2004/07/System'
-ns['so'] = 'http://schemas.datacontract.org/2004/07/Fei.SharedObjects'
-ns['g'] = 'http://schemas.datacontract.org/2004/07/System.Collections.Generic'
-ns['s'] = 'http://schemas.datacontract.org/2004/07/Fei.Applications.Common.Services'
-ns['a'] = 'http://schemas.datacontract.org/2004/07/System.Drawing'
+from epuanalysis import metadata
 
 # Define functions
 def xmlParse(filein):
-    # Read xml file for square
-    tree = ET.parse(filein)
-    root = tree.getroot()
-    # Find stage positions in xml file
-    stagePositionX = root.find('so:microscopeData/so:stage/so:Position/so:X', ns).text
-    stagePositionY = root.find('so:microscopeData/so:stage/so:Position/so:Y', ns).text
-    pixelSize = root.find('so:SpatialScale/so:pixelSize/so:x/so:numericValue', ns).text
-    # Return variables from function
-    # Remember variables cease to exist outside of function
-    return float(stagePositionX)*1e6, float(stagePositionY)*1e6, float(pixelSize)*1e6
+    # Stage positions and pixel size in microns from the shared xml parser
+    return metadata.stage_position(filein)
 
 ################################################################################
 
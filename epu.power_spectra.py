@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Power spectrum quick looks for every micrograph of an EPU analysis
+# Run from the directory containing EPU_analysis, writes EPU_analysis/spectra, shown by
+# ticking 'Spectrum' in epu.star_to_epu_browser_inspect.py. Spectra already computed from
+# the same source are kept, so rerunning after more collection only adds the new micrographs.
+#
+# epu.power_spectra.py              from the EPU jpgs
+# epu.power_spectra.py -m y         from the processed MRCs of the star file, the jpg where none is found
+
+import argparse
+import time
+
+import numpy as np
+
+from epuanalysis import analysis, layers, mrc, spectra, storage
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Power spectrum thumbnails and radial averages for all micrographs')
+parser.add_argument('-m', dest='mrc', default='n', choices=['y', 'n'], help='use the MRC micrographs of the star file (default n)')
+parser.add_argument('-l', dest='layer', default=None, help='particle layer whose star file names the MRCs (default the analysis star file)')
+parser.add_argument('-r', dest='size', type=int, default=spectra.SIZE, help='bin micrographs to at most this size in px (default 2048)')
+parser.add_argument('-b', dest='box', type=int, default=spectra.BOX, help='FFT box size in px (default 512)')
+parser.add_argument('-j', dest='workers', type=int, default=None, help='parallel workers (default all cores)')
+parser.add_argument('-t', dest='threads', type=int, default=None, help='concurrent file reads (default 16, or EPU_IO_THREADS)')
+parser.add_argument('-f', dest='force', action='store_true', help='recompute all spectra')
+args = parser.parse_args()
+
+if args.layer is not None and args.layer not in layers.layer_names():
+    parser.error('No layer '+args.layer+', see epu.particle_layers.py list')
+
+storage.configure(threads=args.threads)
+
+start = time.time()
+squares = analysis.square_images('all')
+mics = [m for listed in analysis.listing(squares, '_Data/*.jpg') for m in listed]
+sources = list(mics)
+if args.mrc == 'y':
+    layer = layers.load(args.layer) if args.layer else layers.default_layer()
+    if layer is None:
+        parser.error('No star file in the analysis settings, add a layer with epu.particle_layers.py')
+    found = [mrc.find(analysis.exposure_name(m), layer.star, layer.entry['column'], layer.entry['suffix']) for m in mics]
+    sources = [f or m for f, m in zip(found, mics)]
+    print('Found MRCs for '+str(sum(f is not None for f in found))+' of '+str(len(mics))+' micrographs')
+
+out, computed = spectra.compute_all(mics, sources, size=args.size, box=args.box, workers=args.workers, force=args.force)
+stored = spectra.read_spectra()
+radial = np.array([r for _, r in stored.values()])
+print('Computed '+str(computed)+' spectra, '+str(len(stored))+' stored, in '+'%.1f' % (time.time()-start)+' s')
+if len(radial) and np.isfinite(radial).any():
+    freq = spectra.frequencies(radial.shape[1])
+    print('Median radial power at 0.25, 0.5, 0.75 Nyquist: '+', '.join('%.3g' % np.nanmedian(radial[:, np.searchsorted(freq, f)]) for f in (0.25, 0.5, 0.75)))
+print('Written '+out)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Rank GridSquares and FoilHoles of an EPU analysis by particle yield
+# Run from the directory containing EPU_analysis, after epu.star_to_epu_tracking_v2.sh
+# Writes EPU_analysis/squares_ranked.csv and EPU_analysis/foilholes_ranked.csv
+
+import argparse
+import time
+
+import numpy as np
+
+from epuanalysis import analysis, images, index, metadata, quality, ranking, star, storage
+
+###############################################################################
+
+settings = analysis.read_settings()
+
+parser = argparse.ArgumentParser(description='Rank GridSquares and FoilHoles by particle yield')
+parser.add_argument('-i', dest='star', default=settings.get('Star'), help='input star file (default from settings.dat)')
+parser.add_argument('-c', dest='column', default=settings.get('Column') or '_rlnMicrographName', help='star column name')
+parser.add_argument('-s', dest='suffix', default=settings.get('Suffix'), help='suffix to remove')
+parser.add_argument('-d', dest='defocus', default='y', help='weight by exposure defocus from xml y/n (default y)')
+parser.add_argument('-j', dest='workers', type=int, default=None, help='parallel workers (default all cores)')
+parser.add_argument('-t', dest='threads', type=int, default=None, help='concurrent file reads (default 16, or EPU_IO_THREADS)')
+parser.add_argument('-n', dest='top', type=int, default=10, help='number of squares to report (default 10)')
+args = parser.parse_args()
+
+storage.configure(threads=args.threads)
+
+if not args.star:
+    parser.error('No star file given and none found in EPU_analysis/settings.dat')
+
+start = time.time()
+counts = star.particle_counts(args.star, args.column, args.suffix)
+squares = analysis.square_images('all')
+paths, square = analysis.exposures(squares)
+names = [analysis.exposure_name(p) for p in paths]
+particles = np.array([counts.get(n, 0) for n in names])
+print('Found '+str(len(squares))+' squares with '+str(len(names))+' exposures')
+
+defocus = None
+if args.defocus == 'y':
+    defocus = np.array([v['defocus'] for v in metadata.read_many(paths, ['defocus'])], dtype=float)
+
+sq, fh = ranking.rank_session(squares, names, square, particles, defocus)
+
+# Square image features, from epu.image_stats.py if it has been run
+stats = images.load_stats(analysis.ANALYSIS_DIR)
+if stats is not None and np.isfinite(stats.lookup(squares)).all():
+    sq['grey_mean'] = stats.lookup(squares, 'mean')
+    sq['grey_std'] = stats.lookup(squares, 'std')
+else:
+    grey = images.greyscale_all(squares, workers=args.workers)
+    sq['grey_mean'] = grey[:, 0]
+    sq['grey_std'] = grey[:, 1]
+
+# CTF and motion means, from epu.micrograph_quality.py if it has been run
+idx = index.load()
+qual = quality.load_quality(idx)
+if qual is not None:
+    at = {s: i for i, s in enumerate(idx.squares)}
+    position = [at.get(s, -1) for s in squares]
+    for c in ranking.QUALITY_COLUMNS:
+        if c in qual.columns:
+            means = np.append(qual.per_square(c), np.nan)
+            sq[c] = means[position]
+            fh[c] = qual.per_foilhole(c, fh['foilhole'])
+
+sqout, fhout = ranking.write_rankings(sq, fh)
+
+print('')
+print('Top squares by score (1 = session average exposure):')
+for r, i in enumerate(ranking.rank(sq['score'])[:args.top]):
+    print('  %3d  %s  score %.2f  survival %.2f  particles %d  grey %.1f' %
+          (r+1, sq['square'][i], sq['score'][i], sq['survival'][i], sq['particles'][i], sq['grey_mean'][i]))
+print('')
+print('Written '+sqout+' and '+fhout+' in '+'%.1f' % (time.time()-start)+' s')
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Serve an EPU_report directory written by epu.session_report.py
+# Binds to localhost, for remote sessions forward the port over ssh:
+#   ssh -L 8000:localhost:8000 <host>   then browse to http://localhost:8000/
+
+import argparse
+
+from epuanalysis import report, viewer
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Serve an EPU session report')
+parser.add_argument('-d', dest='directory', default=report.REPORT_DIR, help='report directory (default EPU_report)')
+parser.add_argument('-p', dest='port', type=int, default=8000, help='port (default 8000)')
+parser.add_argument('-b', dest='bind', default='127.0.0.1', help='address to bind (default 127.0.0.1)')
+args = parser.parse_args()
+
+viewer.serve(args.directory, args.port, args.bind)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Targeted and acquired holes of an EPU session from EpuSession.dm and Metadata/GridSquare_<id>.dm
+# Run from the directory containing EPU_analysis, writes EPU_analysis/holes.npz, which the inspector
+# uses to place holes on the square image, including holes that were targeted but never acquired
+#
+# epu.session_holes.py
+# epu.session_holes.py -e /dls/m02/data/2021/bi23047-76/EPU -o holes.csv
+
+import argparse
+import csv
+import time
+
+import numpy as np
+
+from epuanalysis import analysis, index, session, storage
+
+###############################################################################
+
+settings = analysis.read_settings()
+
+parser = argparse.ArgumentParser(description='Targeted and acquired holes from the EPU session metadata')
+parser.add_argument('-e', dest='epu', default=settings.get('EPU'), help='EPU directory with EpuSession.dm and Metadata (default from the analysis settings)')
+parser.add_argument('-o', dest='out', default=None, help='also write the holes to a csv file')
+parser.add_argument('-t', dest='threads', type=int, default=None, help='concurrent file reads (default 16, or EPU_IO_THREADS)')
+args = parser.parse_args()
+
+if not args.epu:
+    parser.error('No EPU directory given or found in the analysis settings')
+
+storage.configure(threads=args.threads)
+
+start = time.time()
+info = session.read_session(args.epu)
+idx = index.load()
+holes = session.build_holes(idx, args.epu)
+
+print('Session '+str(info['name'])+': '+str(len(info['squares']))+' squares with targets, '+str(len(idx.squares))+' in the analysis')
+targets = holes.targets
+print('%d holes targeted, %d selected, %d acquired, %d near a grid bar' % (len(targets), targets['selected'].sum(), holes.acquired.sum(), targets['near_grid_bar'].sum()))
+missing = np.bincount(holes.square, minlength=len(idx.squares)) == 0
+if missing.any():
+    print(str(missing.sum())+' analysis squares have no GridSquare .dm in '+args.epu+'/'+session.METADATA_DIR)
+if args.out:
+    with open(args.out, 'w', newline='') as f:
+        out = csv.writer(f)
+        out.writerow(['square']+list(session.TARGET.names)+['acquired'])
+        for sq, t, a in zip(holes.square, targets, holes.acquired):
+            out.writerow([analysis.square_name(idx.squares[sq])]+list(t.tolist())+[bool(a)])
+    print('Written '+args.out)
+print('Written '+session.holes_path()+' in '+'%.1f' % (time.time()-start)+' s')
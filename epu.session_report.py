@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Export an EPU analysis as a static HTML report for remote review
+# Run from the directory containing EPU_analysis, ideally after epu.particle_heatmaps.py and
+# epu.image_stats.py so the report includes heatmap layers and greyscale
+# Rerunning only renders squares whose images or particle counts changed
+# View with epu.report_server.py, or open EPU_report/index.html directly
+
+import argparse
+import time
+
+from epuanalysis import analysis, report, star, storage
+
+###############################################################################
+
+settings = analysis.read_settings()
+
+parser = argparse.ArgumentParser(description='Static HTML report of an EPU analysis')
+parser.add_argument('-i', dest='star', default=settings.get('Star'), help='input star file (default from settings.dat)')
+parser.add_argument('-c', dest='column', default=settings.get('Column') or '_rlnMicrographName', help='star column name')
+parser.add_argument('-s', dest='suffix', default=settings.get('Suffix'), help='suffix to remove')
+parser.add_argument('-o', dest='out', default=report.REPORT_DIR, help='output directory (default EPU_report)')
+parser.add_argument('-f', dest='force', action='store_true', help='render every square again')
+parser.add_argument('-j', dest='workers', type=int, default=None, help='parallel workers (default all cores)')
+parser.add_argument('-t', dest='threads', type=int, default=None, help='concurrent file reads (default 16, or EPU_IO_THREADS)')
+args = parser.parse_args()
+
+storage.configure(threads=args.threads)
+
+start = time.time()
+counts = star.particle_counts(args.star, args.column, args.suffix) if args.star else {}
+total, rendered = report.export(counts, args.out, workers=args.workers, force=args.force)
+print('Rendered '+str(rendered)+' of '+str(total)+' squares to '+args.out+' in '+'%.1f' % (time.time()-start)+' s')
+print('View with: epu.report_server.py -d '+args.out)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Write a copy of a star file without the particles of chosen squares and FoilHoles, or with only them
+# Run from the directory containing EPU_analysis. The star file is streamed once, headers and
+# data_optics are copied byte for byte, so multi GB particle files filter in constant memory.
+#
+# epu.star_subset.py -o clean.star -x                    drop squares and FoilHoles excluded in the inspector
+# epu.star_subset.py -o clean.star -q GridSquare_20210806_120003 -H 5871221
+# epu.star_subset.py -o clean.star -w 'defocus>-1.0'     drop exposures by acquisition metadata
+# epu.star_subset.py -o clean.star -w 'ctf_resolution>6'  or by quality from epu.micrograph_quality.py
+# epu.star_subset.py -o good.star -m keep -q GridSquare_20210806_120000
+# epu.star_subset.py -o good.star -m keep -f 'particles > 50 and square_grey_mean between 80 and 120'
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from epuanalysis import analysis, filters, index, selection, storage
+
+###############################################################################
+
+settings = analysis.read_settings()
+
+parser = argparse.ArgumentParser(description='Filter a star file by square, FoilHole or acquisition metadata')
+parser.add_argument('-i', dest='star', default=settings.get('Star'), help='input star file (default from settings.dat)')
+parser.add_argument('-c', dest='column', default=settings.get('Column') or '_rlnMicrographName', help='star column name')
+parser.add_argument('-s', dest='suffix', default=settings.get('Suffix'), help='suffix to remove')
+parser.add_argument('-o', dest='out', required=True, help='output star file')
+parser.add_argument('-q', dest='squares', nargs='+', default=[], help='GridSquare names')
+parser.add_argument('-H', dest='holes', nargs='+', type=int, default=[], help='FoilHole ids')
+parser.add_argument('-w', dest='conditions', action='append', default=[], help="metadata or quality condition, e.g. 'defocus<-2.5', repeat to combine")
+parser.add_argument('-f', dest='filter', default=None, help="filter expression, e.g. 'particles > 50 and defocus < -2.0', see epuanalysis/filters.py")
+parser.add_argument('-x', dest='excluded', action='store_true', help='add the squares and FoilHoles excluded in the inspector')
+parser.add_argument('-m', dest='mode', default='drop', choices=['drop', 'keep'], help='drop the selection or keep only it (default drop)')
+parser.add_argument('-t', dest='threads', type=int, default=None, help='concurrent file reads (default 16, or EPU_IO_THREADS)')
+args = parser.parse_args()
+
+if not args.star:
+    parser.error('No star file given and none found in EPU_analysis/settings.dat')
+if os.path.abspath(args.out) == os.path.abspath(args.star):
+    parser.error('Output would overwrite the input star file')
+try:
+    conditions = [selection.parse_condition(c) for c in args.conditions]
+except ValueError as e:
+    parser.error(str(e))
+
+storage.configure(threads=args.threads)
+
+start = time.time()
+squares, holes = list(args.squares), set(args.holes)
+if args.excluded:
+    marked_squares, marked_holes = selection.read_excluded()
+    squares += sorted(marked_squares)
+    holes |= marked_holes
+if not (squares or holes or conditions or args.filter):
+    parser.error('Nothing selected, give squares, FoilHoles, conditions, a filter or -x')
+idx = index.load()
+try:
+    mask = selection.select(idx, squares, holes, conditions)
+    if args.filter:
+        table = filters.Table(idx)
+        mask |= filters.Filter(args.filter, table).mask(table)
+except ValueError as e:
+    parser.error(str(e))
+print('Selected '+str(int(mask.sum()))+' of '+str(len(idx))+' exposures on '+str(len(np.unique(idx.square[mask])))+' squares')
+kept, total = selection.write_subset(args.star, args.out, idx, mask, args.mode == 'drop', args.column, args.suffix)
+print('Kept '+str(kept)+' of '+str(total)+' particles in '+'%.1f' % (time.time()-start)+' s')
+print('Written '+args.out)
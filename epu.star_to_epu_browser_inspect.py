@@ -35,50 +35,40 @@ from tkinter import ttk
 #from tkinter import filedialog
 #from tkinter.ttk import Progressbar
 import subprocess
-
-from PIL import ImageTk, Image
+import threading
 
 import glob
 
+# PIL, numpy and the analysis stores are imported and read by loadStores in a background
+# thread once the window is up, see startup at the end of this file
+Image = None
+ImageTk = None
+np = None
+
 ###############################################################################
 
 def inspectXml():
-    # Write the current micrograph to a file for reading by xml inspection gui
-    # This is not the right way, pass over as variable properly
-    # https://www.code4example.com/python/tkinter/tkinter-passing-variables-between-windows/
+    # Open the xml inspection panel for the current micrograph, or raise it if already open
+    # The panel then follows the micrograph selection, see MicSelect
+    global xmlpanel
     value = str(miclist.get(miclist.curselection()))
     imgpath = value.rstrip()
     print(imgpath)
-    file = open(".micrograph.dat", "w")
-    file.write(imgpath + "\n")
-    file.close()
-    # Open the xml inspection GUI
-    os.system('epu.xml_inspector.py')
-
-def file_len(fname):
-    p = subprocess.Popen(['wc', '-l', fname], stdout=subprocess.PIPE,
-                                              stderr=subprocess.PIPE)
-    result, err = p.communicate()
-    if p.returncode != 0:
-        raise IOError(err)
-    return int(result.strip().split()[0])
-
-def popSquares():
+    if xmlpanel is None or not xmlpanel.winfo_exists():
+        from epuanalysis.xmlpanel import XmlPanel
+        xmlpanel = XmlPanel(main_frame, source=snapshot)
+    xmlpanel.show(imgpath)
+    xmlpanel.lift()
+
+def popSquares(task_list):
     # Clear current square list
     sqlist.delete(0,tk.END)
-    ## Populate square list box
-    try:
-        f = open('./EPU_analysis/.squares_all.dat')
-        task_list = f.readlines()
-        for item in task_list:
-            sqlist.insert(tk.END, item)
-        f.close()
-    ## Populate fields with defaults if analysis not performed
-    except IOError:
-        print('Previous analysis not found')
+    ## Populate square list box, lines of .squares_all.dat read by loadStores
+    for item in task_list:
+        sqlist.insert(tk.END, item)
     ## Print useful information in label
     #Number of Square images
-    wc = file_len('./EPU_analysis/.squares_all.dat')
+    wc = len(task_list)
     lbl = Label(main_frame, text='Number of Squares: '+str(wc)+'  ')
     lbl.grid(sticky="w",column=2, row=12)
 
@@ -98,24 +88,41 @@ def popSquares():
     lbl = Label(main_frame, text='No. of particles:')
     lbl.grid(sticky="w",column=8, row=15)
 
+def storesLoading():
+    # The list and image handlers need PIL, numpy and the stores, which loadStores is still reading
+    if stores.is_alive():
+        print('Still loading the analysis')
+        return True
+    return False
+
 def popConditional():
+    if storesLoading():
+        return
     # Clear current list
     sqlist.delete(0,tk.END)
     # Get radio button variable to load All, Used, or NotUsed squares
     value = radioSq.get()
+    task_list = []
     ## Populate list box
     try:
-        f = open(str(value))
-        task_list = f.readlines()
+        if layerYield is not None and not value.endswith('.squares_all.dat'):
+            # Used and not used squares of the selected particle layer
+            used = value.endswith('.squares_used.dat')
+            task_list = [item for item in squareList if (squareYield(item) > 0) == used]
+        else:
+            f = openFile(str(value))
+            task_list = f.readlines()
+            f.close()
+        if filterSquares is not None:
+            task_list = [item for item in task_list if os.path.splitext(os.path.basename(item.strip()))[0] in filterSquares]
         for item in task_list:
             sqlist.insert(tk.END, item)
-        f.close()
     ## Populate fields with defaults if analysis not performed
     except IOError:
         print('Previous analysis not found')
     ## Print useful information in label
     #Number of Square images
-    wc = file_len(str(value))
+    wc = len(task_list)
     lbl = Label(main_frame, text='Number of Squares: '+str(wc)+'  ')
     lbl.grid(sticky="w",column=2, row=12)
 
@@ -136,6 +143,8 @@ def popConditional():
     lbl.grid(sticky="w",column=8, row=15)
 
 def SquareSelect(evt):
+    if storesLoading():
+        return
     value=str(sqlist.get(sqlist.curselection()))
     imgpath = value.rstrip()
     print("111",imgpath)
@@ -143,30 +152,27 @@ def SquareSelect(evt):
     global squarepath
     squarepath = imgpath
     #Load square image
-    load = RBGAImage(imgpath)
-    width, height = load.size
-    print(width, height)
-    ratio = width/height
-    print(ratio)
-    load = load.resize((400,int(400/ratio)), Image.ANTIALIAS)
-    render = ImageTk.PhotoImage(load)
-    imgSq = Label(main_frame, image=render)
-    imgSq.image = render
-    imgSq.place(x=0, y=395)
+    loadSquare()
 
     #Report selected square to GUI
     name = os.path.basename(imgpath)
     entrySq.delete(0, tk.END)
     entrySq.insert(0, name)
+    yieldLabel()
+    qualityLabel('square', imgpath, 2)
+    attributeLabel('square', squareIndex.get(os.path.normpath(imgpath)), 2)
     #Populate Foil Holes
     value=os.path.splitext(imgpath)[0]
     ## Clear FoilHole list box
     foillist.delete(0,tk.END)
     ## Populate list box
     try:
-        f = open(value+'_FoilHoles.dat')
+        f = openFile(value+'_FoilHoles.dat')
         task_list = f.readlines()
         for item in task_list:
+            ## FoilHoles without an exposure meeting the filter expression are left out
+            if filterHoles is not None and int(os.path.basename(item).split('_')[1]) not in filterHoles:
+                continue
             ## Populate FoilHole list based on level of particle filtering selected
             global foilfilt
             global star
@@ -178,6 +184,10 @@ def SquareSelect(evt):
                 name=(os.path.splitext(base)[0])
                 reference=name.split('_')[1]
                 # Only populate list if foil reference can be found in star file
+                if usedHoles is not None:
+                    if int(reference) in usedHoles:
+                        foillist.insert(tk.END, item)
+                    continue
                 with open(star[1]) as file:
                     if reference in file.read():
                         foillist.insert(tk.END, item)
@@ -187,12 +197,18 @@ def SquareSelect(evt):
                 name=(os.path.splitext(base)[0])
                 reference=name.split('_')[1]
                 # Only populate list if foil reference can be found in star file
+                if usedHoles is not None:
+                    if int(reference) not in usedHoles:
+                        foillist.insert(tk.END, item)
+                    continue
                 with open(star[1]) as file:
                     if reference in file.read():
                         print("not")
                     else:
                         foillist.insert(tk.END, item)
         f.close()
+        if sort_state.get() == 1:
+            sortFoilHoles()
     ## Populate fields with defaults if analysis not performed
     except IOError:
         print(value+'_FoilHoles.dat not found')
@@ -205,15 +221,282 @@ def SquareSelect(evt):
     #foillist.selection_set(first=0)
     select(foillist, 0, FoilSelect)
 
+def squareYield(path, layer=None):
+    # Particles on a square in the selected (or given) particle layer
+    yields = layerYield if layer is None else layerSquares(layer)[0]
+    i = squareIndex.get(os.path.normpath(path.strip()))
+    return 0 if yields is None or i is None else int(yields[i])
+
+def layerSquares(name):
+    # Per square particles and FoilHole ids with particles for a layer, joined once per layer
+    if name not in layerJoins:
+        exposure, square, _ = particleLayers[name].join(sessionIndex)
+        layerJoins[name] = (square, set(sessionIndex.foilhole[exposure > 0].tolist()))
+    return layerJoins[name]
+
+def layerSelect(event=None):
+    # Switch particle layer, particle numbers, filters and yields follow it
+    global partCounts, layerYield, usedHoles
+    if storesLoading():
+        return
+    name = comboLayer.get()
+    if name not in particleLayers:
+        return
+    print('Using particle layer '+name)
+    partCounts = particleLayers[name].counts
+    layerYield, usedHoles = layerSquares(name)
+    yieldLabel()
+    if radioSq.get():
+        popConditional()
+
+def yieldLabel():
+    # Particles on the selected square, and the change against the compare layer
+    try:
+        squarepath
+    except NameError:
+        return
+    text = '                              '
+    if layerYield is not None:
+        a = squareYield(squarepath)
+        text = 'Square particles: '+str(a)
+        other = comboCompare.get()
+        if other in particleLayers and other != comboLayer.get():
+            b = squareYield(squarepath, other)
+            text = text+' / '+str(b)+' (%+d)' % (b-a)
+        text = text+'      '
+    lbl = Label(main_frame, text=text)
+    lbl.grid(sticky="w",column=8, row=14)
+
+def sortFoilHoles():
+    # Order FoilHole list by greyscale from epu.image_stats.py, darkest first
+    if storesLoading():
+        return
+    if imgstats is None:
+        print('No image statistics found, run epu.image_stats.py')
+        return
+    task_list = list(foillist.get(0, tk.END))
+    foillist.delete(0, tk.END)
+    for i in imgstats.order([item.rstrip() for item in task_list]):
+        foillist.insert(tk.END, task_list[i])
+
+def qualityValues(kind, path):
+    # CTF resolution and total motion from epu.micrograph_quality.py of a square, FoilHole or micrograph
+    if qualityStore is None:
+        return {}
+    from epuanalysis import analysis
+    columns = [c for c in ['ctf_resolution', 'motion_total'] if c in qualityStore.columns]
+    if kind == 'square':
+        i = squareIndex.get(os.path.normpath(path))
+        return {} if i is None else {c: qualityStore.per_square(c)[i] for c in columns}
+    if kind == 'foilhole':
+        ref = analysis.foilhole_id(os.path.basename(path))
+        return {c: qualityStore.per_foilhole(c, [ref])[0] for c in columns}
+    name = analysis.exposure_name(path)
+    return {c: qualityStore.exposure(name, c) for c in columns}
+
+def qualityLabel(kind, path, column):
+    text = '                                                  '
+    values = qualityValues(kind, path)
+    if values:
+        from epuanalysis import quality
+        text = ', '.join(quality.describe(c, v) for c, v in values.items())+'      '
+    lbl = Label(main_frame, text=text)
+    lbl.grid(sticky="w",column=column, row=15)
+
+def sortSquares(event=None):
+    # Order the square list by a quality column, best first and squares without values last
+    if storesLoading():
+        return
+    choice = comboSort.get()
+    if choice not in qualitySort:
+        popConditional() if radioSq.get() else popSquares(squareList)
+        return
+    if qualityStore is None or qualitySort[choice] not in qualityStore.columns:
+        print('No quality store, run epu.micrograph_quality.py')
+        return
+    means = qualityStore.per_square(qualitySort[choice])
+    task_list = list(sqlist.get(0, tk.END))
+    values = [means[i] if i is not None else np.nan for i in (squareIndex.get(os.path.normpath(item.strip())) for item in task_list)]
+    sqlist.delete(0, tk.END)
+    for i in np.argsort(values, kind='stable'):
+        sqlist.insert(tk.END, task_list[i])
+
+def holeColours(path, size):
+    # FoilHoles of the square coloured by a particle attribute from epu.particle_attributes.py
+    key = holeAttributes.get(comboHoles.get())
+    if key is None:
+        return None
+    if attrStore is None:
+        print('No particle attributes found, run epu.particle_attributes.py')
+        return None
+    from epuanalysis import attributes, holemap
+    holes = holemap.load(path, snapshot)
+    values = attrStore.particles('foilhole') if key == 'particles' else attrStore.mean('foilhole', key)
+    if key in attributes.CATEGORIES:
+        return attributes.hole_overlay(holes, attrStore.of_foilhole(values, holes.ids), size, (0, 20), 'tab20')
+    limits = attributes.value_range(values)
+    print(comboHoles.get()+' from %.3g (dark) to %.3g (bright)' % limits)
+    return attributes.hole_overlay(holes, attrStore.of_foilhole(values, holes.ids), size, limits)
+
+def attributeLabel(level, key, column):
+    # Mean particle attributes of the selected square or FoilHole
+    text = '                                                  '
+    if attrStore is not None and key is not None:
+        from epuanalysis import attributes
+        parts = []
+        for a in attrStore.present:
+            mean = attrStore.mean(level, a)[key]
+            if not np.isfinite(mean):
+                continue
+            if a in attributes.CATEGORIES:
+                share = attrStore.fractions(level, a)[key].max()
+                parts.append(attributes.ATTRIBUTES[a][1]+' %d (%.0f%%)' % (mean, 100*share))
+            else:
+                parts.append(attributes.ATTRIBUTES[a][1]+' %.3g' % mean)
+        if parts:
+            text = ', '.join(parts[:3])+'      '
+    lbl = Label(main_frame, text=text)
+    lbl.grid(sticky="w",column=column, row=17)
+
+def greyLabel(text, paths, row):
+    # Report mean greyscale and ice thickness proxy of images from epu.image_stats.py
+    if imgstats is None or not paths:
+        text = '                                           '
+    else:
+        grey = imgstats.mean(paths)
+        ice = imgstats.mean(paths, 'ice')
+        text = text+' %.1f (ice %.2f)      ' % (grey, ice)
+    lbl = Label(main_frame, text=text)
+    lbl.grid(sticky="w",column=6, row=row)
+
+def loadSquare():
+    #Load square image, with particle heatmap overlay if selected
+    global squarepath
+    load = RBGAImage(squarepath)
+    width, height = load.size
+    print(width, height)
+    ratio = width/height
+    print(ratio)
+    heatpath = './EPU_analysis/heatmaps/'+os.path.splitext(os.path.basename(squarepath))[0]+'.png'
+    if heat_state.get() == 1:
+        if isFile(heatpath):
+            heatLoad = RBGAImage(heatpath).resize((width, height), Image.NEAREST)
+            load = Image.alpha_composite(load, heatLoad)
+        else:
+            print(heatpath+' not found, run epu.particle_heatmaps.py')
+    colours = holeColours(squarepath, (width, height))
+    if colours is not None:
+        load = Image.alpha_composite(load, colours)
+    load = load.resize((400,int(400/ratio)), Image.LANCZOS)
+    render = ImageTk.PhotoImage(load)
+    imgSq.configure(image=render)
+    imgSq.image = render
+    #Display size, for placing FoilHoles under the mouse
+    global squareSize
+    squareSize = load.size
+    #Place the square's FoilHoles in the background, ready for the mouse
+    threading.Thread(target=loadHoles, args=(squarepath, snapshot), daemon=True).start()
+
+def loadHoles(path, source):
+    #Background thread, FoilHole map of a square for squareHole, nothing here may touch tkinter
+    global squareHoles
+    import xml.etree.ElementTree as ET
+    from epuanalysis import holemap
+    try:
+        squareHoles = (path, holemap.load(path, source))
+    except (IOError, OSError, ValueError, ET.ParseError) as e:
+        print('FoilHole positions not read for '+path+': '+str(e))
+
+def squareHole(event):
+    #FoilHole image and id nearest the mouse on the square image, within 15 px of the display
+    #The image is None for holes targeted but not acquired, and the id -1 if there is no hole
+    try:
+        squarepath
+    except NameError:
+        return None, -1
+    #Nothing is found until loadHoles has placed the square's FoilHoles
+    if squareSize is None or squareHoles is None or squareHoles[0] != squarepath:
+        return None, -1
+    holes = squareHoles[1]
+    scale = holes.frame/squareSize[0]
+    i = holes.nearest(event.x*scale, event.y*holes.height/squareSize[1], 15*scale)
+    return (holes.paths[i], int(holes.ids[i])) if i >= 0 else (None, -1)
+
+def squareClick(event):
+    #Select the FoilHole clicked on the square image
+    hole, holeid = squareHole(event)
+    if hole is None:
+        if holeid >= 0:
+            print('FoilHole_'+str(holeid)+' was targeted but not acquired')
+        return
+    listed = [os.path.normpath(str(item).rstrip()) for item in foillist.get(0, tk.END)]
+    if os.path.normpath(hole) not in listed:
+        print(os.path.basename(hole)+' is not in the FoilHole list, check the FoilHole filter')
+        return
+    select(foillist, listed.index(os.path.normpath(hole)), FoilSelect)
+
+def squareHover(event):
+    #Name the FoilHole under the mouse
+    hole, holeid = squareHole(event)
+    if holeid < 0:
+        holeTip.place_forget()
+        return
+    text = 'FoilHole_'+str(holeid)
+    if hole is None:
+        text += ' (not acquired)'
+    elif usedHoles is not None:
+        text += ' (used)' if holeid in usedHoles else ' (not used)'
+    holeTip.configure(text=text)
+    holeTip.place(x=event.x+12, y=395+event.y+12)
+    holeTip.lift()
+
+def heatClick():
+    #Redraw current square with or without heatmap
+    if storesLoading():
+        return
+    try:
+        squarepath
+    except NameError:
+        return
+    loadSquare()
+
+def excludeClick(kind):
+    # Mark the current square or FoilHole as excluded, for epu.star_subset.py -x
+    if snapshot is not None:
+        print('Exclusions are not saved from a snapshot')
+        return
+    from epuanalysis import analysis, selection
+    try:
+        if kind == 'square':
+            selection.set_excluded(kind, analysis.square_name(squarepath), exsq_state.get() == 1)
+        else:
+            selection.set_excluded(kind, analysis.foilhole_id(os.path.basename(foilpath)), exfoil_state.get() == 1)
+    except NameError:
+        return
+
+def excludeState():
+    # Show whether the current square and FoilHole are excluded
+    if snapshot is not None:
+        return
+    from epuanalysis import analysis, selection
+    squares, foilholes = selection.read_excluded()
+    try:
+        exsq_state.set(int(analysis.square_name(squarepath) in squares))
+        exfoil_state.set(int(analysis.foilhole_id(os.path.basename(foilpath)) in foilholes))
+    except NameError:
+        pass
+
 def select(self, index, command):
     self.activate(index)
     self.select_clear(0, "end")
     self.selection_set(index)
     self.see(index)
     self.selection_anchor(index)
-    command()
+    command(None)
 
 def FoilSelect(evt):
+    if storesLoading():
+        return
     value = str(foillist.get(foillist.curselection()))
     imgpath = value.rstrip()
     #Define global variable for use outside def, FoilHole
@@ -225,7 +508,7 @@ def FoilSelect(evt):
     print(width, height)
     ratio = width/height
     print(ratio)
-    load = load.resize((400,int(400/ratio)), Image.ANTIALIAS)
+    load = load.resize((400,int(400/ratio)), Image.LANCZOS)
     render = ImageTk.PhotoImage(load)
     imgFoil = Label(main_frame, image=render)
     imgFoil.image = render
@@ -240,7 +523,9 @@ def FoilSelect(evt):
     # Find term from FoilHole to search for data images
     foilref = os.path.basename(foilpath).split('_')[1]
     # Search for associated data images
-    datafiles = [f for f in glob.glob(datapath + "**/*"+str(foilref)+"*.jpg", recursive=True)]
+    datafiles = [f for f in (snapshot or glob).glob(datapath + "**/*"+str(foilref)+"*.jpg", recursive=True)]
+    if filterNames is not None:
+        datafiles = [f for f in datafiles if os.path.splitext(os.path.basename(f))[0] in filterNames]
     ## Populate data list box
     # Clear Data list box
     miclist.delete(0,tk.END)
@@ -252,24 +537,32 @@ def FoilSelect(evt):
     #Number of FoilHoles images
     lbl = Label(main_frame, text='Number of Micrographs: '+str(len(datafiles)))
     lbl.grid(sticky="w",column=6, row=12)
+    greyLabel('Greyscale of FoilHole Micrograph(s):', datafiles, 13)
+    qualityLabel('foilhole', imgpath, 4)
+    attributeLabel('foilhole', None if attrStore is None else attrStore.foilhole_at(int(foilref)), 4)
     clearPickNo()
+    excludeState()
     ## Select first FoilHole of selected Square
     #foillist.selection_set(first=0)
     select(miclist, 0, MicSelect)
 
 def MicSelect(evt):
+    if storesLoading():
+        return
     value = str(miclist.get(miclist.curselection()))
     imgpath = value.rstrip()
     #Define global variable for use outside def, FoilHole
     global micpath
     micpath = imgpath
-    #Load Micrograph image
-    load = RBGAImage(imgpath)
+    #Load Micrograph image, or its power spectrum from epu.power_spectra.py
+    load = specImage(imgpath) if spec_state.get() == 1 else None
+    if load is None:
+        load = micImage(imgpath)
     width, height = load.size
     print(width, height)
     ratio = width/height
     print(ratio)
-    load = load.resize((400,int(400/ratio)), Image.ANTIALIAS)
+    load = load.resize((400,int(400/ratio)), Image.LANCZOS)
     render = ImageTk.PhotoImage(load)
     imgMic = Label(main_frame, image=render)
     imgMic.image = render
@@ -278,17 +571,27 @@ def MicSelect(evt):
     name = os.path.basename(imgpath)
     entryMic.delete(0, tk.END)
     entryMic.insert(0, name)
+    greyLabel('Greyscale of selected Micrograph(s):', [imgpath], 14)
+    qualityLabel('micrograph', imgpath, 6)
+    #Update xml inspection panel if open
+    if xmlpanel is not None and xmlpanel.winfo_exists():
+        xmlpanel.show(imgpath)
     #Report number of picked particles to GUI
     clearPickNo()
-    partLines = []
-    global star
-    #for line in open(star[1]):
-    for line in open("EPU_analysis/star/.mainDataLines.dat"):
-        if os.path.splitext(name)[0] in line:
-            partLines.append(line)
-            partNo = len(partLines)
-            lbl = Label(main_frame, text="  "+str(partNo))
-            lbl.grid(sticky="W",column=8, row=17)
+    if partCounts is not None:
+        # Counted once per micrograph by loadStores
+        lbl = Label(main_frame, text="  "+str(partCounts.get(os.path.splitext(name)[0], 0)))
+        lbl.grid(sticky="W",column=8, row=17)
+    else:
+        partLines = []
+        global star
+        #for line in open(star[1]):
+        for line in openFile("EPU_analysis/star/.mainDataLines.dat"):
+            if os.path.splitext(name)[0] in line:
+                partLines.append(line)
+                partNo = len(partLines)
+                lbl = Label(main_frame, text="  "+str(partNo))
+                lbl.grid(sticky="W",column=8, row=17)
     #Plot particles?
     if pick_state.get() == 1:
         plotPicks()
@@ -303,6 +606,57 @@ def radioClickFoil():
     foilfilt = radioFoil.get()
     print("Radio button clicked, FoilHole filtering "+foilfilt)
 
+def applyFilter(event=None):
+    # Narrow the square, FoilHole and micrograph lists to the exposures meeting the filter expression,
+    # e.g. particles > 50 and defocus < -2.0, see epuanalysis/filters.py for the columns
+    global filterSquares, filterHoles, filterNames, filterLoading
+    from epuanalysis import filters
+    text = entryFilter.get().strip()
+    if not text:
+        filterSquares = filterHoles = filterNames = None
+        lblFilter.configure(text='No filter')
+        popConditional()
+        return
+    if filterTable is None:
+        # Built by loadStores, from the analysis directory only
+        lblFilter.configure(text='Filters need the analysis directory' if not stores.is_alive() else 'Loading analysis...')
+        return
+    try:
+        compiled = filters.Filter(text, filterTable)
+    except ValueError as e:
+        print(str(e))
+        lblFilter.configure(text=str(e)[:45])
+        return
+    # xml metadata columns are read from every exposure xml on first use, away from the GUI
+    if filterLoading is not None and filterLoading.is_alive():
+        main_frame.after(100, applyFilter)
+        return
+    if compiled.fields.intersection(filterTable.lazy):
+        lblFilter.configure(text='Reading exposure metadata...')
+        filterLoading = threading.Thread(target=loadFilterColumns, args=(filterTable, compiled.fields), daemon=True)
+        filterLoading.start()
+        main_frame.after(100, applyFilter)
+        return
+    mask = compiled.mask(filterTable)
+    filterSquares = {os.path.splitext(os.path.basename(sq))[0] for sq in sessionIndex.squares[filters.squares(sessionIndex, mask)]}
+    filterHoles = filters.foilholes(sessionIndex, mask)
+    filterNames = filters.exposures(sessionIndex, mask)
+    lblFilter.configure(text=str(int(mask.sum()))+' of '+str(len(mask))+' micrographs')
+    if not radioSq.get():
+        radioSq.set('./EPU_analysis/.squares_all.dat')
+    popConditional()
+
+def loadFilterColumns(table, fields):
+    # Background thread, reads the lazy columns of a filter table, nothing here may touch tkinter
+    try:
+        for field in fields:
+            table[field]
+    except Exception as e:
+        # Left missing so filters on them match nothing, rather than reading again on every filter
+        print('Exposure metadata not read: '+str(e))
+        table.columns.update({f: np.full(len(table), np.nan) for f in table.lazy})
+        table.lazy = []
+
 def detectorSelect(event):
     detector=combo.get()
     entryMicX.delete(0,tk.END)
@@ -324,8 +678,90 @@ def detectorSelect(event):
         entryMicY.insert(0, "")
 
 def RBGAImage(path):
+    if snapshot is not None and snapshot.isfile(path):
+        return Image.open(snapshot.open(path, 'rb')).convert("RGBA")
     return Image.open(path).convert("RGBA")
 
+def openFile(path):
+    #Analysis file, from the snapshot when browsing one
+    return snapshot.open(path) if snapshot is not None else open(path)
+
+def isFile(path):
+    return (snapshot or os.path).isfile(path)
+
+def micImage(imgpath):
+    #EPU jpg of the micrograph, or the processed MRC from the star file if ticked
+    if mrc_state.get() == 1:
+        mrcpath = micMrc(os.path.splitext(os.path.basename(imgpath))[0])
+        if mrcpath:
+            from epuanalysis import mrc
+            try:
+                return Image.fromarray(mrc.display(mrcpath)).convert("RGBA")
+            except (IOError, OSError, ValueError) as e:
+                print(mrcpath+' could not be read, showing the EPU jpg: '+str(e))
+                return RBGAImage(imgpath)
+        print('No MRC found for '+imgpath+', showing the EPU jpg')
+    return RBGAImage(imgpath)
+
+def specImage(imgpath):
+    #Power spectrum thumbnail of a micrograph, None if not computed
+    from epuanalysis import spectra
+    specpath = spectra.thumbnail_path(imgpath)
+    if not isFile(specpath):
+        print('No power spectrum for '+imgpath+', run epu.power_spectra.py')
+        return None
+    return RBGAImage(specpath)
+
+def micMrc(name):
+    #MRC path of an exposure from the selected particle layer's star file
+    #The star file is read for micrograph paths by loadMrcPaths, the jpg is shown until it is done
+    global mrcPaths
+    from epuanalysis import mrc
+    layer = particleLayers.get(comboLayer.get())
+    if layer is not None:
+        key = (layer.star, layer.entry['column'], layer.entry['suffix'])
+    elif star:
+        key = (star[1], '_rlnMicrographName', suffix[1] if suffix and suffix[1] != 'None' else None)
+    else:
+        return None
+    if mrcPaths is None or mrcPaths[0] != key:
+        if mrcLoading is None or not mrcLoading.is_alive():
+            mrcPaths = None
+            startMrcPaths(key)
+        print('Reading micrograph paths from '+key[0]+', showing the EPU jpg')
+        return None
+    if mrcPaths[1] is None:
+        return None
+    return mrc.find(name, *key, paths=mrcPaths[1])
+
+def startMrcPaths(key):
+    global mrcLoading
+    mrcLoading = threading.Thread(target=loadMrcPaths, args=(key,), daemon=True)
+    mrcLoading.start()
+    main_frame.after(200, waitMrcPaths)
+
+def loadMrcPaths(key):
+    #Background thread, micrograph name -> path of a star file, nothing here may touch tkinter
+    global mrcPaths
+    from epuanalysis import mrc
+    try:
+        mrcPaths = (key, mrc.micrograph_paths(*key))
+    except (IOError, ValueError) as e:
+        print('MRC not read: '+str(e))
+        mrcPaths = (key, None)
+
+def waitMrcPaths():
+    #Redraw the micrograph from its MRC once the star file has been read
+    if mrcLoading.is_alive():
+        main_frame.after(200, waitMrcPaths)
+    elif mrc_state.get() == 1:
+        mrcClick()
+
+def mrcClick():
+    #Redraw current micrograph from the MRC, the jpg or as a power spectrum
+    if miclist.curselection():
+        MicSelect(None)
+
 def plotPicks():
     mic = entryMic.get()
     mic = os.path.splitext(mic)[0]
@@ -334,17 +770,19 @@ def plotPicks():
     print(mic)
     #subprocess.call('epu.plot_coords.sh '+str(star[1])+' '+str(mic)+' '+str(entryMicX.get())+' '+str(entryMicY.get())+' '+str(entryPartD.get())+' y', shell=True)
     #os.rename('particles.png', './EPU_analysis/particles.png')
-    subprocess.call('epu.plot_coords_v2.sh -i '+str(star[1])+' -m '+str(mic)+' -x '+str(entryMicX.get())+' -y '+str(entryMicY.get())+' -d '+str(entryPartD.get())+' -s y -f y -o EPU_analysis/star/', shell=True)
+    #Plot from the selected particle layer's star file
+    starin = particleLayers[comboLayer.get()].star if comboLayer.get() in particleLayers else star[1]
+    subprocess.call('epu.plot_coords_v2.sh -i '+str(starin)+' -m '+str(mic)+' -x '+str(entryMicX.get())+' -y '+str(entryMicY.get())+' -d '+str(entryPartD.get())+' -s y -f y -o EPU_analysis/star/', shell=True)
     #Call  global variable from def FoilHole
     global micpath
     print(micpath)
     imgpath = micpath
     ##Load Micrograph image
-    micLoad = RBGAImage(imgpath)
-    micLoad = micLoad.resize((400,400), Image.ANTIALIAS)
+    micLoad = micImage(imgpath)
+    micLoad = micLoad.resize((400,400), Image.LANCZOS)
     ## Particle pick overlay
     parLoad = RBGAImage("./EPU_analysis/star/particles.png")
-    parLoad = parLoad.resize((400,400), Image.ANTIALIAS)
+    parLoad = parLoad.resize((400,400), Image.LANCZOS)
     micLoad.paste(parLoad, (0, 0), parLoad)
     parRender = ImageTk.PhotoImage(micLoad)
     imgMic = Label(main_frame, image=parRender)
@@ -371,7 +809,7 @@ def clearMicSel():
 
 def openSettings():
     try:
-        f = open('EPU_analysis/settings.dat')
+        f = openFile('EPU_analysis/settings.dat')
         print('Populating fields with previous paths')
         for line in f:
          if "Star" in line:
@@ -388,6 +826,94 @@ def openSettings():
     except IOError:
         print('Previous analysis not found')
 
+def loadStores():
+    # Background thread started once the window is up, nothing here may touch tkinter
+    # Heavy imports, settings, square list, image statistics, particle counts and square metadata
+    global Image, ImageTk, imgstats, partCounts, squareList, placeholders, sessionIndex, squareIndex, particleLayers, snapshot, qualityStore, attrStore, storesError, filterTable, np
+    from PIL import Image, ImageTk
+    import numpy as np
+    from epuanalysis import analysis, attributes, images, index, layers, metadata, quality
+    ## Snapshot from epu.analysis_snapshot.py given on the command line, browsed in place of EPU_analysis
+    if snapshotPath:
+        from epuanalysis.snapshot import Snapshot
+        snapshot = Snapshot(snapshotPath)
+        print('Browsing '+snapshotPath+', written '+snapshot.manifest['created'])
+    openSettings()
+    try:
+        with openFile('./EPU_analysis/.squares_all.dat') as f:
+            squareList = f.readlines()
+    except IOError:
+        print('Previous analysis not found')
+    ## Placeholder images, decoded here and turned into PhotoImages in the main thread
+    try:
+        placeholders = {name: RBGAImage(str(exedir)+"/data/"+name).resize((400,400), Image.LANCZOS)
+                        for name in ['testSq.jpeg', 'testFoil.jpeg', 'testMic.jpeg', 'testPart.png']}
+    except IOError:
+        print('Placeholder images not found in '+str(exedir)+'/data')
+    imgstats = images.load_stats('EPU_analysis', snapshot)
+    ## EPU index and particle layers, the star file of the analysis is attached on first use
+    ## One bad file must not end the thread silently, the error is reported once the window fills
+    if squareList:
+        try:
+            sessionIndex = index.load(source=snapshot)
+            squareIndex = {os.path.normpath(sq): i for i, sq in enumerate(sessionIndex.squares)}
+            try:
+                if snapshot is None:
+                    layers.default_layer()
+            except (IOError, ValueError) as e:
+                print('Particle layer not loaded: '+str(e))
+            particleLayers = layers.load_all(source=snapshot)
+            qualityStore = quality.load_quality(sessionIndex, 'EPU_analysis', snapshot)
+            attrStore = attributes.load_attributes(sessionIndex, 'EPU_analysis', snapshot)
+            ## Filter expression columns, the xml metadata columns are read when a filter first uses them
+            if snapshot is None:
+                from epuanalysis import filters
+                filterTable = filters.Table(sessionIndex)
+        except Exception as e:
+            storesError = 'EPU index not loaded: '+str(e)
+            print(storesError)
+    # Warm the xml cache for the square metadata
+    if snapshot is None:
+        try:
+            metadata.read_many([analysis.square_xml(sq.strip()) for sq in squareList if os.path.isfile(analysis.square_xml(sq.strip()))])
+        except Exception as e:
+            storesError = 'Square metadata not read: '+str(e)
+            print(storesError)
+
+def checkStores():
+    # Poll the loading thread, then fill the GUI in the main thread
+    if stores.is_alive():
+        main_frame.after(50, checkStores)
+        return
+    loading.stop()
+    loading.grid_forget()
+    if storesError:
+        lblLoading.configure(text=storesError[:60])
+    else:
+        lblLoading.grid_forget()
+    popSquares(squareList)
+    ## Particle layers, the tracking run's star file first
+    names = sorted(particleLayers)
+    comboLayer['values'] = names
+    comboCompare['values'] = ['None']+names
+    comboCompare.current(0)
+    if names:
+        default = [n for n in names if particleLayers[n].star == os.path.abspath(star[1])] if star else []
+        comboLayer.current(names.index(default[0]) if default else 0)
+        layerSelect()
+    ## Placeholder images
+    if placeholders is None:
+        return
+    for name, lbl, x in [('testSq.jpeg', imgSq, 0), ('testFoil.jpeg', imgFoil, 432), ('testMic.jpeg', imgMic, 862)]:
+        load = placeholders[name]
+        if name == 'testMic.jpeg':
+            ## Particle pick overlay
+            load = load.copy()
+            load.paste(placeholders['testPart.png'], (0, 0), placeholders['testPart.png'])
+        render = ImageTk.PhotoImage(load)
+        lbl.configure(image=render)
+        lbl.image = render
+
 ###############################################################################
 
 ### Create GUI
@@ -397,17 +923,46 @@ main_frame.title("EPU analysis from Relion star file")
 main_frame.geometry('1420x820')
 
 ## Some defs that need to be run at GUI start
-openSettings()
 clearPickNo()
 
+## Analysis stores, filled by loadStores
+imgstats = None
+qualityStore = None
+attrStore = None
+partCounts = None
+sessionIndex = None
+squareIndex = {}
+particleLayers = {}
+layerJoins = {}
+layerYield = None
+usedHoles = None
+filterTable = None
+filterLoading = None
+filterSquares = None
+filterHoles = None
+filterNames = None
+squareSize = None
+squareHoles = None
+mrcPaths = None
+mrcLoading = None
+star = None
+suffix = None
+squareList = []
+placeholders = None
+storesError = None
+
 ## Variables
 radioSq = StringVar()
 radioFoil = StringVar()
 foilfilt = 'foilAll'
+xmlpanel = None
+snapshot = None
 
 # This scripts location
 exe = sys.argv[0]
 exedir = os.path.dirname(sys.argv[0])
+# Optional snapshot to browse, epu.star_to_epu_browser_inspect.py session.zip
+snapshotPath = sys.argv[1] if len(sys.argv) > 1 else None
 
 ## GUI layout
 row = 0
@@ -435,12 +990,73 @@ row += 1
 lbl = Label(main_frame, text='                                           ')
 lbl.grid(sticky="w",column=4, row=row)
 
+# Filter expression over the exposures, applied with Return or the Filter button
+entryFilter = tk.Entry(main_frame, width=45, state='normal')
+entryFilter.grid(column=2, row=row, sticky=W)
+entryFilter.bind('<Return>', applyFilter)
+btnFilter = tk.Button(main_frame, text='Filter', command=applyFilter)
+btnFilter.grid(sticky="w", column=4, row=row)
+lblFilter = Label(main_frame, text='No filter', anchor=W, justify=LEFT)
+lblFilter.grid(sticky="e", column=4, row=row)
+
+# Particle heatmap on square image
+heat_state = IntVar()
+heat_state.set(0) #set check state
+check2 = Checkbutton(main_frame,text='Particle heatmap', var=heat_state, command=heatClick).grid(sticky="w", column=2, row=13)
+
+# Particle layers, see epu.particle_layers.py
+lbl = Label(main_frame, text='Particle layer / compare:', anchor=W, justify=LEFT)
+lbl.grid(sticky="w",column=8, row=10)
+comboLayer = ttk.Combobox(main_frame, values=[], width=20, state='readonly')
+comboLayer.grid(column=8, row=11)
+comboLayer.bind("<<ComboboxSelected>>", layerSelect)
+comboCompare = ttk.Combobox(main_frame, values=['None'], width=20, state='readonly')
+comboCompare.grid(column=8, row=12)
+comboCompare.bind("<<ComboboxSelected>>", lambda event: yieldLabel())
+
+# Sort FoilHoles by greyscale
+sort_state = IntVar()
+sort_state.set(0) #set check state
+check3 = Checkbutton(main_frame,text='Sort by greyscale', var=sort_state).grid(sticky="w", column=4, row=13)
+
+# Sort squares by CTF and motion quality from epu.micrograph_quality.py
+qualitySort = {'CTF resolution': 'ctf_resolution', 'Astigmatism': 'astigmatism', 'Total motion': 'motion_total'}
+comboSort = ttk.Combobox(main_frame, values=['List order']+list(qualitySort), width=20, state='readonly')
+comboSort.current(0)
+comboSort.grid(sticky="w", column=2, row=16)
+comboSort.bind("<<ComboboxSelected>>", sortSquares)
+
+# Colour FoilHoles on the square by a particle attribute from epu.particle_attributes.py
+holeAttributes = {'Particles': 'particles', 'Pick FOM': 'fom', 'MaxProb': 'maxprob', 'LogLikeli': 'loglike', 'Class': 'class'}
+comboHoles = ttk.Combobox(main_frame, values=['No hole colours']+list(holeAttributes), width=20, state='readonly')
+comboHoles.current(0)
+comboHoles.grid(sticky="w", column=4, row=16)
+comboHoles.bind("<<ComboboxSelected>>", lambda event: heatClick())
+
+# Exclude the current square or FoilHole from star files written by epu.star_subset.py -x
+exsq_state = IntVar()
+exsq_state.set(0) #set check state
+check4 = Checkbutton(main_frame,text='Exclude square', var=exsq_state, command=lambda: excludeClick('square')).grid(sticky="w", column=2, row=14)
+exfoil_state = IntVar()
+exfoil_state.set(0) #set check state
+check5 = Checkbutton(main_frame,text='Exclude FoilHole', var=exfoil_state, command=lambda: excludeClick('foilhole')).grid(sticky="w", column=4, row=14)
+
 # Plot picks
 #btn = tk.Button(main_frame,text='Clear picks', command = MicSelect).grid(sticky="e", column=8, row=15)
 pick_state = IntVar()
 pick_state.set(0) #set check state
 check1 = Checkbutton(main_frame,text='Particles', var=pick_state).grid(sticky="e", column=8, row=18)
 
+# Power spectrum in place of the micrograph
+spec_state = IntVar()
+spec_state.set(0) #set check state
+check5 = Checkbutton(main_frame,text='Spectrum', var=spec_state, command=mrcClick).grid(sticky="w", column=8, row=16)
+
+# Processed MRC in place of the EPU jpg
+mrc_state = IntVar()
+mrc_state.set(0) #set check state
+check4 = Checkbutton(main_frame,text='MRC', var=mrc_state, command=mrcClick).grid(sticky="e", column=8, row=16)
+
 lbl = Label(main_frame, text='x (px):', anchor=W, justify=LEFT)
 lbl.grid(sticky="w",column=8, row=19)
 entryMicX = tk.StringVar()
@@ -508,16 +1124,14 @@ miclist.bind('<<ListboxSelect>>',MicSelect)
 scrollbar.config(command=miclist.yview)
 column += 2
 
-# Populate lists
-popSquares()
-
-## Square image
-sqLoad = Image.open(str(exedir)+"/data/testSq.jpeg")
-sqLoad = sqLoad.resize((400,400), Image.ANTIALIAS)
-sqRender = ImageTk.PhotoImage(sqLoad)
-imgSq = Label(main_frame, image=sqRender)
-imgSq.image = sqRender
+## Square image, placeholder shown once loaded
+## Click a FoilHole on the square to select it, hover to name it
+imgSq = Label(main_frame)
 imgSq.place(x=0, y=395)
+imgSq.bind('<Button-1>', squareClick)
+imgSq.bind('<Motion>', squareHover)
+imgSq.bind('<Leave>', lambda event: holeTip.place_forget())
+holeTip = Label(main_frame, bg='lightyellow', relief=SOLID, borderwidth=1)
 
 lbl = Label(main_frame, text='Current square selection:', anchor=W, justify=LEFT)
 lbl.grid(sticky="w",column=2, row=10)
@@ -526,11 +1140,7 @@ entrySq = tk.Entry(main_frame,width=45, state='normal')
 entrySq.grid(column=2, row=11, sticky=W)
 
 ## FoilHole image
-fhLoad = RBGAImage(str(exedir)+"/data/testFoil.jpeg")
-fhLoad = fhLoad.resize((400,400), Image.ANTIALIAS)
-fhRender = ImageTk.PhotoImage(fhLoad)
-imgFoil = Label(main_frame, image=fhRender)
-imgFoil.image = fhRender
+imgFoil = Label(main_frame)
 imgFoil.place(x=432, y=395)
 
 lbl = Label(main_frame, text='Current foil selection:', anchor=W, justify=LEFT)
@@ -539,12 +1149,8 @@ entryFoil = tk.StringVar()
 entryFoil = tk.Entry(main_frame,width=45, state='normal')
 entryFoil.grid(column=4, row=11, sticky=W)
 
-## Micrograph image
-micLoad = RBGAImage(str(exedir)+"/data/testMic.jpeg")
-micLoad = micLoad.resize((400,400), Image.ANTIALIAS)
-micRender = ImageTk.PhotoImage(micLoad)
-imgMic = Label(main_frame, image=micRender)
-imgMic.image = micRender
+## Micrograph image, with particle pick overlay placeholder
+imgMic = Label(main_frame)
 imgMic.place(x=862, y=395)
 
 lbl = Label(main_frame, text='Current micrograph selection:', anchor=W, justify=LEFT)
@@ -553,13 +1159,15 @@ entryMic = tk.StringVar()
 entryMic = tk.Entry(main_frame,width=45, state='normal')
 entryMic.grid(column=6, row=11, sticky=W)
 
-## Particle pick overlay
-parLoad = RBGAImage(str(exedir)+"/data/testPart.png")
-parLoad = parLoad.resize((400,400), Image.ANTIALIAS)
-micLoad.paste(parLoad, (0, 0), parLoad)
-parRender = ImageTk.PhotoImage(micLoad)
-imgMic = Label(main_frame, image=parRender)
-imgMic.image = parRender
-imgMic.place(x=862, y=395)
+## Loading indicator while loadStores runs
+lblLoading = Label(main_frame, text='Loading analysis...')
+lblLoading.grid(sticky="w", column=6, row=1)
+loading = ttk.Progressbar(main_frame, mode='indeterminate', length=200)
+loading.grid(column=6, row=2)
+loading.start(10)
+
+stores = threading.Thread(target=loadStores, daemon=True)
+stores.start()
+main_frame.after(50, checkStores)
 
 main_frame.mainloop()
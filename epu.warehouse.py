@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Cross session warehouse of square, FoilHole and exposure aggregates
+# publish is run from the directory containing EPU_analysis, and by epu.browser.py after the analysis
+# when EPU_WAREHOUSE is set. Queries read only the partitions and columns they need.
+#
+# epu.warehouse.py publish
+# epu.warehouse.py sessions
+# epu.warehouse.py query -t squares -c grey_mean particles_per_exposure -w 'instrument==TITAN52336320' -p
+# epu.warehouse.py query -t foilholes -c session square foilhole ctf_resolution -w 'ctf_resolution<3.5' -o best.csv
+
+import argparse
+import csv
+import time
+
+import numpy as np
+
+from epuanalysis import warehouse
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Publish to and query the cross session warehouse')
+parser.add_argument('-d', dest='root', default=None, help='warehouse directory (default EPU_WAREHOUSE or ~/epu_warehouse)')
+commands = parser.add_subparsers(dest='command', required=True)
+commands.add_parser('publish', help='add the tables of the analysis in the working directory')
+commands.add_parser('sessions', help='list the published sessions')
+query = commands.add_parser('query', help='rows of a table over all sessions')
+query.add_argument('-t', dest='table', default='squares', choices=warehouse.TABLES, help='table (default squares)')
+query.add_argument('-c', dest='columns', nargs='+', required=True, help='columns to return')
+query.add_argument('-w', dest='where', action='append', default=[], help="predicate, e.g. 'grey_mean>100', repeat to combine")
+query.add_argument('-o', dest='out', default=None, help='csv file of the rows (default print the first rows)')
+query.add_argument('-p', dest='plot', action='store_true', help='scatter plot of the first two columns to query.png')
+args = parser.parse_args()
+
+root = args.root or warehouse.warehouse_dir()
+start = time.time()
+
+if args.command == 'publish':
+    constants, written = warehouse.publish(root=root)
+    print('Published '+constants['session']+' of '+constants['date']+' to '+root+' in '+'%.1f' % (time.time()-start)+' s')
+
+elif args.command == 'sessions':
+    for s in warehouse.sessions(root):
+        print(s['date']+'  '+s['session']+'  '+str(s['constants'].get('instrument', ''))+'  '+
+              ', '.join(str(s.get(t, 0))+' '+t for t in warehouse.TABLES))
+
+else:
+    try:
+        predicates = [warehouse.parse_predicate(w) for w in args.where]
+    except ValueError as e:
+        parser.error(str(e))
+    rows, info = warehouse.query(args.table, args.columns, predicates, root)
+    n = len(rows[args.columns[0]])
+    print(str(n)+' rows from '+str(info['read'])+' of '+str(info['partitions'])+' partitions in '+'%.2f' % (time.time()-start)+' s')
+    if args.out:
+        with open(args.out, 'w', newline='') as f:
+            table = csv.writer(f)
+            table.writerow(args.columns)
+            table.writerows(zip(*[rows[c].tolist() for c in args.columns]))
+        print('Written '+args.out)
+    else:
+        print('  '.join(args.columns))
+        for row in zip(*[rows[c][:20].tolist() for c in args.columns]):
+            print('  '.join('%.4g' % v if isinstance(v, float) else str(v) for v in row))
+    if args.plot and len(args.columns) > 1:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        x, y = (rows[c].astype(float) for c in args.columns[:2])
+        ok = np.isfinite(x) & np.isfinite(y)
+        fig, ax = plt.subplots(figsize=(6, 5))
+        ax.scatter(x[ok], y[ok], s=4, alpha=0.5)
+        ax.set_xlabel(args.columns[0])
+        ax.set_ylabel(args.columns[1])
+        if ok.sum() > 2:
+            ax.set_title('r = %.2f over %d rows' % (np.corrcoef(x[ok], y[ok])[0, 1], ok.sum()))
+        fig.savefig('query.png', dpi=100)
+        print('Written query.png')
@@ -0,0 +1,102 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+# Readers for the EPU_analysis directory written by epu.star_to_epu_tracking_v2.sh
+#
+# EPU_analysis/settings.dat                       Star, EPU, Column, Suffix, Total, Used, Not
+# EPU_analysis/.squares_all.dat                   one square jpg per line (also _used, _not)
+# EPU_analysis/squares_all/<square>.jpg/.xml      links to the GridSquare image and metadata
+# EPU_analysis/squares_all/<square>_FoilHoles/    links to the FoilHole images and metadata
+# EPU_analysis/squares_all/<square>_Data/         links to the exposure images and metadata
+# EPU_analysis/star/.mainDataLines.dat            particle lines of the star file
+
+import os
+import glob
+
+from epuanalysis import storage
+
+ANALYSIS_DIR = 'EPU_analysis'
+
+# Square lists as written at the end of the tracking script
+SQUARE_LISTS = {'all': '.squares_all.dat',
+                'used': '.squares_used.dat',
+                'not': '.squares_not.dat'}
+
+def read_settings(analysis=ANALYSIS_DIR):
+    # Key: value pairs from settings.dat, 'None' entries are returned as None
+    settings = {}
+    try:
+        with open(os.path.join(analysis, 'settings.dat')) as f:
+            for line in f:
+                fields = line.strip().split()
+                if len(fields) == 2 and fields[0].endswith(':'):
+                    value = fields[1]
+                    settings[fields[0][:-1]] = None if value == 'None' else value
+    except IOError:
+        print('Previous analysis not found')
+    return settings
+
+def square_images(subset='all', analysis=ANALYSIS_DIR):
+    # Square jpg paths for All, Used or Not used squares
+    try:
+        with open(os.path.join(analysis, SQUARE_LISTS[subset])) as f:
+            return [line.strip() for line in f if line.strip()]
+    except IOError:
+        print('Previous analysis not found')
+        return []
+
+def square_name(squarepath):
+    # GridSquare image name without directory or extension
+    return os.path.splitext(os.path.basename(squarepath))[0]
+
+def square_xml(squarepath):
+    return os.path.splitext(squarepath)[0]+'.xml'
+
+def foilhole_images(squarepath):
+    return sorted(glob.glob(os.path.splitext(squarepath)[0]+'_FoilHoles/*.jpg'))
+
+def exposure_xmls(squarepath):
+    # Metadata for every exposure taken on a square
+    return sorted(glob.glob(os.path.splitext(squarepath)[0]+'_Data/*.xml'))
+
+def exposure_images(squarepath):
+    return sorted(glob.glob(os.path.splitext(squarepath)[0]+'_Data/*.jpg'))
+
+def listing(squares, pattern):
+    # Files matching pattern in every square's directories, listed concurrently
+    # e.g. listing(squares, '_FoilHoles/*.jpg') is foilhole_images for every square
+    return storage.storage().glob([os.path.splitext(sq)[0]+pattern for sq in squares])
+
+def exposures(squares):
+    # Exposure xml paths of all squares and the index of the square each came from
+    paths = []
+    index = []
+    for i, xmls in enumerate(listing(squares, '_Data/*.xml')):
+        paths += xmls
+        index += [i]*len(xmls)
+    return paths, index
+
+def exposure_name(path):
+    # FoilHole_5871221_Data_5860229_5860231_20210808_185028
+    return os.path.splitext(os.path.basename(path))[0]
+
+def foilhole_id(name):
+    # FoilHole reference, as used to search the star file
+    return int(name.split('_')[1])
@@ -0,0 +1,213 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Particle attributes of a star file aggregated per exposure, FoilHole and square
+# Chosen columns are read in chunks as arrays, particles are assigned to exposures once per run
+# of rows from the same micrograph, and counts, sums and class histograms are accumulated with
+# bincount. FoilHoles and squares are then sums over the exposure totals.
+#
+# EPU_analysis/particle_attributes.npz     per exposure of the index: particles, sum and sum of
+#                                          squares of every attribute, and a class histogram
+
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from epuanalysis import analysis, heatmap, star
+
+ATTRIBUTES_FILE = 'particle_attributes.npz'
+
+# Attribute: (star file column, label in the GUIs)
+ATTRIBUTES = {
+    'class': ('_rlnClassNumber', 'Class'),
+    'fom': ('_rlnAutopickFigureOfMerit', 'Pick FOM'),
+    'maxprob': ('_rlnMaxValueProbDistribution', 'MaxProb'),
+    'loglike': ('_rlnLogLikeliContribution', 'LogLikeli'),
+    'nsamples': ('_rlnNrOfSignificantSamples', 'Significant samples'),
+    'defocus': ('_rlnDefocusU', 'Defocus U'),
+}
+# Attributes that are categories, histogrammed rather than averaged
+CATEGORIES = ['class']
+LEVELS = ['exposure', 'foilhole', 'square']
+
+# Hole colour map dots, radius in square readout pixels
+DOT = 40
+
+def attributes_path(analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, ATTRIBUTES_FILE)
+
+def runs(values):
+    # Start of every run of equal values and the run each element belongs to
+    starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    return starts, np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(values)]))
+
+def accumulate(index, starfile, attributes, column='_rlnMicrographName', suffix=None):
+    # Per exposure totals of the attributes present in starfile, and the particles matching no exposure
+    n = len(index)
+    totals = {'particles': np.zeros(n)}
+    positions = {}
+    unmatched = 0
+    columns = [column]+[ATTRIBUTES[a][0] for a in attributes]
+    for chunk in star.iter_table(starfile, columns):
+        # Particles of a micrograph are written together, so look up one name per run
+        starts, run = runs(chunk[column])
+        heads = chunk[column][starts]
+        new = [h for h in set(heads.tolist()) if h not in positions]
+        if new:
+            found = index.find([star.micrograph_name(h.decode(), suffix) for h in new])
+            positions.update(zip(new, found.tolist()))
+        exposure = np.array([positions[h] for h in heads.tolist()], dtype=np.int64)[run]
+        hit = exposure >= 0
+        unmatched += int((~hit).sum())
+        exposure = exposure[hit]
+        totals['particles'] += np.bincount(exposure, minlength=n)
+        for a in attributes:
+            values = chunk.get(ATTRIBUTES[a][0])
+            if values is None or values.dtype.kind != 'f':
+                continue
+            values = values[hit]
+            if a in CATEGORIES:
+                category = np.maximum(values.astype(np.int64), 0)
+                width = max(int(category.max(initial=0))+1, totals.get(a+'_hist', np.zeros((n, 0))).shape[1])
+                hist = np.bincount(exposure*width+category, minlength=n*width).reshape(n, width)
+                old = totals.get(a+'_hist', np.zeros((n, width)))
+                totals[a+'_hist'] = np.pad(old, ((0, 0), (0, width-old.shape[1])))+hist
+            else:
+                ok = np.isfinite(values)
+                totals[a+'_sum'] = totals.get(a+'_sum', 0)+np.bincount(exposure[ok], weights=values[ok], minlength=n)
+                totals[a+'_sumsq'] = totals.get(a+'_sumsq', 0)+np.bincount(exposure[ok], weights=values[ok]**2, minlength=n)
+                totals[a+'_count'] = totals.get(a+'_count', 0)+np.bincount(exposure[ok], minlength=n)
+    return totals, unmatched
+
+def save_attributes(index, totals, starfile, analysis_dir=analysis.ANALYSIS_DIR):
+    np.savez(attributes_path(analysis_dir), names=index.names, star=os.path.abspath(starfile), **totals)
+    return attributes_path(analysis_dir)
+
+class Attributes:
+    # Means, spreads and class fractions of the attributes at each level
+    def __init__(self, index, saved):
+        self.index = index
+        self.star = str(saved['star'])
+        totals = {k: saved[k] for k in saved.files if k not in ('names', 'star')}
+        if len(saved['names']) != len(index) or (saved['names'] != index.names).any():
+            # Index rebuilt since, carry the totals over by name
+            at = index.find(saved['names'])
+            hit = at >= 0
+            for k, v in totals.items():
+                moved = np.zeros((len(index),)+v.shape[1:])
+                moved[at[hit]] = v[hit]
+                totals[k] = moved
+        self.exposure = totals
+        self.present = [a for a in ATTRIBUTES if a+'_sum' in totals or a+'_hist' in totals]
+        self.foilholes, hole = np.unique(index.foilhole, return_inverse=True)
+        self.groups = {'exposure': (None, len(index)), 'foilhole': (hole, len(self.foilholes)),
+                       'square': (index.square, len(index.squares))}
+        self._levels = {'exposure': totals}
+
+    def totals(self, level):
+        # Sums of the exposure totals over the FoilHoles or squares, in one sorted reduceat per array
+        if level not in self._levels:
+            group, ngroups = self.groups[level]
+            order = np.argsort(group, kind='stable')
+            bounds = np.searchsorted(group[order], np.arange(ngroups))
+            filled = np.r_[bounds[1:], len(group)] > bounds
+            summed = {}
+            for k, v in self.exposure.items():
+                out = np.zeros((ngroups,)+v.shape[1:])
+                if len(order):
+                    out[filled] = np.add.reduceat(v[order], bounds[filled], axis=0)
+                summed[k] = out
+            self._levels[level] = summed
+        return self._levels[level]
+
+    def particles(self, level):
+        return self.totals(level)['particles']
+
+    def mean(self, level, attribute):
+        # Mean of an attribute, or the most common category, nan where there are no particles
+        totals = self.totals(level)
+        if attribute in CATEGORIES:
+            hist = totals[attribute+'_hist']
+            return np.where(hist.sum(axis=1) > 0, hist.argmax(axis=1), np.nan) if hist.shape[1] else np.full(len(hist), np.nan)
+        count = totals[attribute+'_count']
+        return np.divide(totals[attribute+'_sum'], count, out=np.full(len(count), np.nan), where=count > 0)
+
+    def std(self, level, attribute):
+        totals = self.totals(level)
+        count = totals[attribute+'_count']
+        mean = self.mean(level, attribute)
+        var = np.divide(totals[attribute+'_sumsq'], count, out=np.full(len(count), np.nan), where=count > 0)-mean**2
+        return np.sqrt(np.maximum(var, 0))
+
+    def fractions(self, level, attribute='class'):
+        # Fraction of the particles in each category, rows of groups
+        hist = self.totals(level)[attribute+'_hist']
+        total = hist.sum(axis=1, keepdims=True)
+        return np.divide(hist, total, out=np.zeros(hist.shape), where=total > 0)
+
+    def foilhole_at(self, ref):
+        # Position of a FoilHole id in the FoilHole level, None if it has no exposures
+        at = np.searchsorted(self.foilholes, ref)
+        return int(at) if at < len(self.foilholes) and self.foilholes[at] == ref else None
+
+    def of_foilhole(self, values, ids):
+        # Values of the FoilHole level for FoilHole ids, nan for ids without exposures
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.foilholes):
+            return np.full(len(ids), np.nan)
+        at = np.minimum(np.searchsorted(self.foilholes, ids), len(self.foilholes)-1)
+        return np.where(self.foilholes[at] == ids, values[at], np.nan)
+
+def load_attributes(index, analysis_dir=analysis.ANALYSIS_DIR, source=None):
+    # Attributes for an analysis, None if epu.particle_attributes.py has not been run
+    try:
+        with (source or np).load(attributes_path(analysis_dir)) as saved:
+            return Attributes(index, saved)
+    except IOError:
+        return None
+
+def value_range(values):
+    # Colour scale limits from the 2nd to 98th percentile of the finite values
+    finite = values[np.isfinite(values)]
+    if not len(finite):
+        return 0, 1
+    lo, hi = np.percentile(finite, [2, 98])
+    return lo, hi if hi > lo else lo+1
+
+def hole_overlay(holes, values, size, limits, cmap='viridis', frame=None, dot=DOT):
+    # RGBA layer the size of the square image with a dot on every hole coloured by its value
+    # holes is a holemap.HoleMap, values are per hole, limits from value_range over the session
+    # frame is the square readout size or (width, height), that of the HoleMap unless given
+    width, height = (holes.frame, holes.height) if frame is None else heatmap.readout(frame)
+    import matplotlib
+    lo, hi = limits
+    colours = matplotlib.colormaps[cmap](np.clip((values-lo)/(hi-lo), 0, 1))
+    layer = Image.new('RGBA', size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+    sx, sy = size[0]/width, size[1]/height
+    r = max(2, dot*sx)
+    for col, row, value, colour in zip(holes.col, holes.row, values, colours):
+        if not np.isfinite(value):
+            continue
+        x, y = col*sx, row*sy
+        draw.ellipse([x-r, y-r, x+r, y+r], fill=tuple(int(c*255) for c in colour[:3])+(170,))
+    return layer
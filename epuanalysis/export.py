@@ -0,0 +1,233 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Bulk export of the raw files of selected exposures, for collaborators or fast scratch storage
+# The EPU_analysis links are resolved to the EPU directory, and every file of an exposure, its jpg,
+# xml and movie with the movie's own metadata, is copied keeping the EPU directory layout.
+# Files are reflinked where the filesystem can share extents, copied in the kernel with
+# copy_file_range otherwise, and skipped when the copy already has the same size and mtime.
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from epuanalysis import analysis, session, storage
+
+MODES = ['auto', 'copy', 'reflink', 'hardlink']
+WORKERS = 8
+
+# Linux FICLONE ioctl, shares the extents of a file on btrfs, xfs and similar
+FICLONE = 0x40049409
+
+# Errors meaning a fast path is not available between two filesystems, fall back to copying
+UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EPERM}
+
+def exposure_files(index, mask, epu_dir, movie_dir=None):
+    # (source, path relative to the export) of the session, square, FoilHole and exposure files of
+    # the selection. An exposure owns every file in its Data directory named after it, its movie included
+    epu_dir = os.path.realpath(epu_dir)
+    selected = np.flatnonzero(mask)
+    squares = np.unique(index.square[selected])
+    files = {}
+
+    def add(path, root=epu_dir, listed=False):
+        # Links of the analysis are resolved, paths from listing the EPU directory are already real
+        real = path if listed else os.path.realpath(path)
+        rel = os.path.relpath(real, root)
+        if not rel.startswith(os.pardir) and (listed or os.path.isfile(real)):
+            files[real] = rel
+
+    add(os.path.join(epu_dir, session.SESSION_FILE))
+    for s in squares:
+        sq = index.squares[s]
+        add(sq)
+        add(analysis.square_xml(sq))
+        add(session.square_dm(sq, epu_dir))
+    # The Data and FoilHoles directories in the EPU directory, found from one exposure of each square
+    # and listed once each
+    _, first = np.unique(index.square[selected], return_index=True)
+    data = {index.square[i]: os.path.dirname(os.path.realpath(
+            os.path.splitext(index.squares[index.square[i]])[0]+'_Data/'+index.names[i]+'.jpg')) for i in selected[first]}
+    holes = {s: os.path.join(os.path.dirname(d), 'FoilHoles') for s, d in data.items()}
+    roots = [(epu_dir, data)]
+    if movie_dir:
+        # Movies written to a separate tree with the same layout as the EPU directory
+        moved = {s: os.path.join(os.path.realpath(movie_dir), os.path.relpath(d, epu_dir)) for s, d in data.items()}
+        roots.append((os.path.realpath(movie_dir), moved))
+    names = {}
+    for i in selected:
+        names.setdefault(index.square[i], set()).add(str(index.names[i]))
+    for root, dirs in roots:
+        listed = storage.storage().listdir(list(dirs.values()))
+        for (s, d), entries in zip(dirs.items(), listed):
+            wanted = names[s]
+            for entry in entries:
+                if owner(entry, wanted):
+                    add(os.path.join(d, entry), root, True)
+    # FoilHole images of the selected exposures
+    refs = {s: {str(r) for r in index.foilhole[selected][index.square[selected] == s]} for s in squares}
+    for (s, d), entries in zip(holes.items(), storage.storage().listdir(list(holes.values()))):
+        for entry in entries:
+            parts = entry.split('_')
+            if len(parts) > 1 and parts[1] in refs[s]:
+                add(os.path.join(d, entry), listed=True)
+    return sorted(files.items(), key=lambda f: f[1])
+
+def owner(entry, names):
+    # Whether a file is named after one of the exposure names, as name.jpg or name_Fractions.tiff
+    stem = entry.split('.')[0]
+    if stem in names:
+        return True
+    cut = stem.rfind('_')
+    while cut > 0:
+        if stem[:cut] in names:
+            return True
+        cut = stem.rfind('_', 0, cut)
+    return False
+
+def unchanged(source, target, st, checksum=False):
+    # Whether target already holds source, by size and mtime or by content
+    try:
+        tt = os.stat(target)
+    except OSError:
+        return False
+    if tt.st_size != st.st_size:
+        return False
+    if tt.st_mtime_ns == st.st_mtime_ns:
+        return True
+    if checksum and file_digest(source) == file_digest(target):
+        # Same contents, take the source mtime so the next export needs no checksum
+        os.utime(target, ns=(tt.st_atime_ns, st.st_mtime_ns))
+        return True
+    return False
+
+def file_digest(path, chunk=1 << 22):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class Copier:
+    # Copies files by the fastest method each pair of filesystems allows, remembering what failed
+
+    def __init__(self, mode='auto', checksum=False):
+        self.mode = mode
+        self.checksum = checksum
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.totals = {'copied': 0, 'reflinked': 0, 'linked': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+
+    def count(self, kind, size=0):
+        with self.lock:
+            self.totals[kind] += 1
+            self.totals['bytes'] += size
+
+    def usable(self, method, devices):
+        return (method, devices) not in self.failed
+
+    def unusable(self, method, devices):
+        with self.lock:
+            self.failed.add((method, devices))
+
+    def copy(self, source, target):
+        try:
+            st = os.stat(source)
+            if unchanged(source, target, st, self.checksum):
+                self.count('skipped')
+                return
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            devices = (st.st_dev, os.stat(os.path.dirname(target)).st_dev)
+            if self.mode == 'hardlink' and devices[0] == devices[1]:
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.link(source, target)
+                self.count('linked', st.st_size)
+                return
+            # Written aside and moved into place, so an interrupted export never looks complete
+            part = target+'.part'
+            kind = self.write(source, part, st.st_size, devices)
+            os.utime(part, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(part, target)
+            self.count(kind, st.st_size)
+        except OSError as e:
+            print(source+' could not be exported: '+str(e))
+            self.count('failed')
+
+    def write(self, source, target, size, devices):
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            if self.mode in ('auto', 'reflink') and self.usable('reflink', devices):
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    return 'reflinked'
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED:
+                        raise
+                    self.unusable('reflink', devices)
+            if self.usable('copy_file_range', devices) and hasattr(os, 'copy_file_range'):
+                try:
+                    done = 0
+                    while done < size:
+                        n = os.copy_file_range(src.fileno(), dst.fileno(), size-done)
+                        if n == 0:
+                            break
+                        done += n
+                    return 'copied'
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED:
+                        raise
+                    self.unusable('copy_file_range', devices)
+                    src.seek(0)
+                    dst.seek(0)
+                    dst.truncate()
+            shutil.copyfileobj(src, dst, 1 << 22)
+            return 'copied'
+
+def export(files, outdir, mode='auto', checksum=False, workers=WORKERS, report=10):
+    # Copy (source, relative path) pairs under outdir on a thread pool, reporting progress every
+    # report seconds. Returns the Copier totals and the elapsed seconds
+    copier = Copier(mode, checksum)
+    limiter = storage.storage()
+    start = time.time()
+    last = [start]
+
+    def one(job):
+        source, rel = job
+        limiter.call(copier.copy, source, os.path.join(outdir, rel))
+        now = time.time()
+        if now-last[0] > report:
+            last[0] = now
+            progress(copier.totals, now-start, len(files))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(one, files))
+    return copier.totals, time.time()-start
+
+def progress(totals, seconds, total):
+    done = sum(totals[k] for k in ('copied', 'reflinked', 'linked', 'skipped', 'failed'))
+    print('%d of %d files, %.1f GB, %.0f MB/s' % (done, total, totals['bytes']/1e9, totals['bytes']/1e6/max(seconds, 1e-6)))
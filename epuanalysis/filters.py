@@ -0,0 +1,272 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Filter expressions over the exposures of an analysis, compiled once into numpy masks
+#
+#   particles > 50 and defocus < -2.0 and square_grey_mean between 80 and 120
+#   (ctf_resolution < 4 or foilhole_particles > 100) and not square == GridSquare_20210806_120003
+#
+# Comparisons are < <= > >= == !=, 'between a and b' and 'in (a, b)', joined by and, or, not and
+# brackets. Every column has a value per exposure: the exposure's own particles, quality, particle
+# attributes, greyscale and xml metadata, and square_<column> and foilhole_<column> for the tables
+# of its square and FoilHole. Exposures missing a value never match a comparison on it.
+# Timestamps are compared with quoted dates and times, time > '2021-08-08 18:50'.
+#
+# EPU_analysis/exposure_metadata.npz    numeric xml fields of every exposure, read on first use
+
+import os
+import re
+
+import numpy as np
+
+from epuanalysis import analysis, attributes, images, metadata, selection, warehouse
+
+METADATA_FILE = 'exposure_metadata.npz'
+
+TOKEN = re.compile(r'\s*(?:(<=|>=|==|!=|<|>|\(|\)|,)|(-?\d+\.?\d*(?:[eE][-+]?\d+)?|-?\.\d+)|'
+                   r'\'([^\']*)\'|"([^"]*)"|([\w.-]+))')
+KEYWORDS = {'and', 'or', 'not', 'between', 'in'}
+
+def metadata_path(analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, METADATA_FILE)
+
+def metadata_fields():
+    return [f for f, (_, scale) in metadata.FIELDS.items() if scale is not None]
+
+def load_metadata(index, analysis_dir=analysis.ANALYSIS_DIR):
+    # Numeric xml fields per exposure, read from every exposure xml once and kept until the index changes
+    try:
+        with np.load(metadata_path(analysis_dir)) as saved:
+            if len(saved['names']) == len(index) and (saved['names'] == index.names).all():
+                return {f: saved[f] for f in metadata_fields() if f in saved.files}
+    except (IOError, KeyError):
+        pass
+    fields = metadata_fields()
+    values = metadata.read_many(selection.exposure_xmls(index), fields)
+    columns = {f: np.array([np.nan if v[f] is None else v[f] for v in values], dtype=float) for f in fields}
+    np.savez(metadata_path(analysis_dir), names=index.names, **columns)
+    return columns
+
+class Table:
+    # Columns of an analysis per exposure, each built on first use
+
+    def __init__(self, index, analysis_dir=analysis.ANALYSIS_DIR):
+        self.index = index
+        self.analysis_dir = analysis_dir
+        tables = warehouse.session_tables(index, analysis_dir)
+        self.columns = dict(tables['exposures'])
+        stats = images.load_stats(analysis_dir)
+        if stats is not None:
+            jpgs = [os.path.splitext(x)[0]+'.jpg' for x in selection.exposure_xmls(index)]
+            self.columns['grey_mean'] = stats.lookup(jpgs, 'mean')
+            self.columns['grey_std'] = stats.lookup(jpgs, 'std')
+        attrs = attributes.load_attributes(index, analysis_dir)
+        if attrs is not None:
+            for a in attrs.present:
+                self.columns[a] = attrs.mean('exposure', a)
+        # Square and FoilHole tables are spread over their exposures
+        _, hole = np.unique(index.foilhole, return_inverse=True)
+        for level, table, at in [('square', tables['squares'], index.square), ('foilhole', tables['foilholes'], hole)]:
+            for c, values in table.items():
+                if c not in ('square', 'foilhole'):
+                    self.columns[level+'_'+c] = np.asarray(values)[at] if len(at) else np.zeros(0)
+        self.lazy = [f for f in metadata_fields() if f not in self.columns]
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        return sorted(list(self.columns)+self.lazy)
+
+    def __contains__(self, name):
+        return name in self.columns or name in self.lazy
+
+    def __getitem__(self, name):
+        if name not in self.columns and name in self.lazy:
+            self.columns.update(load_metadata(self.index, self.analysis_dir))
+            self.lazy = []
+        return self.columns[name]
+
+    def kind(self, name):
+        # 'text' for name columns, 'time' for timestamps, 'number' otherwise, without building lazy columns
+        if name in self.lazy:
+            return 'number'
+        dtype = self.columns[name].dtype.kind
+        return 'text' if dtype in 'UOS' else 'time' if dtype == 'M' else 'number'
+
+def tokenize(text):
+    tokens = []
+    at = 0
+    text = text.rstrip()
+    while at < len(text):
+        match = TOKEN.match(text, at)
+        if not match or match.end() == at:
+            raise ValueError('Cannot read the filter from '+text[at:].strip())
+        symbol, number, single, double, word = match.groups()
+        if symbol:
+            tokens.append(('symbol', symbol))
+        elif number is not None:
+            tokens.append(('number', float(number)))
+        elif single is not None or double is not None:
+            tokens.append(('text', single if single is not None else double))
+        elif word.lower() in KEYWORDS:
+            tokens.append(('keyword', word.lower()))
+        else:
+            tokens.append(('word', word))
+        at = match.end()
+    return tokens
+
+class Filter:
+    # A filter expression compiled against the column names and kinds of a Table, raising
+    # ValueError naming what could not be read. mask(table) is the exposures meeting it
+
+    def __init__(self, text, table):
+        self.text = text
+        self.fields = set()
+        self.used = []
+        self.tokens = tokenize(text)
+        self.at = 0
+        self.table = table
+        if not self.tokens:
+            raise ValueError('Empty filter')
+        self.evaluate = self.expression()
+        if self.at < len(self.tokens):
+            raise ValueError('Unexpected '+str(self.tokens[self.at][1])+' in the filter')
+        del self.tokens, self.table, self.used
+
+    def mask(self, table):
+        with np.errstate(invalid='ignore'):
+            return np.asarray(self.evaluate(table), dtype=bool)
+
+    def peek(self, kind=None, value=None):
+        if self.at >= len(self.tokens):
+            return False
+        k, v = self.tokens[self.at]
+        return (kind is None or k == kind) and (value is None or v == value)
+
+    def take(self, kind=None, value=None, expected=''):
+        if not self.peek(kind, value):
+            found = str(self.tokens[self.at][1]) if self.at < len(self.tokens) else 'the end'
+            raise ValueError('Expected '+(expected or str(value))+' but found '+found+' in the filter')
+        self.at += 1
+        return self.tokens[self.at-1][1]
+
+    def expression(self):
+        terms = [self.term()]
+        while self.peek('keyword', 'or'):
+            self.take()
+            terms.append(self.term())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda t: np.logical_or.reduce([f(t) for f in terms])
+
+    def term(self):
+        factors = [self.factor()]
+        while self.peek('keyword', 'and'):
+            self.take()
+            factors.append(self.factor())
+        if len(factors) == 1:
+            return factors[0]
+        return lambda t: np.logical_and.reduce([f(t) for f in factors])
+
+    def factor(self):
+        if self.peek('keyword', 'not'):
+            self.take()
+            start = len(self.used)
+            inner = self.factor()
+            # Exposures missing a value of the negated comparisons still do not match
+            fields = sorted(set(self.used[start:]))
+            return lambda t: ~inner(t) & np.logical_and.reduce([present(t[f]) for f in fields]+[np.ones(len(t), bool)])
+        if self.peek('symbol', '('):
+            self.take()
+            inner = self.expression()
+            self.take('symbol', ')')
+            return inner
+        return self.comparison()
+
+    def value(self, kind):
+        # A number for number columns, a quoted date and time for timestamps, a word or quoted text for name columns
+        if kind == 'number':
+            return self.take('number', expected='a number')
+        if kind == 'time':
+            text = self.take('text', expected='a quoted date and time, as \'2021-08-08 18:50\'')
+            try:
+                return np.datetime64(text.strip().replace(' ', 'T'))
+            except ValueError:
+                raise ValueError('Cannot read '+text+' as a date and time, as \'2021-08-08 18:50\'')
+        if self.peek('number'):
+            number = self.take()
+            return str(int(number)) if number == int(number) else str(number)
+        if self.peek('text'):
+            return self.take()
+        return self.take('word', expected='a name')
+
+    def comparison(self):
+        field = self.take('word', expected='a column name')
+        if field not in self.table:
+            raise ValueError('Unknown column '+field+', one of '+', '.join(self.table.names()))
+        self.fields.add(field)
+        self.used.append(field)
+        kind = self.table.kind(field)
+        if self.peek('keyword', 'between'):
+            self.take()
+            low = self.value(kind)
+            self.take('keyword', 'and')
+            high = self.value(kind)
+            return lambda t: (t[field] >= low) & (t[field] <= high)
+        if self.peek('keyword', 'in'):
+            self.take()
+            self.take('symbol', '(')
+            values = [self.value(kind)]
+            while self.peek('symbol', ','):
+                self.take()
+                values.append(self.value(kind))
+            self.take('symbol', ')')
+            return lambda t: np.isin(t[field], values)
+        op = self.take('symbol', expected='a comparison')
+        if op not in selection.OPERATORS:
+            raise ValueError('Expected a comparison after '+field+' but found '+op)
+        compare, value = selection.OPERATORS[op], self.value(kind)
+        if kind == 'number' and op == '!=':
+            # Missing values do not match
+            return lambda t: compare(t[field], value) & ~np.isnan(t[field])
+        if kind == 'time' and op == '!=':
+            return lambda t: compare(t[field], value) & ~np.isnat(t[field])
+        return lambda t: compare(t[field], value)
+
+def present(values):
+    # Whether each exposure has a value, numbers and timestamps may be missing
+    if values.dtype.kind == 'f':
+        return ~np.isnan(values)
+    if values.dtype.kind == 'M':
+        return ~np.isnat(values)
+    return np.ones(len(values), dtype=bool)
+
+def squares(index, mask):
+    # Whether each square of the index has an exposure meeting the filter
+    return np.bincount(index.square[mask], minlength=len(index.squares)) > 0
+
+def foilholes(index, mask):
+    # FoilHole ids with an exposure meeting the filter
+    return set(np.unique(index.foilhole[mask]).tolist())
+
+def exposures(index, mask):
+    return set(index.names[mask].tolist())
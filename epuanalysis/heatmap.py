@@ -0,0 +1,117 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Particle density heatmaps on GridSquare images
+# Every exposure is placed on its square from the stage positions in the square and exposure xml,
+# as epu.plot_foilhole.py does for a single FoilHole, and its particle count is accumulated into a
+# 2D histogram that is written as a colour mapped overlay the size of the square jpg
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from epuanalysis import analysis, metadata
+
+HEATMAP_DIR = 'heatmaps'
+
+# Square readout width and height used when the square xml does not give them, as assumed in epu.plot_foilhole.py
+FRAME = 4096
+
+def heatmap_path(squarepath, analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, HEATMAP_DIR, analysis.square_name(squarepath)+'.png')
+
+def readout(frame):
+    # Readout width and height from one size for both or a (width, height) pair
+    frame = np.asarray(frame, dtype=float)
+    return (float(frame), float(frame)) if frame.ndim == 0 else (float(frame[0]), float(frame[1]))
+
+def frames(values):
+    # (N x 2) readout width and height of squares from their xml values, FRAME where missing
+    return np.array([[v.get('readout_width') or FRAME, v.get('readout_height') or FRAME] for v in values],
+                    dtype=float).reshape(-1, 2)
+
+def square_frames(squares):
+    # Readout width and height in px of each square image
+    return frames(metadata.read_many([analysis.square_xml(sq) for sq in squares], ['readout_width', 'readout_height']))
+
+def square_pixels(square, stage, frame=FRAME):
+    # Stage positions (N x 2, microns) to pixel column, row on the square readout
+    # square is an (M x 3) array of square stage X, Y and pixel size in microns
+    # and stage carries the square index in its third column
+    # frame is the readout size, one size, a (width, height) pair, or an (M x 2) array per square
+    index = stage[:, 2].astype(int)
+    sq = square[index]
+    frame = np.asarray(frame, dtype=float)
+    frame = np.broadcast_to(frame if frame.ndim else np.full(2, frame), (len(square), 2))[index]
+    col = frame[:, 0]/2 + (sq[:, 0]-stage[:, 0])/sq[:, 2]
+    row = frame[:, 1]/2 + (sq[:, 1]-stage[:, 1])/sq[:, 2]
+    return col, row
+
+def render(squarepath, col, row, weights, outpath, bins=32, frame=FRAME, cmap='inferno'):
+    # Histogram one square's particles and write the overlay png, frame is the readout size or (width, height)
+    import matplotlib
+    width, height = readout(frame)
+    hist, _, _ = np.histogram2d(row, col, bins=bins, range=[[0, height], [0, width]], weights=weights)
+    peak = hist.max()
+    norm = hist/peak if peak > 0 else hist
+    rgba = matplotlib.colormaps[cmap](norm)
+    # Only colour where particles came from
+    rgba[..., 3] = np.where(hist > 0, 0.35+0.4*norm, 0)
+    overlay = Image.fromarray((rgba*255).astype(np.uint8), 'RGBA')
+    with Image.open(squarepath) as im:
+        size = im.size
+    overlay = overlay.resize(size, Image.NEAREST)
+    overlay.save(outpath)
+    return outpath, int(hist.sum())
+
+def render_all(counts, subset='all', analysis_dir=analysis.ANALYSIS_DIR, bins=32, frame=None, workers=None):
+    # Overlays for every square in the analysis, on each square's readout size unless frame is given
+    squares = analysis.square_images(subset, analysis_dir)
+    os.makedirs(os.path.join(analysis_dir, HEATMAP_DIR), exist_ok=True)
+
+    # Stage positions of squares and their exposures
+    fields = ['stage_x', 'stage_y', 'pixel_size']
+    values = metadata.read_many([analysis.square_xml(sq) for sq in squares], fields+['readout_width', 'readout_height'])
+    square = np.array([[v[f] for f in fields] for v in values], dtype=float).reshape(-1, 3)
+    frame = frames(values) if frame is None else np.tile(readout(frame), (len(squares), 1))
+    paths, index = analysis.exposures(squares)
+    stage = np.zeros((len(paths), 3))
+    stage[:, 2] = index
+    for i, v in enumerate(metadata.read_many(paths, fields[:2])):
+        stage[i, :2] = v['stage_x'], v['stage_y']
+    weights = np.array([counts.get(analysis.exposure_name(xml), 0) for xml in paths], dtype=float)
+
+    # All exposures onto their squares at once
+    col, row = square_pixels(square, stage, frame)
+
+    # Split by square and render in parallel
+    index = stage[:, 2].astype(int)
+    order = np.argsort(index, kind='stable')
+    bounds = np.searchsorted(index[order], np.arange(len(squares)+1))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = []
+        for i, sq in enumerate(squares):
+            part = order[bounds[i]:bounds[i+1]]
+            jobs.append(pool.submit(render, sq, col[part], row[part], weights[part],
+                                    heatmap_path(sq, analysis_dir), bins, frame[i]))
+        return [job.result() for job in jobs]
@@ -0,0 +1,258 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Hole detection on GridSquare images, to compare the holes on a square with those EPU acquired
+# Each square is reduced to at most 512 px, the hole lattice spacing is found from its
+# autocorrelation and holes are found by FFT cross-correlation with a disk over an annulus.
+# Peaks are local maxima of the correlation, kept apart by a separable maximum filter.
+# Detected holes are registered to the acquired FoilHoles placed on the square by holemap,
+# after removing the median offset between them.
+#
+# EPU_analysis/detected_holes.npz     per detected hole: square, position on the readout, score,
+#                                     brightness and the FoilHole id it was acquired as, or -1
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from epuanalysis import analysis, heatmap, holemap, images
+
+DETECTED_FILE = 'detected_holes.npz'
+SIZE = 512
+
+# Peaks more than THRESHOLD robust deviations above the median correlation
+THRESHOLD = 4.0
+# Largest hole radius as a fraction of the lattice spacing
+RADIUS = 0.4
+# Trial hole radii as fractions of the lattice spacing
+TRIALS = np.array([0.15, 0.2, 0.25, 0.3, 0.35])
+# Peaks weaker than this fraction of the strong peaks are not holes
+STRONG = 0.25
+
+# Per square counts written to squares_coverage.csv
+COVERAGE = ['detected', 'acquired', 'matched', 'coverage', 'missed_good', 'spacing', 'offset_x', 'offset_y']
+
+def detected_path(analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, DETECTED_FILE)
+
+def lattice_spacing(image):
+    # Distance in px to the first ring of the autocorrelation beyond its central peak, which falls
+    # to its minimum at about a hole diameter
+    data = image-image.mean()
+    power = np.abs(np.fft.rfft2(data))**2
+    auto = np.fft.fftshift(np.fft.irfft2(power, s=data.shape))
+    cy, cx = np.array(auto.shape)//2
+    y, x = np.indices(auto.shape)
+    radius = np.hypot(y-cy, x-cx).astype(int).ravel()
+    profile = np.bincount(radius, weights=auto.ravel())/np.maximum(np.bincount(radius), 1)
+    slope = np.diff(profile[:min(auto.shape)//4])
+    rising = np.flatnonzero(slope > 0)
+    if not len(rising):
+        return None
+    start = rising[0]
+    # Holes are at least a diameter apart and rarely more than three
+    ring = profile[start:min(3*start+1, len(slope))]
+    return int(start+np.argmax(ring))
+
+def disk(shape, radius, outer=1.5):
+    # Zero mean template centred at the origin, a disk of 1 inside a balancing annulus,
+    # and the disk normalised to a mean
+    y = np.fft.fftfreq(shape[0])*shape[0]
+    x = np.fft.fftfreq(shape[1])*shape[1]
+    r = np.hypot(y[:, None], x[None, :])
+    inside = r <= radius
+    ring = (r > radius) & (r <= radius*outer)
+    template = inside.astype(np.float32)
+    template[ring] = -inside.sum()/max(ring.sum(), 1)
+    return template, inside.astype(np.float32)/inside.sum()
+
+def max_filter(data, size):
+    # Maximum over a size x size window, as two passes of a sliding window
+    pad = size//2
+    padded = np.pad(data, pad, mode='constant', constant_values=-np.inf)
+    rows = sliding_window_view(padded, size, axis=0).max(axis=-1)
+    return sliding_window_view(rows, size, axis=1).max(axis=-1)[:data.shape[0], :data.shape[1]]
+
+def correlate(spectrum, template, shape):
+    return np.fft.irfft2(spectrum*np.conj(np.fft.rfft2(template)), s=shape)
+
+def normalised(score):
+    # Correlation in robust deviations from its median, most of the image is not a hole centre
+    median = np.median(score)
+    scale = 1.4826*np.median(np.abs(score-median)) or 1
+    return (score-median)/scale
+
+def mean_hole(data, col, row, half):
+    # Mean of the square patches of half width half around the given centres
+    keep = (col >= half) & (row >= half) & (col < data.shape[1]-half) & (row < data.shape[0]-half)
+    offset = np.arange(-half, half+1)
+    patches = data[row[keep, None, None]+offset[None, :, None], col[keep, None, None]+offset[None, None, :]]
+    return patches.mean(axis=0) if len(patches) else None
+
+def hole_radius(patch):
+    # Radius at which the mean hole falls half way from its centre to the carbon around it
+    half = patch.shape[0]//2
+    y, x = np.indices(patch.shape)
+    radius = np.hypot(y-half, x-half).astype(int).ravel()
+    profile = np.bincount(radius, weights=patch.ravel())/np.bincount(radius)
+    profile = profile[:half+1]
+    middle = (profile[:2].mean()+profile[-2:].mean())/2
+    below = np.flatnonzero(profile < middle)
+    if not len(below) or below[0] == 0:
+        return None
+    # Interpolated between the radii either side of the crossing
+    r = below[0]
+    return float(r-1+(profile[r-1]-middle)/(profile[r-1]-profile[r]))
+
+def trial_radius(data, spacing, threshold):
+    # Hole radius measured on the mean of the holes found with trial disks on the image binned by
+    # two, from the trial closest to the radius it measures, among those finding more than a few holes
+    h, w = (np.array(data.shape)//2)*2
+    binned = data[:h, :w].reshape(h//2, 2, w//2, 2).mean(axis=(1, 3))
+    spectrum = np.fft.rfft2(binned-binned.mean())
+    measured = []
+    for trial in TRIALS*spacing/2:
+        col, row = peaks(normalised(correlate(spectrum, disk(binned.shape, trial)[0], binned.shape)), trial, threshold)
+        patch = mean_hole(binned, col, row, int(spacing/4))
+        found = hole_radius(patch) if patch is not None else None
+        if found:
+            measured.append((len(col), abs(found-trial)/trial, 2*found))
+    most = max([m[0] for m in measured] or [0])
+    measured = [m[1:] for m in measured if m[0] >= most/10]
+    return min(min(measured)[1] if measured else spacing/4, RADIUS*spacing)
+
+def peaks(score, radius, threshold):
+    # Local maxima at least a diameter apart, above the threshold and above a quarter of the
+    # strong peaks, which leaves out the edges of grid bars and contamination
+    apart = int(2*radius) | 1
+    found = (score == max_filter(score, apart)) & (score > threshold)
+    # No holes cut by the image edge
+    margin = int(np.ceil(radius))
+    found[:margin] = found[-margin:] = False
+    found[:, :margin] = found[:, -margin:] = False
+    row, col = np.nonzero(found)
+    if len(row):
+        strong = score[row, col] > STRONG*np.percentile(score[row, col], 90)
+        row, col = row[strong], col[strong]
+    return col, row
+
+def detect(image, radius=None, threshold=THRESHOLD, dark=False):
+    # Hole centres (col, row) in image px, their scores and mean brightness, and the spacing used
+    data = image.astype(np.float32)
+    if dark:
+        data = data.max()-data
+    spacing = lattice_spacing(data)
+    if not spacing:
+        spacing = None
+        if radius is None:
+            return np.zeros((0, 2)), np.zeros(0), np.zeros(0), spacing
+    spectrum = np.fft.rfft2(data-data.mean())
+    if radius is None:
+        radius = trial_radius(data, spacing, threshold)
+    radius = max(radius, 1.5)
+    template, mean = disk(data.shape, radius)
+    score = normalised(correlate(spectrum, template, data.shape))
+    col, row = peaks(score, radius, threshold)
+    brightness = correlate(np.fft.rfft2(image.astype(np.float32)), mean, data.shape)
+    return np.column_stack([col, row]).astype(float), score[row, col], brightness[row, col], spacing
+
+def square_job(job):
+    # Process pool worker, detection on one square in readout px
+    squarepath, diameter, size, threshold, dark, frame = job
+    try:
+        image = images.reduced(squarepath, size)
+    except (IOError, OSError):
+        print(squarepath[:80]+' could not be read')
+        return np.zeros((0, 2)), np.zeros(0), np.zeros(0), None
+    scale = max(heatmap.readout(frame))/max(image.shape)
+    radius = diameter/2/scale if diameter else None
+    position, score, brightness, spacing = detect(image, radius, threshold, dark)
+    return position*scale, score, brightness, spacing*scale if spacing else None
+
+def register(detected, holes, spacing, rounds=2):
+    # Detected hole matching each acquired hole, -1 if none is within half a spacing, and the offset
+    # removed from the acquired positions. holes is the holemap.HoleMap of the square
+    acquired = np.array([p is not None for p in holes.paths], dtype=bool)
+    match = np.full(len(holes), -1)
+    offset = np.zeros(2)
+    if not len(detected) or not acquired.any():
+        return match, offset
+    found = holemap.HoleMap([None]*len(detected), detected[:, 0], detected[:, 1], frame=holes.frame, height=holes.height)
+    reach = spacing or holes.frame/20
+    for r in range(rounds):
+        # Wide search first for the offset, then matches within half a spacing
+        radius = reach if r < rounds-1 else reach/2
+        for i in np.flatnonzero(acquired):
+            match[i] = found.nearest(holes.col[i]+offset[0], holes.row[i]+offset[1], radius)
+        hit = match >= 0
+        if hit.any() and r < rounds-1:
+            offset = np.median(detected[match[hit]]-np.column_stack([holes.col[hit], holes.row[hit]]), axis=0)
+    return match, offset
+
+def good_ice(brightness, particles=None):
+    # Brightness range of acquired holes, those with particles when known, as the 10th to 90th percentile
+    chosen = brightness if particles is None else brightness[particles > 0]
+    if len(chosen) < 3:
+        chosen = brightness
+    if not len(chosen):
+        return None
+    return tuple(np.percentile(chosen, [10, 90]))
+
+def coverage(result, holes, particles=None):
+    # FoilHole id of each detected hole, -1 where not acquired, and the square's counts
+    # particles: per hole of the HoleMap, nan or 0 for holes without any
+    position, score, brightness, spacing = result
+    match, offset = register(position, holes, spacing)
+    foilhole = np.full(len(position), -1, dtype=np.int64)
+    hit = match >= 0
+    foilhole[match[hit]] = holes.ids[hit]
+    acquired = np.array([p is not None for p in holes.paths], dtype=bool)
+    ice = good_ice(brightness[match[hit]], None if particles is None else np.nan_to_num(particles[hit]))
+    missed = foilhole < 0
+    if ice is not None:
+        missed &= (brightness >= ice[0]) & (brightness <= ice[1])
+    else:
+        missed[:] = False
+    counts = {'detected': len(position), 'acquired': int(acquired.sum()), 'matched': int(hit.sum()),
+              'coverage': float(hit.sum()/len(position)) if len(position) else np.nan,
+              'missed_good': int(missed.sum()), 'spacing': spacing or np.nan,
+              'offset_x': offset[0], 'offset_y': offset[1]}
+    return foilhole, counts
+
+def detect_all(squares, diameters, size=SIZE, threshold=THRESHOLD, dark=False, frame=None, workers=None):
+    # Detections of every square on a process pool, on each square's readout size unless frame is given
+    frames = heatmap.square_frames(squares) if frame is None else [frame]*len(squares)
+    jobs = [(sq, d, size, threshold, dark, f) for sq, d, f in zip(squares, diameters, frames)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(square_job, jobs, chunksize=2))
+
+def save_detected(squares, results, acquired, analysis_dir=analysis.ANALYSIS_DIR):
+    # acquired: per square, the FoilHole id each detected hole was acquired as or -1
+    square = np.concatenate([np.full(len(r[1]), i) for i, r in enumerate(results)]) if results else np.zeros(0)
+    position = np.concatenate([r[0] for r in results]) if results else np.zeros((0, 2))
+    np.savez(detected_path(analysis_dir), squares=np.array(squares, dtype=str), square=square.astype(np.int32),
+             col=position[:, 0], row=position[:, 1],
+             score=np.concatenate([r[1] for r in results]) if results else np.zeros(0),
+             brightness=np.concatenate([r[2] for r in results]) if results else np.zeros(0),
+             foilhole=np.concatenate(acquired).astype(np.int64) if acquired else np.zeros(0, dtype=np.int64))
+    return detected_path(analysis_dir)
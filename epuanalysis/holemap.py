@@ -0,0 +1,151 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# FoilHole positions on a square image, for picking holes with the mouse
+# Holes are taken from the GridSquare .dm targets read by epu.session_holes.py, which include
+# holes that were never acquired, or else placed on the square from the stage positions in the
+# square and FoilHole xml as for the particle heatmaps. They are bucketed into a regular grid of
+# cells so the hole nearest a point is found by looking only at the cells around it
+
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from epuanalysis import analysis, heatmap, keys, metadata, session
+
+# Grid cell in square readout pixels
+CELL = 64
+
+class HoleMap:
+
+    def __init__(self, paths, col, row, ids=None, frame=heatmap.FRAME, cell=CELL, height=None):
+        # frame and height are the readout width and height of the square, col and row are readout px
+        # paths are the FoilHole images, None for holes targeted but not acquired
+        self.paths = list(paths)
+        self.ids = keys.foilhole_ids([p or '' for p in self.paths]) if ids is None else np.asarray(ids, dtype=np.int64)
+        self.col = np.asarray(col, dtype=float)
+        self.row = np.asarray(row, dtype=float)
+        self.frame = frame
+        self.height = frame if height is None else height
+        self.cell = cell
+        # Holes sorted by grid cell, with the first hole of each cell
+        self.ncells = int(np.ceil(max(frame, self.height)/cell))
+        cells = self.cells(self.col, self.row)
+        self.order = np.argsort(cells, kind='stable')
+        self.offsets = np.r_[0, np.cumsum(np.bincount(cells, minlength=self.ncells**2))]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def cells(self, col, row):
+        cx = np.clip((col//self.cell).astype(int), 0, self.ncells-1)
+        cy = np.clip((row//self.cell).astype(int), 0, self.ncells-1)
+        return cy*self.ncells+cx
+
+    def nearest(self, col, row, radius=np.inf):
+        # Index of the hole nearest a point in readout pixels, -1 if none is within radius
+        cx = min(max(int(col//self.cell), 0), self.ncells-1)
+        cy = min(max(int(row//self.cell), 0), self.ncells-1)
+        reach = self.ncells if np.isinf(radius) else int(np.ceil(radius/self.cell))
+        best, bestd = -1, radius**2
+        # Grow a ring of cells until a hole is found and no closer cell is left unchecked
+        for r in range(min(reach, self.ncells)+1):
+            if best >= 0 and (r-1)*self.cell > np.sqrt(bestd):
+                break
+            for y in range(cy-r, cy+r+1):
+                if not 0 <= y < self.ncells:
+                    continue
+                xs = range(cx-r, cx+r+1) if abs(y-cy) == r else (cx-r, cx+r)
+                for x in xs:
+                    if not 0 <= x < self.ncells:
+                        continue
+                    c = y*self.ncells+x
+                    found = self.order[self.offsets[c]:self.offsets[c+1]]
+                    if not len(found):
+                        continue
+                    d = (self.col[found]-col)**2+(self.row[found]-row)**2
+                    i = np.argmin(d)
+                    if d[i] <= bestd:
+                        best, bestd = int(found[i]), d[i]
+        return best
+
+def build(squarepath, frame=None, holes=None, source=None):
+    # HoleMap of the targeted holes of a square, or of its FoilHole images with readable stage positions
+    # frame is the square readout size or (width, height), read from the square xml unless given
+    # source is a snapshot.Snapshot to read in place of the analysis directory
+    if source is None:
+        images = analysis.foilhole_images(squarepath)
+        isfile, read_many = os.path.isfile, metadata.read_many
+    else:
+        images = source.glob(os.path.splitext(squarepath)[0]+'_FoilHoles/*.jpg')
+        isfile, read_many = source.isfile, source.read_many
+    fields = ['stage_x', 'stage_y', 'pixel_size']
+    hasxml = isfile(analysis.square_xml(squarepath))
+    square = read_many([analysis.square_xml(squarepath)], fields+['readout_width', 'readout_height'])[0] if hasxml else {}
+    frame, height = heatmap.readout(heatmap.frames([square])[0] if frame is None else frame)
+    stored = holes.of_square(squarepath) if holes is not None else None
+    if stored is not None:
+        targets, _ = stored
+        byid = {}
+        for path, i in zip(images, keys.foilhole_ids(images)):
+            byid.setdefault(i, path)
+        return HoleMap([byid.get(i) for i in targets['foilhole']], targets['pixel_x'], targets['pixel_y'],
+                       targets['foilhole'], frame, height=height)
+    if not hasxml:
+        return HoleMap([], [], [], frame=frame, height=height)
+    holes = images
+    xmls = [os.path.splitext(h)[0]+'.xml' for h in holes]
+    present = [i for i, x in enumerate(xmls) if isfile(x)]
+    stage = read_many([xmls[i] for i in present], fields[:2])
+    keep = [(holes[i], s['stage_x'], s['stage_y']) for i, s in zip(present, stage)
+            if s['stage_x'] is not None and s['stage_y'] is not None]
+    if None in [square[f] for f in fields] or not keep:
+        return HoleMap([], [], [], frame=frame, height=height)
+    positions = np.array([[x, y, 0] for _, x, y in keep], dtype=float)
+    col, row = heatmap.square_pixels(np.array([[square[f] for f in fields]], dtype=float), positions, (frame, height))
+    return HoleMap([p for p, _, _ in keep], col, row, frame=frame, height=height)
+
+@lru_cache(maxsize=1)
+def _holes(mtime):
+    return session.load_holes()
+
+@lru_cache(maxsize=64)
+def _cached(squarepath, mtime, holesmtime):
+    return build(squarepath, holes=_holes(holesmtime))
+
+@lru_cache(maxsize=4)
+def _source_holes(source):
+    return session.load_holes(source.analysis_dir, source)
+
+@lru_cache(maxsize=64)
+def _source_cached(source, squarepath):
+    return build(squarepath, holes=_source_holes(source), source=source)
+
+def load(squarepath, source=None):
+    # HoleMap of a square, built once while its FoilHole directory and the stored targets are unchanged
+    if source is not None:
+        return _source_cached(source, os.path.normpath(squarepath))
+    holedir = os.path.splitext(squarepath)[0]+'_FoilHoles'
+    mtime = os.stat(holedir).st_mtime_ns if os.path.isdir(holedir) else 0
+    stored = session.holes_path()
+    holesmtime = os.stat(stored).st_mtime_ns if os.path.isfile(stored) else 0
+    return _cached(os.path.normpath(squarepath), mtime, holesmtime)
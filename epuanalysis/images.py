@@ -0,0 +1,169 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Bulk image decoding for statistics over square, FoilHole and micrograph jpgs
+# jpgs are decoded in PIL draft mode, which lets libjpeg scale by 1/2, 1/4 or 1/8
+# while decoding, so a 4096 px micrograph costs little more than a thumbnail
+#
+# Statistics for a whole analysis are kept in EPU_analysis/image_stats.npz as one array per
+# statistic, indexed alongside the image paths, so the browser never decodes to report them
+
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from epuanalysis import storage
+
+THUMBNAIL = 256
+
+def reduced(path, size=THUMBNAIL):
+    # Greyscale array of an image no larger than size px, path may also be the file contents
+    if isinstance(path, bytes):
+        path = io.BytesIO(path)
+    with Image.open(path) as im:
+        im.draft('L', (size, size))
+        im = im.convert('L')
+        im.thumbnail((size, size))
+        return np.asarray(im)
+
+def thumbnail(path, size=THUMBNAIL, mode='RGB'):
+    # PIL image no larger than size px, decoded in draft mode
+    with Image.open(path) as im:
+        im.draft(mode, (size, size))
+        im = im.convert(mode)
+        im.thumbnail((size, size), Image.LANCZOS)
+        return im
+
+def greyscale(path, size=THUMBNAIL):
+    # Mean and standard deviation of greyscale, nan if the file could not be read or decoded
+    if path is None:
+        return np.nan, np.nan
+    try:
+        data = reduced(path, size)
+    except (IOError, OSError):
+        print(('image' if isinstance(path, bytes) else str(path)[:80])+' could not be decoded')
+        return np.nan, np.nan
+    return data.mean(), data.std()
+
+def decode_all(func, paths, size=THUMBNAIL, workers=None, batch=64, pool=None):
+    # func(contents, size) for many images, files are read by the shared Storage threads
+    # a batch ahead of the decoding process pool so neither waits on the other
+    # contents is None for files that could not be read, func returns its missing value for them
+    # pool is a ProcessPoolExecutor to reuse across calls, one is started otherwise
+    if pool is None:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return decode_all(func, paths, size, batch=batch, pool=pool)
+    results = []
+    for _, contents in storage.storage().prefetch(paths, batch):
+        results += pool.map(func, contents, [size]*len(contents), chunksize=4)
+    return results
+
+def greyscale_all(paths, size=THUMBNAIL, workers=None):
+    # (N x 2) array of greyscale mean and standard deviation for many images
+    if not paths:
+        return np.zeros((0, 2))
+    return np.array(decode_all(greyscale, paths, size, workers))
+
+# Image kinds and statistics in the stats store
+KINDS = ['square', 'foilhole', 'micrograph']
+STATS = ['mean', 'std', 'p05', 'p50', 'p95']
+STATS_FILE = 'image_stats.npz'
+
+def statistics(path, size=THUMBNAIL):
+    # Greyscale mean, std and 5th, 50th, 95th percentiles, nan if the file could not be read or decoded
+    if path is None:
+        return np.full(len(STATS), np.nan)
+    try:
+        data = reduced(path, size)
+    except (IOError, OSError):
+        print(('image' if isinstance(path, bytes) else str(path)[:80])+' could not be decoded')
+        return np.full(len(STATS), np.nan)
+    p05, p50, p95 = np.percentile(data, [5, 50, 95])
+    return np.array([data.mean(), data.std(), p05, p50, p95])
+
+def statistics_all(paths, size=THUMBNAIL, workers=None):
+    # (N x len(STATS)) array of statistics for many images
+    if not paths:
+        return np.zeros((0, len(STATS)))
+    return np.array(decode_all(statistics, paths, size, workers))
+
+def ice_proxy(mean, kind):
+    # Relative ice thickness, log ratio of the brightest images of a kind to each image
+    # Energy filtered images darken as ice thickens, so the brightest (empty or thinnest)
+    # images of each kind stand in for the unscattered beam intensity
+    mean = np.asarray(mean, dtype=float)
+    kind = np.asarray(kind)
+    ice = np.full(len(mean), np.nan)
+    for k in np.unique(kind):
+        sel = (kind == k) & (mean > 0)
+        if sel.any():
+            ice[sel] = np.log(np.percentile(mean[sel], 99)/mean[sel])
+    return ice
+
+def stats_path(analysis_dir):
+    return os.path.join(analysis_dir, STATS_FILE)
+
+def save_stats(analysis_dir, paths, kind, values):
+    # Write the stats store, paths are normalised so lookups from any listing match
+    values = np.asarray(values, dtype=float).reshape(-1, len(STATS))
+    columns = {name: values[:, i] for i, name in enumerate(STATS)}
+    columns['ice'] = ice_proxy(columns['mean'], kind)
+    np.savez(stats_path(analysis_dir), path=np.array([os.path.normpath(p) for p in paths], dtype=str),
+             kind=np.asarray(kind, dtype=np.int8), **columns)
+    return stats_path(analysis_dir)
+
+class ImageStats:
+    # Lookup of the stats store by image path
+    def __init__(self, analysis_dir, source=None):
+        with (source or np).load(stats_path(analysis_dir)) as store:
+            self.columns = {name: store[name] for name in store.files}
+        self.index = {p: i for i, p in enumerate(self.columns['path'])}
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, path, stat='mean'):
+        # Statistic for one image, nan if not in the store
+        i = self.index.get(os.path.normpath(path))
+        return np.nan if i is None else self.columns[stat][i]
+
+    def lookup(self, paths, stat='mean'):
+        # Statistic for many images as an array
+        return np.array([self.get(p, stat) for p in paths], dtype=float)
+
+    def mean(self, paths, stat='mean'):
+        # Mean of a statistic over many images, ignoring images not in the store
+        values = self.lookup(paths, stat)
+        return float(np.nanmean(values)) if np.isfinite(values).any() else np.nan
+
+    def order(self, paths, stat='mean'):
+        # Indices sorting paths by a statistic, images not in the store last
+        return [int(i) for i in np.argsort(self.lookup(paths, stat), kind='stable')]
+
+def load_stats(analysis_dir, source=None):
+    # ImageStats for an analysis, None if the stats pass has not been run
+    try:
+        return ImageStats(analysis_dir, source)
+    except IOError:
+        return None
@@ -0,0 +1,132 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Index of every exposure in an EPU analysis, built once from the EPU_analysis square
+# directories and kept in EPU_analysis/index.npz until .squares_all.dat or a squares_all
+# <square>_Data directory changes, as new exposures are linked during a live session
+#
+# squares    square jpg paths, as listed in .squares_all.dat
+# names      exposure names, FoilHole_<id>_Data_<a>_<b>_<date>_<time>
+# square     index into squares of the square each exposure was taken on
+# foilhole   FoilHole id of each exposure
+#
+# Joins to the index match exposures by their integer keys, see keys.py
+
+import os
+
+import numpy as np
+
+from epuanalysis import analysis, keys
+
+INDEX_FILE = 'index.npz'
+
+class Index:
+
+    def __init__(self, squares, names, square, foilhole):
+        self.squares = np.asarray(squares, dtype=str)
+        self.names = np.asarray(names, dtype=str)
+        self.square = np.asarray(square, dtype=np.int32)
+        self.foilhole = np.asarray(foilhole, dtype=np.int64)
+        self._lookup = None
+        self._keys = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self):
+        # Exposure name to position in the index
+        if self._lookup is None:
+            self._lookup = {n: i for i, n in enumerate(self.names)}
+        return self._lookup
+
+    def keys(self):
+        # Integer key of each exposure and whether its name parsed as an EPU exposure
+        if self._keys is None:
+            self._keys = keys.exposures(self.names)
+        return self._keys
+
+    def find(self, names, suffix=None):
+        # Position in the index of each exposure or star file micrograph name, -1 if not found
+        found, valid = keys.exposures(names, suffix)
+        at = np.full(len(found), -1, dtype=np.int64)
+        table, parsed = self.keys()
+        at[valid] = keys.join(found[valid], np.where(parsed, table, np.zeros(1, dtype=keys.EXPOSURE)))
+        # Names outside the EPU naming are matched as strings
+        if not (valid.all() and parsed.all()):
+            lookup = self.lookup()
+            for i in np.flatnonzero(~valid):
+                at[i] = lookup.get(str(names[i]), -1)
+        return at
+
+    def align(self, names, values, suffix=None):
+        # Sum values given per name onto the exposures of the index, missing exposures are 0
+        at = self.find(names, suffix)
+        hit = at >= 0
+        return np.bincount(at[hit], weights=np.asarray(values, dtype=float)[hit], minlength=len(self))
+
+    def per_exposure(self, counts):
+        # Align a name -> value mapping with the index, missing exposures are 0
+        return self.align(list(counts), list(counts.values()))
+
+    def per_square(self, values):
+        # Sum a per exposure array over squares
+        return np.bincount(self.square, weights=values, minlength=len(self.squares))
+
+    def save(self, path):
+        np.savez(path, squares=self.squares, names=self.names, square=self.square, foilhole=self.foilhole)
+
+def index_path(analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, INDEX_FILE)
+
+def build(analysis_dir=analysis.ANALYSIS_DIR):
+    squares = analysis.square_images('all', analysis_dir)
+    paths, square = analysis.exposures(squares)
+    names = [analysis.exposure_name(p) for p in paths]
+    index = Index(squares, names, square, keys.foilhole_ids(names))
+    index.save(index_path(analysis_dir))
+    return index
+
+def modified(analysis_dir=analysis.ANALYSIS_DIR):
+    # Newest mtime of the square list and the squares_all <square>_Data directories
+    newest = os.path.getmtime(os.path.join(analysis_dir, analysis.SQUARE_LISTS['all']))
+    try:
+        with os.scandir(os.path.join(analysis_dir, 'squares_all')) as entries:
+            for entry in entries:
+                if entry.name.endswith('_Data'):
+                    newest = max(newest, entry.stat().st_mtime)
+    except (IOError, OSError):
+        pass
+    return newest
+
+def load(analysis_dir=analysis.ANALYSIS_DIR, rebuild=False, source=None):
+    # The saved index, built again if missing or older than the square list or exposure listings
+    # source is a snapshot.Snapshot to read in place of the analysis directory
+    path = index_path(analysis_dir)
+    if source is not None:
+        with source.load(path) as saved:
+            return Index(saved['squares'], saved['names'], saved['square'], saved['foilhole'])
+    try:
+        if not rebuild and os.path.getmtime(path) >= modified(analysis_dir):
+            with np.load(path) as saved:
+                return Index(saved['squares'], saved['names'], saved['square'], saved['foilhole'])
+    except (IOError, OSError, KeyError):
+        pass
+    return build(analysis_dir)
@@ -0,0 +1,186 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# EPU names as integer keys
+# FoilHole_5871221_Data_5860229_5860231_20210808_185028 is held as the integers of its fields,
+# foilhole 5871221, area 5860229, template 5860231, date 20210808 and time 185028, parsed for a
+# whole array of names at once from their bytes. Joins between the index, star files and other
+# stores then compare a few integers per row rather than strings.
+#
+# Star file entries are reduced to the exposure name first, directories and extension are
+# ignored and the data suffix (e.g. _Fractions) is removed as by sed "s/${suffix}//g"
+
+import numpy as np
+
+# Exposure key, sorts by FoilHole then acquisition time
+EXPOSURE = np.dtype([('foilhole', '<i8'), ('date', '<i4'), ('time', '<i4'), ('area', '<i8'), ('template', '<i8')])
+# Field of each token of FoilHole_<id>_Data_<area>_<template>_<date>_<time>, None for text tokens
+EXPOSURE_TOKENS = [None, 'foilhole', None, 'area', 'template', 'date', 'time']
+DIGITS = {'date': 8, 'time': 6}
+
+def as_bytes(names, suffix=None):
+    # Names as a 2d uint8 array, one row per name padded with 0, characters past latin-1 as 255
+    names = np.asarray(names, dtype=str)
+    if suffix:
+        names = np.char.replace(names, suffix, '')
+    width = max(names.dtype.itemsize//4, 1)
+    if not len(names):
+        return np.zeros((0, width), dtype=np.uint8)
+    codes = np.ascontiguousarray(names).view(np.uint32).reshape(len(names), -1)
+    return np.minimum(codes, 255).astype(np.uint8)
+
+def layout(name):
+    # Start and length of the '_' separated tokens of a name's basename, before any extension
+    base = name.rfind('/')+1
+    ext = name.rfind('.')
+    stem = name[base:ext if ext > base else len(name)]
+    spans = []
+    at = base
+    for token in stem.split('_'):
+        spans.append((at, len(token)))
+        at += len(token)+1
+    return spans
+
+def tokens(names, count, suffix=None):
+    # Integer value, length, digit count and start position of the first count tokens of each
+    # name, and the bytes of the names. Names sharing the positions of '_', '/', '.' and their
+    # end have the same layout, which is worked out once, and each token is then read for all
+    # those names at once a column of bytes at a time
+    codes = as_bytes(names, suffix)
+    n, width = codes.shape
+    value = np.zeros((n, count), dtype=np.int64)
+    length = np.zeros((n, count), dtype=np.int64)
+    digits = np.zeros((n, count), dtype=np.int64)
+    start = np.full((n, count), width, dtype=np.int64)
+    if not n:
+        return value, length, digits, start, codes
+    marks = (codes == ord('_')) | (codes == ord('/')) | (codes == ord('.')) | (codes == 0)
+    packed = np.ascontiguousarray(np.packbits(marks, axis=1))
+    signature = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+    _, first, group = np.unique(signature, return_index=True, return_inverse=True)
+    order = np.argsort(group, kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(group))]
+    for g, r in enumerate(first):
+        rows = order[bounds[g]:bounds[g+1]] if len(first) > 1 else slice(None)
+        name = codes[r].tobytes().rstrip(b'\0').decode('latin-1')
+        for i, (at, size) in enumerate(layout(name)[:count]):
+            start[rows, i] = at
+            length[rows, i] = size
+            if not 0 < size < 19:
+                continue
+            chars = codes[rows, at:at+size]-np.uint8(ord('0'))
+            isdigit = chars < 10
+            digits[rows, i] = isdigit.sum(axis=1)
+            if not isdigit.all(axis=1).any():
+                continue
+            number = np.zeros(len(chars), dtype=np.int64)
+            for k in range(size):
+                number = number*10+chars[:, k]
+            value[rows, i] = number
+    return value, length, digits, start, codes
+
+def is_word(codes, start, length, word):
+    # Whether the token at start of the given length is word
+    word = np.frombuffer(word.encode(), dtype=np.uint8)
+    ok = length == len(word)
+    at = np.minimum(start[:, None]+np.arange(len(word)), codes.shape[1]-1)
+    return ok & (codes[np.arange(len(codes))[:, None], at] == word).all(axis=1)
+
+def exposures(names, suffix=None):
+    # EXPOSURE keys and a mask of the names that are EPU exposures
+    # Star files list the particles of a micrograph together, so each run of repeated names
+    # is parsed once, which avoids sorting the strings. Names repeated out of order fall back
+    # to parsing only the distinct names
+    names = np.asarray(names, dtype=str)
+    if len(names) < 2:
+        return exposures_distinct(names, suffix)
+    change = np.empty(len(names), dtype=bool)
+    change[0] = True
+    np.not_equal(names[1:], names[:-1], out=change[1:])
+    if change.sum() <= len(names)//2:
+        keys, valid = exposures_distinct(names[change], suffix)
+        run = np.cumsum(change)-1
+        return keys[run], valid[run]
+    distinct, inverse = np.unique(names, return_inverse=True)
+    if len(distinct) < len(names):
+        keys, valid = exposures_distinct(distinct, suffix)
+        return keys[inverse], valid[inverse]
+    return exposures_distinct(names, suffix)
+
+def exposures_distinct(names, suffix=None):
+    value, length, digits, start, codes = tokens(names, len(EXPOSURE_TOKENS), suffix)
+    keys = np.zeros(len(value), dtype=EXPOSURE)
+    valid = is_word(codes, start[:, 0], length[:, 0], 'FoilHole') & is_word(codes, start[:, 2], length[:, 2], 'Data')
+    for i, field in enumerate(EXPOSURE_TOKENS):
+        if field is not None:
+            valid &= (digits[:, i] == length[:, i]) & (digits[:, i] == DIGITS.get(field, digits[:, i])) & (digits[:, i] > 0)
+            keys[field] = value[:, i]
+    keys[~valid] = 0
+    return keys, valid
+
+def foilhole_ids(names, suffix=None):
+    # FoilHole id of FoilHole images and exposures, -1 where the name has none
+    value, length, digits, start, codes = tokens(names, 2, suffix)
+    ok = is_word(codes, start[:, 0], length[:, 0], 'FoilHole') & (digits[:, 1] == length[:, 1]) & (digits[:, 1] > 0)
+    return np.where(ok, value[:, 1], -1)
+
+def timestamps(keys):
+    # datetime64[s] of exposure keys, NaT for invalid dates
+    date, time = keys['date'].astype(np.int64), keys['time'].astype(np.int64)
+    year, month, day = date//10000, date//100 % 100, date % 100
+    hour, minute, second = time//10000, time//100 % 100, time % 100
+    ok = (year > 0) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31) & (hour < 24) & (minute < 60) & (second < 61)
+    times = np.full(len(keys), np.datetime64('NaT'), dtype='datetime64[s]')
+    months = (year[ok]-1970).astype('datetime64[Y]').astype('datetime64[M]')+(month[ok]-1)
+    stamp = months.astype('datetime64[D]')+(day[ok]-1)
+    # Days past the end of the month, as Feb 30, roll over into the next month and are invalid
+    stamp[stamp.astype('datetime64[M]') != months] = np.datetime64('NaT')
+    times[ok] = stamp.astype('datetime64[s]')+(hour[ok]*3600+minute[ok]*60+second[ok])
+    return times
+
+def join(keys, table):
+    # Position in table of each key, -1 where it is not found
+    # Searching structured keys is slow, so runs of repeated keys are searched once
+    if len(keys) > 1:
+        change = np.zeros(len(keys), dtype=bool)
+        change[0] = True
+        for field in keys.dtype.names or [None]:
+            column = keys if field is None else keys[field]
+            change[1:] |= column[1:] != column[:-1]
+        if change.sum() < len(keys)//2:
+            return join(keys[change], table)[np.cumsum(change)-1]
+    # Structured keys are sorted and searched by their raw bytes, which is several times faster
+    # than comparing field by field and orders equal keys together all the same
+    table, keys = np.ascontiguousarray(table), np.ascontiguousarray(keys)
+    if table.dtype.names:
+        raw = np.dtype((np.void, table.dtype.itemsize))
+        order = np.argsort(table.view(raw), kind='stable')
+        at = np.searchsorted(table.view(raw)[order], keys.view(raw))
+    else:
+        order = np.argsort(table, kind='stable')
+        at = np.searchsorted(table[order], keys)
+    if not len(order):
+        return np.full(len(keys), -1, dtype=np.int64)
+    at = order[np.minimum(at, len(order)-1)]
+    found = np.ones(len(keys), dtype=bool)
+    for field in table.dtype.names or [None]:
+        found &= (table[at] if field is None else table[field][at]) == (keys if field is None else keys[field])
+    return np.where(found, at, -1)
@@ -0,0 +1,158 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Particle layers, any number of star files attached to one EPU index
+#
+# EPU_analysis/layers/layers.json         layer name -> star path, size, mtime, sha1, column, suffix, key
+# EPU_analysis/layers/<key>.npz           particles per micrograph name for one star file
+#
+# A layer's npz is keyed on the sha1 of the star file contents with its column and suffix, so
+# attaching the same file again, or under another name, never parses it twice. The sha1 itself
+# is only recomputed when the star file's size or mtime changes. Joining to the index happens
+# when a layer is loaded, which is cheap, so rebuilding the index never needs a re-parse.
+
+import builtins
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from epuanalysis import analysis, star
+
+LAYER_DIR = 'layers'
+REGISTRY = 'layers.json'
+
+def layer_dir(analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, LAYER_DIR)
+
+def file_hash(path, chunk=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def read_registry(analysis_dir=analysis.ANALYSIS_DIR, source=None):
+    try:
+        with (source or builtins).open(os.path.join(layer_dir(analysis_dir), REGISTRY)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def write_registry(registry, analysis_dir=analysis.ANALYSIS_DIR):
+    os.makedirs(layer_dir(analysis_dir), exist_ok=True)
+    path = os.path.join(layer_dir(analysis_dir), REGISTRY)
+    with open(path+'.tmp', 'w') as f:
+        json.dump(registry, f, indent=1, sort_keys=True)
+    os.replace(path+'.tmp', path)
+
+def layer_names(analysis_dir=analysis.ANALYSIS_DIR):
+    return sorted(read_registry(analysis_dir))
+
+def default_name(starfile):
+    # Relion job and file, e.g. Refine3D/job045/run_data.star -> Refine3D_job045_run_data
+    parts = os.path.normpath(os.path.abspath(starfile)).split(os.sep)[-3:]
+    return '_'.join(os.path.splitext(p)[0] for p in parts)
+
+class Layer:
+
+    def __init__(self, name, entry, names, counts):
+        self.name = name
+        self.star = entry['star']
+        self.entry = entry
+        self.names = names
+        self.totals = counts
+        self.counts = dict(zip(names.tolist(), counts.tolist()))
+
+    def particles(self):
+        return int(self.totals.sum())
+
+    def join(self, index):
+        # Particles per exposure of the index and per square, and particles matching no exposure
+        exposure = index.align(self.names, self.totals)
+        return exposure, index.per_square(exposure), self.particles()-int(exposure.sum())
+
+def attach(starfile, name=None, column='_rlnMicrographName', suffix=None, analysis_dir=analysis.ANALYSIS_DIR):
+    # Add or refresh a layer, parsing the star file only if no layer of its contents exists
+    name = name or default_name(starfile)
+    registry = read_registry(analysis_dir)
+    st = os.stat(starfile)
+    entry = dict(registry.get(name, {}))
+    if not (entry.get('star') == os.path.abspath(starfile) and entry.get('size') == st.st_size
+            and entry.get('mtime') == st.st_mtime_ns and entry.get('sha1')):
+        entry = {'star': os.path.abspath(starfile), 'size': st.st_size, 'mtime': st.st_mtime_ns,
+                 'sha1': file_hash(starfile)}
+    entry['column'] = column
+    entry['suffix'] = suffix
+    entry['key'] = hashlib.sha1((entry['sha1']+' '+column+' '+str(suffix)).encode()).hexdigest()[:16]
+    path = os.path.join(layer_dir(analysis_dir), entry['key']+'.npz')
+    if not os.path.isfile(path):
+        print('Parsing '+starfile+' for layer '+name)
+        counts = star.particle_counts(starfile, column, suffix)
+        os.makedirs(layer_dir(analysis_dir), exist_ok=True)
+        np.savez(path, names=np.array(list(counts), dtype=str), counts=np.array(list(counts.values()), dtype=np.int64))
+    if registry.get(name) != entry:
+        registry[name] = entry
+        write_registry(registry, analysis_dir)
+    return load(name, analysis_dir)
+
+def load(name, analysis_dir=analysis.ANALYSIS_DIR, source=None):
+    entry = read_registry(analysis_dir, source)[name]
+    with (source or np).load(os.path.join(layer_dir(analysis_dir), entry['key']+'.npz')) as saved:
+        return Layer(name, entry, saved['names'], saved['counts'])
+
+def load_all(analysis_dir=analysis.ANALYSIS_DIR, source=None):
+    # source is a snapshot.Snapshot to read in place of the analysis directory
+    layers = {}
+    for name in sorted(read_registry(analysis_dir, source)):
+        try:
+            layers[name] = load(name, analysis_dir, source)
+        except (IOError, KeyError) as e:
+            print('Layer '+name+' could not be loaded: '+str(e))
+    return layers
+
+def remove(name, analysis_dir=analysis.ANALYSIS_DIR):
+    # Drop a layer, its npz is deleted once no other layer shares it
+    registry = read_registry(analysis_dir)
+    entry = registry.pop(name)
+    write_registry(registry, analysis_dir)
+    if not any(e['key'] == entry['key'] for e in registry.values()):
+        try:
+            os.remove(os.path.join(layer_dir(analysis_dir), entry['key']+'.npz'))
+        except OSError:
+            pass
+
+def default_layer(analysis_dir=analysis.ANALYSIS_DIR):
+    # Layer for the star file of the tracking run in settings.dat with its current column and suffix
+    # attach only parses again when the star file's size or mtime, the column or the suffix changed
+    settings = analysis.read_settings(analysis_dir)
+    if not settings.get('Star'):
+        return None
+    name = default_name(settings['Star'])
+    return attach(settings['Star'], name, settings.get('Column') or '_rlnMicrographName',
+                  settings.get('Suffix'), analysis_dir)
+
+def differential(index, a, b):
+    # Per square particles of layer a and b, and the change b - a
+    _, sqa, _ = a.join(index)
+    _, sqb, _ = b.join(index)
+    return sqa, sqb, sqb-sqa
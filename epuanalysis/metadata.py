@@ -0,0 +1,154 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# EPU xml metadata reading, shared by the scripts
+# Adapted from code from T. J. Raegen, University of Leicester
+#
+# Field paths are compiled once per xml root namespace into tuples of namespaced tags. Only
+# the EPU 2.x layout is known, other namespaces are read with the same layout. Each file is
+# parsed once into a record of every field, kept in an LRU cache keyed on path, mtime and
+# size, so reopening a file that has not changed never parses it again. Missing fields are
+# None, and every field is None for files that are missing or not yet fully written.
+
+import os
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+
+from epuanalysis import storage
+
+# FEI EPU xml stuff
+ns = {'p': 'http://schemas.datacontract.org/2004/07/Applications.Epu.Persistence'}
+ns['system'] = 'http://schemas.datacontract.org/2004/07/System'
+ns['so'] = 'http://schemas.datacontract.org/2004/07/Fei.SharedObjects'
+ns['g'] = 'http://schemas.datacontract.org/2004/07/System.Collections.Generic'
+ns['s'] = 'http://schemas.datacontract.org/2004/07/Fei.Applications.Common.Services'
+ns['a'] = 'http://schemas.datacontract.org/2004/07/System.Drawing'
+
+# Field name: (path, scale to the units reported in the GUIs, None for text)
+FIELDS = {
+    'stage_x': ('so:microscopeData/so:stage/so:Position/so:X', 1e6),                 # um
+    'stage_y': ('so:microscopeData/so:stage/so:Position/so:Y', 1e6),                 # um
+    'stage_z': ('so:microscopeData/so:stage/so:Position/so:Z', 1e6),                 # um
+    'stage_a': ('so:microscopeData/so:stage/so:Position/so:A', 1),                   # rad
+    'stage_b': ('so:microscopeData/so:stage/so:Position/so:B', 1),                   # rad
+    'pixel_size': ('so:SpatialScale/so:pixelSize/so:x/so:numericValue', 1e6),        # um
+    'readout_width': ('so:microscopeData/so:acquisition/so:camera/so:ReadoutArea/a:width', 1),    # px
+    'readout_height': ('so:microscopeData/so:acquisition/so:camera/so:ReadoutArea/a:height', 1),  # px
+    'defocus': ('so:microscopeData/so:optics/so:Defocus', 1e6),                      # um
+    'exposure_time': ('so:microscopeData/so:acquisition/so:camera/so:ExposureTime', 1),  # sec
+    'spot': ('so:microscopeData/so:optics/so:SpotIndex', 1),
+    'magnification': ('so:microscopeData/so:optics/so:TemMagnification/so:NominalMagnification', 1),
+    'beam_diameter': ('so:microscopeData/so:optics/so:BeamDiameter', 1e9),           # nm
+    'slit_width': ('so:microscopeData/so:optics/so:EnergyFilter/so:EnergySelectionSlitWidth', 1),  # eV
+    'acquisition_time': ('so:microscopeData/so:acquisition/so:acquisitionDateTime', None),
+    'camera': ('so:microscopeData/so:acquisition/so:camera/so:Name', None),
+    'instrument': ('so:microscopeData/so:instrument/so:InstrumentModel', None),
+    'epu_version': ('so:microscopeData/so:core/so:ApplicationSoftwareVersion', None),
+}
+
+# Known schema versions by root namespace, with any prefixes that differ from ns
+# EPU 2.x MicroscopeImage files, both square, FoilHole and exposure metadata, are the only
+# layout handled so far
+SCHEMAS = {
+    'http://schemas.datacontract.org/2004/07/Fei.SharedObjects': ('epu2', {}),
+}
+
+class Schema:
+    # Field paths of one schema version compiled to tuples of {namespace}tag
+    def __init__(self, name, namespaces):
+        self.name = name
+        self.ns = dict(ns, **namespaces)
+        self.paths = {field: self.compile(path) for field, (path, _) in FIELDS.items()}
+
+    def compile(self, path):
+        tags = []
+        for step in path.split('/'):
+            prefix, tag = step.split(':')
+            tags.append('{'+self.ns[prefix]+'}'+tag)
+        return tuple(tags)
+
+    def extract(self, root):
+        # Every field from a parsed root element
+        record = {'schema': self.name}
+        for field, tags in self.paths.items():
+            node = root
+            for tag in tags:
+                node = node.find(tag)
+                if node is None:
+                    break
+            scale = FIELDS[field][1]
+            if node is None or node.text is None:
+                record[field] = None
+            elif scale is None:
+                record[field] = node.text
+            else:
+                try:
+                    record[field] = float(node.text)*scale
+                except ValueError:
+                    record[field] = None
+        return record
+
+_schemas = {}
+
+def schema(root):
+    # Schema for a root element, detected from its namespace
+    namespace = root.tag[1:].split('}')[0] if root.tag.startswith('{') else ''
+    if namespace not in _schemas:
+        if namespace in SCHEMAS:
+            name, namespaces = SCHEMAS[namespace]
+        else:
+            # Unknown version, assume the layout is unchanged under the new namespace
+            print('Unknown EPU xml namespace '+namespace+', reading as epu2')
+            name, namespaces = 'unknown', {'so': namespace}
+        _schemas[namespace] = Schema(name, namespaces)
+    return _schemas[namespace]
+
+@lru_cache(maxsize=65536)
+def _record(xmlfile, mtime, size):
+    root = ET.parse(xmlfile).getroot()
+    return schema(root).extract(root)
+
+def record(xmlfile):
+    # All fields of an xml file, parsed at most once while the file is unchanged
+    st = os.stat(xmlfile)
+    return _record(os.path.abspath(xmlfile), st.st_mtime_ns, st.st_size)
+
+def read(xmlfile, fields=FIELDS):
+    # Named fields from an EPU xml file, None where the field is missing or the file
+    # could not be read, as a half written xml during live collection
+    try:
+        values = record(xmlfile)
+    except (IOError, OSError, ET.ParseError):
+        print(str(xmlfile)[-80:]+' could not be read')
+        return {field: None for field in fields}
+    return {field: values[field] for field in fields}
+
+def stage_position(xmlfile):
+    # Stage X, Y and pixel size in microns, as epu.plot_foilhole.py
+    values = record(xmlfile)
+    return values['stage_x'], values['stage_y'], values['pixel_size']
+
+def read_many(xmlfiles, fields=FIELDS):
+    # read() for many files, concurrently on the shared Storage
+    return storage.storage().map(read, xmlfiles, fields)
+
+def cache_info():
+    return _record.cache_info()
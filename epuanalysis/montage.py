@@ -0,0 +1,163 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Paged contact sheets of squares and FoilHoles, to compare a whole session side by side
+# Thumbnails are decoded in jpeg draft mode on a process pool, files read ahead by the Storage threads
+#
+# EPU_analysis/montages/<used|not>/squares_NNN.jpg                 squares, most particles first
+# EPU_analysis/montages/<used|not>/<square>/foilholes_NNN.jpg      FoilHoles of a square, holes with particles first
+
+import glob
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from epuanalysis import analysis, images, keys
+
+MONTAGE_DIR = 'montages'
+SUBSETS = ['used', 'not']
+TILE = 192
+COLUMNS = 8
+ROWS = 5
+LABEL = 30
+# FoilHole tiles decoded at a time, about 110 kB each at the default size
+CHUNK = 2048
+
+# Border of FoilHoles with and without particles
+USED = (40, 160, 40)
+NOT_USED = (200, 50, 50)
+
+def montage_dir(subset, analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, MONTAGE_DIR, subset)
+
+def sheets(subset, analysis_dir=analysis.ANALYSIS_DIR):
+    # Square sheets of a subset in page order
+    return sorted(glob.glob(os.path.join(montage_dir(subset, analysis_dir), 'squares_*.jpg')))
+
+def tile(contents, size=TILE):
+    # Process pool worker, RGB array of a thumbnail no larger than size px, None if unreadable
+    if contents is None:
+        return None
+    try:
+        return np.asarray(images.thumbnail(io.BytesIO(contents), size))
+    except (IOError, OSError):
+        return None
+
+def page(tiles, labels, borders, columns=COLUMNS, size=TILE):
+    # One sheet of tiles, each centred in its cell over a two line label
+    rows = -(-len(tiles)//columns)
+    sheet = Image.new('RGB', (columns*size, rows*(size+LABEL)), (0, 0, 0))
+    draw = ImageDraw.Draw(sheet)
+    for i, (data, label, border) in enumerate(zip(tiles, labels, borders)):
+        x, y = (i % columns)*size, (i//columns)*(size+LABEL)
+        if data is not None:
+            h, w = data.shape[:2]
+            sheet.paste(Image.fromarray(data), (x+(size-w)//2, y+(size-h)//2))
+        else:
+            draw.text((x+4, y+size//2), 'unreadable', fill=(255, 255, 255))
+        if border is not None:
+            draw.rectangle([x, y, x+size-1, y+size-1], outline=border, width=3)
+        draw.text((x+4, y+size+2), label, fill=(255, 255, 255))
+    return sheet
+
+def write_pages(tiles, labels, borders, outdir, prefix, columns=COLUMNS, rows=ROWS, size=TILE):
+    # Sheets of columns x rows tiles, replacing the sheets written before
+    os.makedirs(outdir, exist_ok=True)
+    for old in glob.glob(os.path.join(outdir, prefix+'_*.jpg')):
+        os.remove(old)
+    per = columns*rows
+    written = []
+    for n, first in enumerate(range(0, len(tiles), per)):
+        sheet = page(tiles[first:first+per], labels[first:first+per], borders[first:first+per], columns, size)
+        written.append(os.path.join(outdir, prefix+'_%03d.jpg' % (n+1)))
+        sheet.save(written[-1], quality=85)
+    return written
+
+def decode(paths, size=TILE, workers=None, pool=None):
+    return images.decode_all(tile, paths, size, workers, pool=pool) if paths else []
+
+def short_name(name):
+    # GridSquare_20210806_120003 -> 120003, FoilHole_5000001_20210806_120101 -> 5000001
+    parts = name.split('_')
+    return parts[1] if name.startswith('FoilHole') and len(parts) > 1 else parts[-1]
+
+def subset_squares(index, subset, analysis_dir=analysis.ANALYSIS_DIR):
+    # Squares of the used or not used list and their position in the index
+    # The lists hold squares_used and squares_not_used paths, the index squares_all, so match by name
+    position = {analysis.square_name(sq): i for i, sq in enumerate(index.squares)}
+    squares = [sq for sq in analysis.square_images(subset, analysis_dir) if analysis.square_name(sq) in position]
+    return squares, [position[analysis.square_name(sq)] for sq in squares]
+
+def square_sheets(index, exposure, subset, analysis_dir=analysis.ANALYSIS_DIR, columns=COLUMNS, rows=ROWS,
+                  size=TILE, workers=None):
+    # Squares of the used or not used list, most particles first
+    squares, at = subset_squares(index, subset, analysis_dir)
+    counts = index.per_square(exposure)[at].astype(np.int64)
+    order = np.argsort(-counts, kind='stable')
+    squares = [squares[i] for i in order]
+    labels = [short_name(analysis.square_name(sq))+'\n'+str(counts[i])+' particles' for sq, i in zip(squares, order)]
+    return write_pages(decode(squares, size, workers), labels, [None]*len(squares),
+                       montage_dir(subset, analysis_dir), 'squares', columns, rows, size)
+
+def hole_counts(index, exposure, square, ids):
+    # Particles of each FoilHole id on one square of the index
+    mine = index.square == square
+    table, at = np.unique(index.foilhole[mine], return_inverse=True)
+    if not len(table):
+        return np.zeros(len(ids), dtype=np.int64)
+    totals = np.bincount(at, weights=exposure[mine], minlength=len(table))
+    found = np.minimum(np.searchsorted(table, ids), len(table)-1)
+    return np.where(table[found] == ids, totals[found], 0).astype(np.int64)
+
+def foilhole_sheets(index, exposure, subset, analysis_dir=analysis.ANALYSIS_DIR, columns=COLUMNS, rows=ROWS,
+                    size=TILE, workers=None):
+    # FoilHoles of every square in the subset, holes with particles first and bordered green
+    # Squares are decoded on one pool in chunks of about CHUNK tiles, and each chunk is paged
+    # before the next is decoded, so memory stays bounded however many FoilHoles a session has
+    squares, at = subset_squares(index, subset, analysis_dir)
+    listed = analysis.listing(squares, '_FoilHoles/*.jpg')
+    written = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        start = 0
+        while start < len(squares):
+            end, count = start+1, len(listed[start])
+            while end < len(squares) and count+len(listed[end]) <= CHUNK:
+                end, count = end+1, count+len(listed[end])
+            tiles = decode([h for holes in listed[start:end] for h in holes], size, pool=pool)
+            first = 0
+            for sq, square, holes in zip(squares[start:end], at[start:end], listed[start:end]):
+                written += hole_pages(index, exposure, sq, square, holes, tiles[first:first+len(holes)],
+                                      subset, analysis_dir, columns, rows, size)
+                first += len(holes)
+            start = end
+    return written
+
+def hole_pages(index, exposure, sq, square, holes, tiles, subset, analysis_dir, columns, rows, size):
+    # Sheets of the FoilHoles of one square, most particles first
+    counts = hole_counts(index, exposure, square, keys.foilhole_ids([analysis.exposure_name(h) for h in holes]))
+    order = np.argsort(-counts, kind='stable')
+    labels = [short_name(analysis.exposure_name(holes[i]))+'\n'+str(counts[i])+' particles' for i in order]
+    borders = [USED if counts[i] > 0 else NOT_USED for i in order]
+    outdir = os.path.join(montage_dir(subset, analysis_dir), analysis.square_name(sq))
+    return write_pages([tiles[i] for i in order], labels, borders, outdir, 'foilholes', columns, rows, size)
@@ -0,0 +1,110 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Memory mapped MRC micrograph reading for display
+# The processed micrographs named in the star file are opened as np.memmap and reduced to the
+# display size by block averaging a strip of rows at a time, so a K3 micrograph never sits in RAM
+
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from epuanalysis import star
+
+# MRC2014 data modes
+MODES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16, 12: np.float16}
+HEADER = 1024
+DISPLAY = 400
+# Contrast limits, percentiles of the downsampled image
+LIMITS = (1, 99)
+# Rows of blocks averaged per read
+STRIP = 16
+
+def header(path):
+    # nx, ny, nz, mode and extended header length of an MRC file
+    words = np.fromfile(path, dtype='<i4', count=24)
+    if not 0 < words[3] < 100 and 0 < words[3].byteswap() < 100:
+        words = words.byteswap()
+    nx, ny, nz, mode = (int(w) for w in words[:4])
+    if mode not in MODES:
+        raise ValueError('MRC mode '+str(mode)+' not supported in '+path)
+    return nx, ny, nz, mode, int(words[23])
+
+def open_mrc(path):
+    # Memory map of the first section of an MRC file, rows by columns
+    nx, ny, nz, mode, extended = header(path)
+    dtype = np.dtype(MODES[mode]).newbyteorder('<')
+    return np.memmap(path, dtype=dtype, mode='r', offset=HEADER+extended, shape=(ny, nx))
+
+def block_average(data, factor, strip=STRIP):
+    # Mean of factor x factor blocks, reading strip block rows from the map at a time
+    ny, nx = data.shape[0]//factor, data.shape[1]//factor
+    out = np.empty((ny, nx), dtype=np.float32)
+    for y in range(0, ny, strip):
+        rows = np.asarray(data[y*factor:min(y+strip, ny)*factor, :nx*factor], dtype=np.float32)
+        out[y:y+len(rows)//factor] = rows.reshape(-1, factor, nx, factor).mean(axis=(1, 3))
+    return out
+
+@lru_cache(maxsize=32)
+def _reduced(path, mtime, size, display):
+    data = open_mrc(path)
+    factor = max(1, -(-max(data.shape)//display))
+    image = block_average(data, factor)
+    del data
+    lo, hi = np.percentile(image, LIMITS)
+    return image, lo, hi
+
+def reduced(path, display=DISPLAY):
+    # Downsampled micrograph and its contrast limits, kept while the file is unchanged
+    st = os.stat(path)
+    return _reduced(os.path.abspath(path), st.st_mtime_ns, st.st_size, display)
+
+def display(path, size=DISPLAY):
+    # 8 bit greyscale for display, scaled between the precomputed percentiles
+    image, lo, hi = reduced(path, size)
+    scaled = (image-lo)*(255/(hi-lo)) if hi > lo else image*0
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+@lru_cache(maxsize=8)
+def _micrographs(starfile, mtime, column, suffix):
+    data = star.read_loop(starfile, [column])
+    return {star.micrograph_name(v, suffix): v for v in data[column]}
+
+def micrograph_paths(starfile, column='_rlnMicrographName', suffix=None):
+    # EPU exposure name -> micrograph path as written in the star file
+    return _micrographs(os.path.abspath(starfile), os.stat(starfile).st_mtime_ns, column, suffix)
+
+def find(name, starfile, column='_rlnMicrographName', suffix=None, paths=None):
+    # MRC file of an exposure, the star file paths are relative to the Relion project directory
+    # which is the working directory or a parent of the star file's job directory
+    # paths is micrograph_paths of the star file when already read, it is read here otherwise
+    value = (micrograph_paths(starfile, column, suffix) if paths is None else paths).get(name)
+    if value is None or os.path.splitext(value)[1].lower() != '.mrc':
+        return None
+    if os.path.isabs(value):
+        return value if os.path.isfile(value) else None
+    base = os.path.dirname(os.path.abspath(starfile))
+    for directory in [os.getcwd()]+[base]+[os.path.dirname(base), os.path.dirname(os.path.dirname(base))]:
+        path = os.path.join(directory, value)
+        if os.path.isfile(path):
+            return path
+    return None
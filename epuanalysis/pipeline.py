@@ -0,0 +1,331 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# The analysis as a graph of stages, each run only when what it reads has changed
+# A stage's key is a hash of its command, the settings it uses and the contents of its inputs:
+# small files and the arrays of npz files by content, large files by size and mtime, directories
+# by their listing. Outputs of every run are kept under the key, so a stage whose key was seen
+# before is restored instead of run, and stages whose inputs are ready run concurrently.
+# Stages with bulk outputs, the tracking link trees and star data, are not kept and run again
+# when their key changes.
+#
+# EPU_analysis/.pipeline/<stage>.json            keys kept for the stage, newest last
+# EPU_analysis/.pipeline/<stage>/<key>/          outputs of the stage for that key
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+from epuanalysis import analysis, export, index
+
+PIPELINE_DIR = '.pipeline'
+WORKERS = 4
+# Keys kept per stage
+KEEP = 3
+# Files larger than this are keyed by size and mtime rather than read
+CONTENT_LIMIT = 64 << 20
+
+# Settings of the analysis, as written to settings.dat by the tracking script
+SETTINGS = ['Star', 'EPU', 'Column', 'Suffix']
+
+class Stage:
+
+    def __init__(self, name, command, after=(), settings=(), inputs=(), listings=(), outputs=(), when=None, cache=True):
+        # command is a list of arguments, or a function of the analysis directory, formatted with
+        # the settings as '{Star}'. inputs are files and listings directories, both glob patterns
+        # either relative to the analysis directory or formatted with the settings. outputs are
+        # relative to the analysis directory. when is a function deciding if the stage runs at all
+        # cache=False keeps no copy of the outputs, for stages whose outputs are too large to copy
+        self.name = name
+        self.command = command
+        self.after = list(after)
+        self.settings = list(settings)
+        self.inputs = list(inputs)
+        self.listings = list(listings)
+        self.outputs = list(outputs)
+        self.when = when
+        self.cache = cache
+
+def warehouse_set():
+    return bool(os.environ.get('EPU_WAREHOUSE'))
+
+TRACKING_OUTPUTS = ['squares_all', 'squares_used', 'squares_not_used', 'star', 'settings.dat',
+                    '.squares_all.dat', '.squares_used.dat', '.squares_not.dat', 'squares_all.dat',
+                    'squares_used.dat', 'squares_not_used.dat', 'EPU_structure.dat', '_rln*.dat']
+
+STAGES = [
+    Stage('tracking', ['epu.star_to_epu_tracking_v2.sh', '-e', '{EPU}', '-i', '{Star}', '-s', '{Suffix}', '-c', '{Column}'],
+          settings=SETTINGS, inputs=['{Star}'], listings=['{EPU}/Images-Disc*/GridSquare_*/Data'],
+          outputs=TRACKING_OUTPUTS, cache=False),
+    Stage('index', index.build, after=['tracking'], inputs=['.squares_all.dat'], listings=['squares_all/*_Data'],
+          outputs=[index.INDEX_FILE]),
+    Stage('holes', ['epu.session_holes.py'], after=['index'], settings=['EPU'], inputs=[index.INDEX_FILE],
+          listings=['{EPU}/Metadata'], outputs=['holes.npz']),
+    Stage('heatmaps', ['epu.particle_heatmaps.py'], after=['index'], settings=['Column', 'Suffix'],
+          inputs=['{Star}', index.INDEX_FILE], outputs=['heatmaps']),
+    Stage('image_stats', ['epu.image_stats.py'], after=['index'], inputs=[index.INDEX_FILE], outputs=['image_stats.npz']),
+    Stage('rank', ['epu.rank_squares.py'], after=['image_stats'], settings=['Column', 'Suffix'],
+          inputs=['{Star}', index.INDEX_FILE, 'image_stats.npz', 'quality.npz'],
+          outputs=['squares_ranked.csv', 'foilholes_ranked.csv']),
+    Stage('montages', ['epu.montages.py'], after=['index'], settings=['Column', 'Suffix'],
+          inputs=['{Star}', index.INDEX_FILE], outputs=['montages']),
+    Stage('warehouse', ['epu.warehouse.py', 'publish'], after=['holes', 'heatmaps', 'rank', 'montages'],
+          settings=SETTINGS, inputs=['{Star}', index.INDEX_FILE, '*.npz'], when=warehouse_set),
+]
+
+def pipeline_dir(analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, PIPELINE_DIR)
+
+def expand(pattern, settings, analysis_dir):
+    # Paths matching a pattern, analysis relative unless it names a setting
+    path = pattern.format(**settings)
+    if '{' not in pattern:
+        path = os.path.join(analysis_dir, path)
+    return sorted(glob.glob(path)) if glob.has_magic(path) else [path]
+
+def array_digest(path, digest):
+    # npz files are rewritten with new zip timestamps, so their arrays are hashed instead
+    with np.load(path) as saved:
+        for k in sorted(saved.files):
+            value = saved[k]
+            digest.update(k.encode()+str(value.dtype).encode()+str(value.shape).encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+
+def signature(path, digest):
+    # Content of a file, or its size and mtime when large, the listing of a directory
+    digest.update(path.encode())
+    try:
+        st = os.stat(path)
+    except OSError:
+        digest.update(b'missing')
+        return
+    if os.path.isdir(path):
+        for entry in sorted(os.listdir(path)):
+            digest.update(entry.encode()+b'\0')
+    elif st.st_size > CONTENT_LIMIT:
+        digest.update(('%d %d' % (st.st_size, st.st_mtime_ns)).encode())
+    elif path.endswith('.npz'):
+        try:
+            array_digest(path, digest)
+        except (IOError, ValueError):
+            digest.update(export.file_digest(path).encode())
+    else:
+        digest.update(export.file_digest(path).encode())
+
+def stage_key(stage, settings, analysis_dir=analysis.ANALYSIS_DIR):
+    digest = hashlib.sha1()
+    command = stage.command if isinstance(stage.command, list) else [stage.command.__module__, stage.command.__name__]
+    digest.update(json.dumps([stage.name, command, [settings.get(s) for s in stage.settings]]).encode())
+    for pattern in stage.inputs:
+        for path in expand(pattern, settings, analysis_dir):
+            if os.path.isdir(path):
+                # Directories given as inputs are read in full
+                for root, dirs, files in sorted(os.walk(path)):
+                    dirs.sort()
+                    for f in sorted(files):
+                        signature(os.path.join(root, f), digest)
+            else:
+                signature(path, digest)
+    for pattern in stage.listings:
+        for path in expand(pattern, settings, analysis_dir):
+            signature(path, digest)
+    return digest.hexdigest()[:16]
+
+def outputs(stage, analysis_dir=analysis.ANALYSIS_DIR):
+    # Output paths of a stage present now, relative to the analysis directory
+    found = []
+    for pattern in stage.outputs:
+        if glob.has_magic(pattern):
+            found += sorted(os.path.relpath(p, analysis_dir) for p in glob.glob(os.path.join(analysis_dir, pattern)))
+        elif os.path.lexists(os.path.join(analysis_dir, pattern)):
+            found.append(pattern)
+    return found
+
+def copy_tree(source, target, copier):
+    # Copy a file or directory, keeping links as links and copying files by the fastest method
+    if os.path.islink(source):
+        if os.path.lexists(target):
+            os.remove(target)
+        os.symlink(os.readlink(source), target)
+    elif os.path.isdir(source):
+        os.makedirs(target, exist_ok=True)
+        for entry in os.listdir(source):
+            copy_tree(os.path.join(source, entry), os.path.join(target, entry), copier)
+    else:
+        copier.copy(source, target)
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def read_state(stage, analysis_dir=analysis.ANALYSIS_DIR):
+    try:
+        with open(os.path.join(pipeline_dir(analysis_dir), stage.name+'.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'keys': [], 'outputs': {}}
+
+def write_state(stage, state, analysis_dir=analysis.ANALYSIS_DIR):
+    os.makedirs(pipeline_dir(analysis_dir), exist_ok=True)
+    path = os.path.join(pipeline_dir(analysis_dir), stage.name+'.json')
+    with open(path+'.part', 'w') as f:
+        json.dump(state, f)
+    os.replace(path+'.part', path)
+
+def store(stage, key, analysis_dir=analysis.ANALYSIS_DIR):
+    # Keep the outputs of a run under its key, dropping the oldest keys beyond KEEP
+    state = read_state(stage, analysis_dir)
+    if not stage.cache:
+        # Only the key and output list, so the stage is current until its key changes
+        remove(os.path.join(pipeline_dir(analysis_dir), stage.name))
+        write_state(stage, {'keys': [key], 'outputs': {key: outputs(stage, analysis_dir)}}, analysis_dir)
+        return
+    cache = os.path.join(pipeline_dir(analysis_dir), stage.name, key)
+    remove(cache)
+    os.makedirs(cache)
+    copier = export.Copier()
+    kept = outputs(stage, analysis_dir)
+    for rel in kept:
+        os.makedirs(os.path.dirname(os.path.join(cache, rel)), exist_ok=True)
+        copy_tree(os.path.join(analysis_dir, rel), os.path.join(cache, rel), copier)
+    state['keys'] = [k for k in state['keys'] if k != key]+[key]
+    state['outputs'][key] = kept
+    for old in state['keys'][:-KEEP]:
+        remove(os.path.join(pipeline_dir(analysis_dir), stage.name, old))
+        state['outputs'].pop(old, None)
+    state['keys'] = state['keys'][-KEEP:]
+    write_state(stage, state, analysis_dir)
+
+def current(stage, key, analysis_dir=analysis.ANALYSIS_DIR):
+    # Whether the outputs in place are those of key, which is the newest key of the stage
+    state = read_state(stage, analysis_dir)
+    return bool(state['keys']) and state['keys'][-1] == key and \
+        all(os.path.lexists(os.path.join(analysis_dir, rel)) for rel in state['outputs'].get(key, []))
+
+def restore(stage, key, analysis_dir=analysis.ANALYSIS_DIR):
+    # Put the outputs kept under key in place, False if the key was never kept
+    state = read_state(stage, analysis_dir)
+    cache = os.path.join(pipeline_dir(analysis_dir), stage.name, key)
+    if not stage.cache or key not in state['keys'] or not os.path.isdir(cache):
+        return False
+    for rel in outputs(stage, analysis_dir):
+        remove(os.path.join(analysis_dir, rel))
+    copier = export.Copier()
+    for rel in state['outputs'][key]:
+        copy_tree(os.path.join(cache, rel), os.path.join(analysis_dir, rel), copier)
+    state['keys'] = [k for k in state['keys'] if k != key]+[key]
+    write_state(stage, state, analysis_dir)
+    return True
+
+def touch(stage, analysis_dir=analysis.ANALYSIS_DIR):
+    # Outputs kept or restored are made newer than their inputs, for the readers that compare mtimes
+    for rel in outputs(stage, analysis_dir):
+        path = os.path.join(analysis_dir, rel)
+        if not os.path.islink(path):
+            os.utime(path)
+
+def execute(stage, settings, analysis_dir=analysis.ANALYSIS_DIR):
+    # Run a stage, True if it succeeded, errors are reported and fail only this stage
+    try:
+        if not isinstance(stage.command, list):
+            stage.command(analysis_dir)
+            return True
+        command = [c.format(**settings) for c in stage.command]
+        return subprocess.call(command) == 0
+    except Exception as e:
+        print('Stage '+stage.name+' failed: '+type(e).__name__+': '+str(e))
+        return False
+
+def downstream(stages, names):
+    # Names of the stages after any of names, names included
+    found = set(names)
+    for stage in stages:
+        if found.intersection(stage.after):
+            found.add(stage.name)
+    return found
+
+def run(settings, stages=STAGES, force=(), workers=WORKERS, dry=False, analysis_dir=analysis.ANALYSIS_DIR):
+    # Run the stages in dependency order, concurrently where they can be, returning what was done
+    # with each stage: 'run', 'restored', 'current', 'skipped' when not wanted and 'failed'
+    settings = {s: str(settings.get(s)) for s in SETTINGS}
+    forced = downstream(stages, force)
+    names = set(s.name for s in stages)
+    # Stages after one left out of the graph wait only for those in it
+    done = {a: ('skipped', 0) for s in stages for a in s.after if a not in names}
+    waiting = list(stages)
+    running = {}
+
+    def one(stage):
+        start = time.time()
+        key = stage_key(stage, settings, analysis_dir)
+        if stage.name not in forced:
+            if current(stage, key, analysis_dir):
+                touch(stage, analysis_dir)
+                return 'current', time.time()-start
+            if dry:
+                return ('restored' if stage.cache and key in read_state(stage, analysis_dir)['keys'] else 'run'), 0
+            if restore(stage, key, analysis_dir):
+                touch(stage, analysis_dir)
+                return 'restored', time.time()-start
+        elif dry:
+            return 'run', 0
+        print('Running '+stage.name)
+        if not execute(stage, settings, analysis_dir):
+            return 'failed', time.time()-start
+        store(stage, key, analysis_dir)
+        return 'run', time.time()-start
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while waiting or running:
+            for stage in list(waiting):
+                if any(a not in done for a in stage.after):
+                    continue
+                waiting.remove(stage)
+                if any(done[a][0] == 'failed' for a in stage.after):
+                    done[stage.name] = ('failed', 0)
+                    print(stage.name+': not run, a stage before it failed')
+                    continue
+                if stage.when is not None and not stage.when():
+                    done[stage.name] = ('skipped', 0)
+                    continue
+                # In a dry run nothing is written, so the stages after one that would run are assumed to
+                if dry and any(done[a][0] in ('run', 'restored') for a in stage.after):
+                    done[stage.name] = ('run', 0)
+                    continue
+                running[pool.submit(one, stage)] = stage
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                done[stage.name] = future.result()
+                if not dry:
+                    print(stage.name+': '+done[stage.name][0]+' in '+'%.1f' % done[stage.name][1]+' s')
+    return done
@@ -0,0 +1,139 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Per micrograph quality from Relion CtfFind and MotionCorr outputs, joined to the EPU exposures
+#
+# CtfFind/jobNNN/micrographs_ctf.star              max resolution, figure of merit, astigmatism, defocus
+# MotionCorr/jobNNN/corrected_micrographs.star     total, early and late accumulated motion
+#
+# EPU_analysis/quality.npz     one value per exposure of the index for each column, nan where missing
+
+import os
+
+import numpy as np
+
+from epuanalysis import analysis, star
+
+QUALITY_FILE = 'quality.npz'
+NAME = '_rlnMicrographName'
+
+# Column: (star file column, label in the GUIs, format), in display order
+COLUMNS = {
+    'ctf_resolution': ('_rlnCtfMaxResolution', 'CTF resolution', '%.1f A'),
+    'ctf_fom': ('_rlnCtfFigureOfMerit', 'CTF figure of merit', '%.3f'),
+    'astigmatism': ('_rlnCtfAstigmatism', 'Astigmatism', '%.0f A'),
+    'defocus_ctf': (None, 'CTF defocus', '%.2f um'),
+    'motion_total': ('_rlnAccumMotionTotal', 'Total motion', '%.1f A'),
+    'motion_early': ('_rlnAccumMotionEarly', 'Early motion', '%.1f A'),
+    'motion_late': ('_rlnAccumMotionLate', 'Late motion', '%.1f A'),
+}
+CTF = ['ctf_resolution', 'ctf_fom', 'astigmatism']
+MOTION = ['motion_total', 'motion_early', 'motion_late']
+DEFOCUS = ['_rlnDefocusU', '_rlnDefocusV']
+
+def quality_path(analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, QUALITY_FILE)
+
+def read_ctf(starfile):
+    # Micrograph names and CTF columns of micrographs_ctf.star, defocus as the mean of U and V in um
+    table = star.read_table(starfile, [NAME]+[COLUMNS[c][0] for c in CTF]+DEFOCUS)
+    columns = {c: table[COLUMNS[c][0]] for c in CTF if COLUMNS[c][0] in table}
+    if all(d in table for d in DEFOCUS):
+        columns['defocus_ctf'] = (table[DEFOCUS[0]]+table[DEFOCUS[1]])/2e4
+        if 'astigmatism' not in columns:
+            columns['astigmatism'] = np.abs(table[DEFOCUS[0]]-table[DEFOCUS[1]])
+    return table[NAME], columns
+
+def read_motion(starfile):
+    # Micrograph names and accumulated motion columns of corrected_micrographs.star
+    table = star.read_table(starfile, [NAME]+[COLUMNS[c][0] for c in MOTION])
+    return table[NAME], {c: table[COLUMNS[c][0]] for c in MOTION if COLUMNS[c][0] in table}
+
+def join(index, names, columns, suffix=None):
+    # Columns given per micrograph onto the exposures of the index, nan where no micrograph matched
+    joined = {c: np.full(len(index), np.nan) for c in columns}
+    if not len(names):
+        return joined, 0
+    unique, inverse = np.unique(names, return_inverse=True)
+    at = index.find([star.micrograph_name(n, suffix) for n in unique])[inverse]
+    hit = at >= 0
+    for c, values in columns.items():
+        joined[c][at[hit]] = values[hit]
+    return joined, int(hit.sum())
+
+def save_quality(index, columns, sources, analysis_dir=analysis.ANALYSIS_DIR):
+    np.savez(quality_path(analysis_dir), names=index.names, sources=np.array(sources, dtype=str), **columns)
+    return quality_path(analysis_dir)
+
+def nanmean(group, values, ngroups):
+    # Mean of the finite values of each group, nan for groups without any
+    ok = np.isfinite(values)
+    total = np.bincount(group[ok], weights=values[ok], minlength=ngroups)
+    number = np.bincount(group[ok], minlength=ngroups)
+    return np.divide(total, number, out=np.full(ngroups, np.nan), where=number > 0)
+
+class Quality:
+    # Lookup of the quality store by exposure, with per square and per FoilHole means
+    def __init__(self, index, saved):
+        self.index = index
+        self.columns = {c: saved[c] for c in COLUMNS if c in saved.files}
+        if len(saved['names']) != len(index) or (saved['names'] != index.names).any():
+            # Index rebuilt since, carry the values over by name
+            at = index.find(saved['names'])
+            hit = at >= 0
+            for c, values in self.columns.items():
+                self.columns[c] = np.full(len(index), np.nan)
+                self.columns[c][at[hit]] = values[hit]
+        self._squares = {}
+        self._holes = {}
+
+    def exposure(self, name, column):
+        # Value for one exposure name, nan if unknown
+        i = self.index.lookup().get(name)
+        return np.nan if i is None else float(self.columns[column][i])
+
+    def per_square(self, column):
+        if column not in self._squares:
+            self._squares[column] = nanmean(self.index.square, self.columns[column], len(self.index.squares))
+        return self._squares[column]
+
+    def per_foilhole(self, column, foilholes):
+        # Mean over the exposures of each FoilHole id
+        if column not in self._holes:
+            table, group = np.unique(self.index.foilhole, return_inverse=True)
+            self._holes[column] = table, nanmean(group, self.columns[column], len(table))
+        table, means = self._holes[column]
+        foilholes = np.asarray(foilholes)
+        at = np.minimum(np.searchsorted(table, foilholes), len(table)-1)
+        return np.where(table[at] == foilholes, means[at], np.nan) if len(table) else np.full(len(foilholes), np.nan)
+
+def load_quality(index, analysis_dir=analysis.ANALYSIS_DIR, source=None):
+    # Quality for an analysis, None if epu.micrograph_quality.py has not been run
+    try:
+        with (source or np).load(quality_path(analysis_dir)) as saved:
+            return Quality(index, saved)
+    except IOError:
+        return None
+
+def describe(column, value):
+    # 'CTF resolution 4.2 A'
+    label, fmt = COLUMNS[column][1:]
+    return label+' '+('-' if not np.isfinite(value) else fmt % value)
@@ -0,0 +1,119 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Ranking of GridSquares and FoilHoles by particle yield
+#
+# Each exposure is scored by its particle count relative to the mean count of exposures
+# taken at a similar defocus, since more particles are picked further from focus. A score
+# of 1 is an average exposure for the session. Squares and FoilHoles are scored by the
+# mean of their exposures, and also report survival, the fraction of exposures with particles
+
+import csv
+import os
+
+import numpy as np
+
+from epuanalysis import analysis, keys
+
+# Defocus bin width for the expected particle count (um)
+DEFOCUS_BIN = 0.25
+
+def exposure_scores(counts, defocus=None, binwidth=DEFOCUS_BIN):
+    # Particle counts relative to the mean count at the same defocus
+    counts = np.asarray(counts, dtype=float)
+    if len(counts) == 0:
+        return counts
+    if defocus is None:
+        defocus = np.full(len(counts), np.nan)
+    defocus = np.asarray(defocus, dtype=float)
+    known = np.isfinite(defocus)
+    bins = np.zeros(len(counts), dtype=int)
+    if known.any():
+        bins[known] = 1+np.floor((defocus[known]-defocus[known].min())/binwidth).astype(int)
+    # Unknown defocus falls back to the session mean, in bin 0
+    total = np.bincount(bins, weights=counts)
+    number = np.bincount(bins)
+    total[0], number[0] = counts.sum(), len(counts)
+    expected = np.divide(total, number, out=np.zeros(len(total)), where=number > 0)[bins]
+    return np.divide(counts, expected, out=np.zeros(len(counts)), where=expected > 0)
+
+def aggregate(group, counts, scores, ngroups=None):
+    # Per group exposures, exposures with particles, particles, survival, particles per exposure and score
+    group = np.asarray(group, dtype=int)
+    counts = np.asarray(counts, dtype=float)
+    n = np.bincount(group, minlength=ngroups or 0).astype(float)
+    used = np.bincount(group, weights=counts > 0, minlength=ngroups or 0)
+    particles = np.bincount(group, weights=counts, minlength=ngroups or 0)
+    score = np.bincount(group, weights=scores, minlength=ngroups or 0)
+    per = lambda x: np.divide(x, n, out=np.zeros(len(n)), where=n > 0)
+    return {'exposures': n.astype(int),
+            'exposures_used': used.astype(int),
+            'particles': particles.astype(int),
+            'survival': per(used),
+            'particles_per_exposure': per(particles),
+            'score': per(score)}
+
+def rank(score):
+    # Indices from best to worst
+    return np.argsort(-np.asarray(score), kind='stable')
+
+def rank_session(squares, names, index, counts, defocus=None):
+    # Square and FoilHole tables for a session
+    # squares: square jpg paths; names, index: exposure names and the square index of each
+    # counts: particles per exposure; defocus: per exposure defocus (um) or None
+    index = np.asarray(index, dtype=int)
+    scores = exposure_scores(counts, defocus)
+    sq = aggregate(index, counts, scores, len(squares))
+    sq['square'] = np.array([analysis.square_name(s) for s in squares], dtype=object)
+
+    holeids = keys.foilhole_ids(names)
+    holes, first, hole = np.unique(holeids, return_index=True, return_inverse=True)
+    fh = aggregate(hole, counts, scores, len(holes))
+    fh['foilhole'] = holes
+    fh['square'] = sq['square'][index[first]] if len(holes) else np.zeros(0, dtype=object)
+    return sq, fh
+
+def write_table(path, table, columns, order):
+    # csv with a rank column, rows in rank order
+    with open(path, 'w', newline='') as f:
+        out = csv.writer(f)
+        out.writerow(['rank']+columns)
+        for r, i in enumerate(order):
+            row = [r+1]
+            for c in columns:
+                value = table[c][i]
+                row.append('%.4g' % value if isinstance(value, (float, np.floating)) else value)
+            out.writerow(row)
+    return path
+
+# Mean CTF and motion quality, when epu.micrograph_quality.py has been run
+QUALITY_COLUMNS = ['ctf_resolution', 'astigmatism', 'motion_total']
+SQUARE_COLUMNS = ['square', 'score', 'survival', 'particles_per_exposure', 'particles',
+                  'exposures', 'exposures_used', 'grey_mean', 'grey_std']+QUALITY_COLUMNS
+FOILHOLE_COLUMNS = ['foilhole', 'square', 'score', 'survival', 'particles_per_exposure', 'particles',
+                    'exposures', 'exposures_used']+QUALITY_COLUMNS
+
+def write_rankings(sq, fh, analysis_dir=analysis.ANALYSIS_DIR):
+    sqout = write_table(os.path.join(analysis_dir, 'squares_ranked.csv'), sq,
+                        [c for c in SQUARE_COLUMNS if c in sq], rank(sq['score']))
+    fhout = write_table(os.path.join(analysis_dir, 'foilholes_ranked.csv'), fh,
+                        [c for c in FOILHOLE_COLUMNS if c in fh], rank(fh['score']))
+    return sqout, fhout
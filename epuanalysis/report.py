@@ -0,0 +1,221 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Static HTML session report of an EPU analysis
+#
+# EPU_report/index.html                          squares, most particles first, with used/not used and stats
+# EPU_report/squares/<square>/index.html         square image, particle heatmap layer, FoilHoles and micrographs
+# EPU_report/squares/<square>/square.webp        thumbnails, webp where PIL supports it, jpeg otherwise
+# EPU_report/squares/<square>/heatmap.png        overlay layer from epu.particle_heatmaps.py
+# EPU_report/manifest.json                       signature of the inputs of every rendered square
+#
+# Squares are rendered on a process pool. A square is only rendered again when its signature,
+# made from the path, size and mtime of every input image, its particle counts and the page
+# layout version, changes.
+
+import hashlib
+import html
+import json
+import os
+import shutil
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from epuanalysis import analysis, heatmap, images, keys, storage
+
+REPORT_DIR = 'EPU_report'
+MANIFEST = 'manifest.json'
+
+# Thumbnail sizes (px)
+SQUARE_SIZE = 800
+FOILHOLE_SIZE = 200
+
+# Bumped when the square page markup changes, so pages written before are rendered again
+LAYOUT = 2
+MICROGRAPH_SIZE = 200
+
+STYLE = """body { font-family: sans-serif; margin: 1em; }
+table { border-collapse: collapse; }
+td, th { padding: 2px 8px; text-align: right; }
+td:first-child, th:first-child { text-align: left; }
+tr:nth-child(even) { background: #eee; }
+.used { color: #070; } .notused { color: #a00; }
+.layers { position: relative; display: inline-block; }
+.layers img.overlay { position: absolute; left: 0; top: 0; width: 100%; height: 100%; }
+#heat:not(:checked) ~ .layers img.overlay { display: none; }
+.hole { display: inline-block; vertical-align: top; margin: 4px; padding: 4px; border: 1px solid #ccc; }
+.hole img { display: block; }
+.mics img { display: inline-block; margin: 1px; }
+.caption { font-size: small; }
+"""
+
+def image_format():
+    # webp is much smaller than jpeg for the same quality, where PIL was built with it
+    from PIL import features
+    return 'webp' if features.check('webp') else 'jpeg'
+
+def signature(paths, counts, fmt):
+    # Hash of the inputs of a square, paths that cannot be stat'ed hash as missing
+    stats = storage.storage().map(_stat, paths)
+    h = hashlib.sha1((fmt+' %d' % LAYOUT).encode())
+    for path, st in zip(paths, stats):
+        h.update(('%s %s\n' % (path, st)).encode())
+    h.update(json.dumps(counts, sort_keys=True).encode())
+    return h.hexdigest()
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return '%d %d' % (st.st_size, st.st_mtime_ns)
+    except OSError:
+        return 'missing'
+
+def save_thumbnail(path, outpath, size, fmt):
+    try:
+        images.thumbnail(path, size).save(outpath, fmt, quality=85)
+        return True
+    except (IOError, OSError):
+        print(path+' could not be read')
+        return False
+
+def render_square(job):
+    # Write the thumbnails, layers and page of one square
+    outdir = job['outdir']
+    ext = job['fmt'][:4]
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(outdir)
+    save_thumbnail(job['square'], os.path.join(outdir, 'square.'+ext), SQUARE_SIZE, job['fmt'])
+    overlay = job['heatmap'] and os.path.isfile(job['heatmap'])
+    if overlay:
+        shutil.copyfile(job['heatmap'], os.path.join(outdir, 'heatmap.png'))
+
+    holes = []
+    for hole, mics in job['holes']:
+        holename = analysis.exposure_name(hole)
+        save_thumbnail(hole, os.path.join(outdir, holename+'.'+ext), FOILHOLE_SIZE, job['fmt'])
+        cells = []
+        for mic, count in mics:
+            micname = analysis.exposure_name(mic)
+            save_thumbnail(mic, os.path.join(outdir, micname+'.'+ext), MICROGRAPH_SIZE, job['fmt'])
+            cells.append('<a href="%s.%s" title="%s: %d particles"><img src="%s.%s" width="%d" loading="lazy"></a>' %
+                         (micname, ext, html.escape(micname), count, micname, ext, MICROGRAPH_SIZE//2))
+        particles = sum(count for _, count in mics)
+        holes.append('<div class="hole"><img src="%s.%s" width="%d" loading="lazy">'
+                     '<div class="caption">%s<br>%d micrographs, %d particles</div><div class="mics">%s</div></div>' %
+                     (holename, ext, FOILHOLE_SIZE, html.escape(holename), len(mics), particles, ''.join(cells)))
+
+    stats = ''.join('<tr><th>%s</th><td>%s</td></tr>' % (html.escape(k), html.escape(str(v))) for k, v in job['stats'])
+    page = ['<!DOCTYPE html><html><head><meta charset="utf-8"><title>%s</title>' % html.escape(job['name']),
+            '<link rel="stylesheet" href="../../style.css"></head><body>',
+            '<p><a href="../../index.html">All squares</a></p><h1>%s</h1>' % html.escape(job['name']),
+            '<table>%s</table>' % stats]
+    # The toggle and the layers share one div, the CSS sibling selector needs them side by side
+    page.append('<div>')
+    if overlay:
+        page.append('<input type="checkbox" id="heat" checked><label for="heat">Particle heatmap</label><br>')
+    page.append('<div class="layers"><img src="square.%s" width="%d">' % (ext, SQUARE_SIZE))
+    if overlay:
+        page.append('<img class="overlay" src="heatmap.png">')
+    page.append('</div></div>')
+    page.append('<h2>FoilHoles (%d)</h2>%s</body></html>' % (len(holes), ''.join(holes)))
+    with open(os.path.join(outdir, 'index.html'), 'w') as f:
+        f.write('\n'.join(page))
+    return job['name']
+
+def export(counts, outdir=REPORT_DIR, analysis_dir=analysis.ANALYSIS_DIR, workers=None, force=False):
+    # Render the report, only squares whose inputs changed since the last export
+    fmt = image_format()
+    squares = analysis.square_images('all', analysis_dir)
+    # The used list holds squares_used paths, matched to squares_all by square name
+    used = set(analysis.square_name(sq) for sq in analysis.square_images('used', analysis_dir))
+    holes = analysis.listing(squares, '_FoilHoles/*.jpg')
+    mics = analysis.listing(squares, '_Data/*.jpg')
+    stats = images.load_stats(analysis_dir)
+
+    manifest_path = os.path.join(outdir, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+    if force:
+        manifest = {}
+    os.makedirs(os.path.join(outdir, 'squares'), exist_ok=True)
+
+    rows = []
+    jobs = []
+    signatures = {}
+    for sq, sqholes, sqmics in zip(squares, holes, mics):
+        name = analysis.square_name(sq)
+        # Micrographs grouped under their FoilHole
+        byhole = defaultdict(list)
+        for mic, hole in zip(sqmics, keys.foilhole_ids(sqmics)):
+            byhole[hole].append((mic, counts.get(analysis.exposure_name(mic), 0)))
+        grouped = [(hole, byhole.get(i, [])) for hole, i in zip(sqholes, keys.foilhole_ids(sqholes))]
+        miccounts = [counts.get(analysis.exposure_name(mic), 0) for mic in sqmics]
+        particles = sum(miccounts)
+        nused = sum(1 for c in miccounts if c > 0)
+        grey = stats.get(sq) if stats is not None else float('nan')
+        row = {'name': name, 'used': name in used, 'holes': len(sqholes),
+               'micrographs': len(sqmics), 'with_particles': nused, 'particles': particles, 'grey': grey}
+        rows.append(row)
+        job = {'name': name, 'square': sq, 'heatmap': heatmap.heatmap_path(sq, analysis_dir), 'holes': grouped,
+               'outdir': os.path.join(outdir, 'squares', name), 'fmt': fmt,
+               'stats': [('Used in star file', 'yes' if row['used'] else 'no'), ('FoilHoles', row['holes']),
+                         ('Micrographs', row['micrographs']), ('Micrographs with particles', nused),
+                         ('Particles', particles), ('Mean greyscale', '%.1f' % grey)]}
+        sig = signature([sq, job['heatmap']]+sqholes+sqmics, miccounts+[job['stats']], fmt)
+        signatures[name] = sig
+        if manifest.get(name) != sig or not os.path.isfile(os.path.join(job['outdir'], 'index.html')):
+            jobs.append(job)
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for done in pool.map(render_square, jobs):
+                manifest[done] = signatures[done]
+                # Keep the manifest current so an interrupted export resumes where it stopped
+                with open(manifest_path, 'w') as f:
+                    json.dump(manifest, f)
+
+    write_index(outdir, rows)
+    with open(manifest_path, 'w') as f:
+        json.dump({r['name']: manifest.get(r['name']) for r in rows}, f)
+    return len(rows), len(jobs)
+
+def write_index(outdir, rows):
+    with open(os.path.join(outdir, 'style.css'), 'w') as f:
+        f.write(STYLE)
+    # Best squares first
+    rows = sorted(rows, key=lambda r: (-r['particles'], r['name']))
+    lines = ['<!DOCTYPE html><html><head><meta charset="utf-8"><title>EPU session report</title>',
+             '<link rel="stylesheet" href="style.css"></head><body><h1>EPU session report</h1>',
+             '<p>%d squares, %d used in star file</p>' % (len(rows), sum(r['used'] for r in rows)),
+             '<table><tr><th>Square</th><th>Used</th><th>FoilHoles</th><th>Micrographs</th>'
+             '<th>With particles</th><th>Particles</th><th>Greyscale</th></tr>']
+    for r in rows:
+        lines.append('<tr><td><a href="squares/%s/index.html">%s</a></td><td class="%s">%s</td>'
+                     '<td>%d</td><td>%d</td><td>%d</td><td>%d</td><td>%.1f</td></tr>' %
+                     (r['name'], html.escape(r['name']), 'used' if r['used'] else 'notused',
+                      'yes' if r['used'] else 'no', r['holes'], r['micrographs'], r['with_particles'],
+                      r['particles'], r['grey']))
+    lines.append('</table></body></html>')
+    with open(os.path.join(outdir, 'index.html'), 'w') as f:
+        f.write('\n'.join(lines))
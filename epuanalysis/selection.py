@@ -0,0 +1,134 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Selections of exposures by square, FoilHole or acquisition metadata, for filtering star files
+#
+# EPU_analysis/excluded.dat      squares and FoilHoles marked in the inspector, one per line
+#                                  square GridSquare_20210806_120003
+#                                  foilhole 5000001
+
+import operator
+import os
+import re
+
+import numpy as np
+
+from epuanalysis import analysis, metadata, quality, star
+
+EXCLUDED_FILE = 'excluded.dat'
+
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+             '==': operator.eq, '!=': operator.ne}
+CONDITION = re.compile(r'^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*(\S+)\s*$')
+
+def excluded_path(analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, EXCLUDED_FILE)
+
+def read_excluded(analysis_dir=analysis.ANALYSIS_DIR):
+    # Square names and FoilHole ids marked as excluded
+    squares, foilholes = set(), set()
+    try:
+        with open(excluded_path(analysis_dir)) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and fields[0] == 'square':
+                    squares.add(fields[1])
+                elif len(fields) == 2 and fields[0] == 'foilhole':
+                    foilholes.add(int(fields[1]))
+    except IOError:
+        pass
+    return squares, foilholes
+
+def write_excluded(squares, foilholes, analysis_dir=analysis.ANALYSIS_DIR):
+    with open(excluded_path(analysis_dir), 'w') as f:
+        for name in sorted(squares):
+            f.write('square '+name+'\n')
+        for ref in sorted(foilholes):
+            f.write('foilhole '+str(ref)+'\n')
+
+def set_excluded(kind, value, excluded, analysis_dir=analysis.ANALYSIS_DIR):
+    # Mark or clear one square name or FoilHole id
+    squares, foilholes = read_excluded(analysis_dir)
+    marked = squares if kind == 'square' else foilholes
+    if excluded:
+        marked.add(value)
+    else:
+        marked.discard(value)
+    write_excluded(squares, foilholes, analysis_dir)
+
+def parse_condition(text):
+    # 'defocus<-2.5' -> ('defocus', operator.lt, -2.5) on a numeric metadata field or quality column
+    match = CONDITION.match(text)
+    if not match:
+        raise ValueError('Condition '+text+' is not of the form field<value, e.g. defocus<-2.5')
+    field, op, value = match.groups()
+    if field not in numeric_fields():
+        raise ValueError('Unknown numeric field '+field+', one of '+', '.join(numeric_fields()))
+    return field, OPERATORS[op], float(value)
+
+def numeric_fields():
+    # Metadata fields and quality columns from epu.micrograph_quality.py
+    return [f for f, (_, scale) in metadata.FIELDS.items() if scale is not None]+list(quality.COLUMNS)
+
+def exposure_xmls(index):
+    # Metadata file of every exposure of the index
+    data = [os.path.splitext(sq)[0]+'_Data/' for sq in index.squares]
+    return [data[s]+n+'.xml' for s, n in zip(index.square, index.names)]
+
+def condition_mask(index, conditions, analysis_dir=analysis.ANALYSIS_DIR):
+    # Exposures meeting all conditions, exposures missing a field never match
+    if not conditions:
+        return np.zeros(len(index), dtype=bool)
+    fields = sorted({field for field, _, _ in conditions})
+    columns = {}
+    if any(f in quality.COLUMNS for f in fields):
+        qual = quality.load_quality(index, analysis_dir)
+        if qual is None:
+            raise ValueError('No quality store, run epu.micrograph_quality.py')
+        columns = {f: qual.columns.get(f, np.full(len(index), np.nan)) for f in fields if f in quality.COLUMNS}
+    xml = [f for f in fields if f not in columns]
+    if xml:
+        values = metadata.read_many(exposure_xmls(index), xml)
+        columns.update({f: np.array([np.nan if v[f] is None else v[f] for v in values], dtype=float) for f in xml})
+    mask = np.ones(len(index), dtype=bool)
+    with np.errstate(invalid='ignore'):
+        for field, op, value in conditions:
+            mask &= op(columns[field], value)
+    return mask
+
+def select(index, squares=(), foilholes=(), conditions=()):
+    # Exposures on any of the squares (names or paths) or FoilHole ids, or meeting the conditions
+    names = {analysis.square_name(sq) for sq in squares}
+    on_square = np.array([analysis.square_name(sq) in names for sq in index.squares], dtype=bool)
+    mask = on_square[index.square] if len(index.squares) else np.zeros(len(index), dtype=bool)
+    mask |= np.isin(index.foilhole, np.fromiter(foilholes, dtype=np.int64))
+    return mask | condition_mask(index, conditions)
+
+def write_subset(starfile, outfile, index, mask, drop=True, column='_rlnMicrographName', suffix=None):
+    # Stream starfile to outfile without (drop) or with only (not drop) the particles of the
+    # selected exposures. Micrographs matching no exposure of the index are never selected
+    # filter_rows asks once per distinct micrograph
+    selected = set(index.names[mask].tolist())
+
+    def keep(value):
+        return (star.micrograph_name(value, suffix) in selected) != drop
+
+    return star.filter_rows(starfile, outfile, keep, column)
@@ -0,0 +1,170 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# EPU session metadata, EpuSession.dm and Metadata/GridSquare_<id>.dm
+# The .dm files are DataContract xml. Each GridSquare .dm holds every hole targeted on the
+# square, acquired or not, with its stage position, pixel centre on the square image and size.
+# They are read with iterparse, clearing each target once read, so one pass per file is enough
+#
+# EPU_analysis/holes.npz      every targeted hole of the analysis squares, see TARGET
+
+import glob
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from epuanalysis import analysis, storage
+
+HOLES_FILE = 'holes.npz'
+METADATA_DIR = 'Metadata'
+SESSION_FILE = 'EpuSession.dm'
+
+# A targeted hole, stage in microns, pixel centre and diameter on the square image
+TARGET = np.dtype([('foilhole', '<i8'), ('stage_x', '<f8'), ('stage_y', '<f8'), ('pixel_x', '<f8'),
+                   ('pixel_y', '<f8'), ('diameter', '<f8'), ('selected', '?'), ('near_grid_bar', '?')])
+
+def local(tag):
+    # Tag without its namespace
+    return tag.rsplit('}', 1)[-1]
+
+def children(elem):
+    return {local(c.tag): c for c in elem}
+
+def number(elem, name, scale=1.0):
+    found = None if elem is None else children(elem).get(name)
+    try:
+        return float(found.text)*scale
+    except (AttributeError, TypeError, ValueError):
+        return np.nan
+
+def flag(elem, name):
+    found = children(elem).get(name)
+    return found is not None and (found.text or '').strip().lower() == 'true'
+
+def target(pair):
+    # One KeyValuePairOfintTargetLocation... element as a TARGET row
+    parts = children(pair)
+    value = parts.get('value')
+    fields = children(value) if value is not None else {}
+    stage = fields.get('StagePosition')
+    pixel = fields.get('PixelCenter')
+    size = fields.get('PixelWidthHeight')
+    return (int(parts['key'].text), number(stage, 'X', 1e6), number(stage, 'Y', 1e6),
+            number(pixel, 'x'), number(pixel, 'y'), number(size, 'width'),
+            value is not None and flag(value, 'Selected'), value is not None and flag(value, 'IsNearGridBar'))
+
+def square_targets(dmfile):
+    # Every hole targeted on a square from its GridSquare .dm
+    rows = []
+    if not os.path.isfile(dmfile):
+        return np.zeros(0, dtype=TARGET)
+    try:
+        for _, elem in ET.iterparse(dmfile):
+            if local(elem.tag).startswith('KeyValuePairOfintTargetLocation'):
+                try:
+                    rows.append(target(elem))
+                except (KeyError, AttributeError, ValueError):
+                    pass
+                elem.clear()
+    except (IOError, ET.ParseError) as e:
+        print(str(dmfile)+' could not be read: '+str(e))
+    return np.array(rows, dtype=TARGET)
+
+def read_session(epu_dir):
+    # Name and GridSquare ids of a session from EpuSession.dm, with the squares that have a
+    # .dm in Metadata, which EPU writes for every square it has targeted holes on
+    info = {'name': None, 'squares': set()}
+    try:
+        for _, elem in ET.iterparse(os.path.join(epu_dir, SESSION_FILE)):
+            name = local(elem.tag)
+            if name == 'Name' and info['name'] is None and elem.text:
+                info['name'] = elem.text.strip()
+            elif name.startswith('KeyValuePairOf') and 'GridSquare' in name:
+                key = children(elem).get('key')
+                if key is not None and (key.text or '').strip().isdigit():
+                    info['squares'].add(int(key.text))
+                elem.clear()
+    except (IOError, ET.ParseError) as e:
+        print(SESSION_FILE+' could not be read: '+str(e))
+    for dm in glob.glob(os.path.join(epu_dir, METADATA_DIR, 'GridSquare_*.dm')):
+        info['squares'].add(square_id(dm))
+    info['squares'].discard(-1)
+    return info
+
+def square_id(path):
+    # GridSquare id from a .dm name or the GridSquare_<id> directory holding a square image
+    name = os.path.splitext(os.path.basename(path))[0]
+    if not name.startswith('GridSquare_') or not name[11:].isdigit():
+        name = os.path.basename(os.path.dirname(os.path.realpath(path)))
+    try:
+        return int(name.split('_')[1])
+    except (IndexError, ValueError):
+        return -1
+
+def square_dm(squarepath, epu_dir):
+    return os.path.join(epu_dir, METADATA_DIR, 'GridSquare_'+str(square_id(squarepath))+'.dm')
+
+def holes_path(analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, HOLES_FILE)
+
+def build_holes(index, epu_dir, analysis_dir=analysis.ANALYSIS_DIR):
+    # Targeted holes of every square of the index, marked acquired where the index has exposures
+    dms = [square_dm(sq, epu_dir) for sq in index.squares]
+    parts = storage.storage().map(square_targets, dms)
+    holes = np.concatenate([p for p in parts]+[np.zeros(0, dtype=TARGET)])
+    square = np.repeat(np.arange(len(dms)), [len(p) for p in parts])
+    # A hole id is acquired on a square if any exposure of the square came from it
+    acquired = np.isin(square*(1 << 40)+holes['foilhole'], index.square.astype(np.int64)*(1 << 40)+index.foilhole)
+    np.savez(holes_path(analysis_dir), squares=index.squares, square=square, acquired=acquired,
+             **{f: holes[f] for f in TARGET.names})
+    return load_holes(analysis_dir)
+
+class Holes:
+
+    def __init__(self, saved):
+        self.squares = saved['squares']
+        self.square = saved['square']
+        self.acquired = saved['acquired']
+        self.targets = np.zeros(len(self.square), dtype=TARGET)
+        for f in TARGET.names:
+            self.targets[f] = saved[f]
+        self.bounds = np.searchsorted(self.square, np.arange(len(self.squares)+1))
+        self.position = {os.path.normpath(sq): i for i, sq in enumerate(self.squares)}
+
+    def __len__(self):
+        return len(self.square)
+
+    def of_square(self, squarepath):
+        # Targets of a square and whether each was acquired, None if the square has none stored
+        i = self.position.get(os.path.normpath(squarepath))
+        if i is None or self.bounds[i] == self.bounds[i+1]:
+            return None
+        part = slice(self.bounds[i], self.bounds[i+1])
+        return self.targets[part], self.acquired[part]
+
+def load_holes(analysis_dir=analysis.ANALYSIS_DIR, source=None):
+    # Stored targets, None if the session metadata has not been read
+    try:
+        with (source or np).load(holes_path(analysis_dir)) as saved:
+            return Holes(saved)
+    except (IOError, KeyError):
+        return None
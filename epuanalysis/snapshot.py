@@ -0,0 +1,225 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Single file snapshots of an analysis, for browsing away from the EPU storage
+# EPU_analysis is a tree of links back into the EPU directory. A snapshot is one zip holding the
+# analysis files themselves, the metadata of every linked xml as a table, and every linked jpg
+# at the inspector's display size and as a small thumbnail. Images are stored uncompressed in
+# the zip, as jpgs, so they are read straight from a memory map of the file
+#
+# manifest.json                          version, levels and what was packed
+# metadata.npz                           path and FIELDS of every linked xml
+# files/EPU_analysis/...                 regular files of the analysis, stores, lists and overlays
+# pyramid/<size>/EPU_analysis/...jpg     linked jpgs reduced to size px
+#
+# A Snapshot answers isfile, glob, open, record and load as os.path, glob, open, metadata
+# and np.load do for the analysis directory, with the paths the analysis lists
+
+import fnmatch
+import io
+import json
+import mmap
+import os
+import struct
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from epuanalysis import analysis, images, metadata
+
+VERSION = 1
+# Pyramid levels, the first is the size the inspector displays
+LEVELS = [400, 128]
+QUALITY = 85
+# Regular files larger than this are left out, e.g. star file copies
+MAX_FILE = 64 << 20
+
+def norm(path):
+    return os.path.normpath(str(path).strip())
+
+def pyramid(path, levels=LEVELS, quality=QUALITY):
+    # Process pool worker, jpg bytes of an image at each level
+    out = []
+    try:
+        for size in levels:
+            buffer = io.BytesIO()
+            images.thumbnail(path, size).save(buffer, 'JPEG', quality=quality)
+            out.append(buffer.getvalue())
+    except (IOError, OSError) as e:
+        print(str(path)[:80]+' could not be read: '+str(e))
+        return None
+    return out
+
+def metadata_table(xmls):
+    # FIELDS of many xml files as columns, nan or '' where missing
+    records = metadata.read_many(xmls) if xmls else []
+    table = {'path': np.array([norm(x) for x in xmls], dtype=str)}
+    for field, (_, scale) in metadata.FIELDS.items():
+        values = [r[field] for r in records]
+        if scale is None:
+            table[field] = np.array(['' if v is None else str(v) for v in values], dtype=str)
+        else:
+            table[field] = np.array([np.nan if v is None else v for v in values], dtype=float)
+    return table
+
+def gather(analysis_dir=analysis.ANALYSIS_DIR, max_file=MAX_FILE):
+    # Regular files, linked jpgs and linked xmls of an analysis
+    # Links outside squares_all duplicate it and are left out
+    files, jpgs, xmls, skipped = [], [], [], []
+    linked = os.path.join(norm(analysis_dir), 'squares_all')
+    for top, dirs, names in os.walk(analysis_dir):
+        dirs.sort()
+        for name in sorted(names):
+            path = norm(os.path.join(top, name))
+            if os.path.islink(path):
+                if not path.startswith(linked+os.sep):
+                    continue
+                ext = os.path.splitext(name)[1].lower()
+                if ext == '.jpg':
+                    jpgs.append(path)
+                elif ext == '.xml':
+                    xmls.append(path)
+            elif os.path.getsize(path) <= max_file:
+                files.append(path)
+            else:
+                skipped.append(path)
+    return files, jpgs, xmls, skipped
+
+def export(outpath, analysis_dir=analysis.ANALYSIS_DIR, levels=LEVELS, workers=None, max_file=MAX_FILE):
+    # Write a snapshot of an analysis, returns counts of what was packed
+    files, jpgs, xmls, skipped = gather(analysis_dir, max_file)
+    counts = {'files': len(files), 'images': 0, 'xml': len(xmls), 'skipped': skipped}
+    partial = outpath+'.tmp'
+    with zipfile.ZipFile(partial, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as out:
+        for path in files:
+            out.write(path, 'files/'+path.replace(os.sep, '/'))
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **metadata_table(xmls))
+        out.writestr('metadata.npz', buffer.getvalue(), zipfile.ZIP_STORED)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for path, levelled in zip(jpgs, pool.map(pyramid, jpgs, [levels]*len(jpgs), chunksize=8)):
+                if levelled is None:
+                    continue
+                for size, data in zip(levels, levelled):
+                    out.writestr('pyramid/'+str(size)+'/'+path.replace(os.sep, '/'), data, zipfile.ZIP_STORED)
+                counts['images'] += 1
+        manifest = {'version': VERSION, 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'analysis': norm(analysis_dir),
+                    'levels': levels, 'files': counts['files'], 'images': counts['images'], 'xml': counts['xml'],
+                    'settings': analysis.read_settings(analysis_dir)}
+        out.writestr('manifest.json', json.dumps(manifest, indent=1))
+    os.replace(partial, outpath)
+    return counts
+
+class Snapshot:
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path)
+        self.members = {info.filename: info for info in self.zip.infolist()}
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.manifest = json.loads(bytes(self.read('manifest.json')))
+        if self.manifest.get('version', 0) > VERSION:
+            print(path+' was written by a newer version, some contents may not be read')
+        self.levels = self.manifest['levels']
+        self.analysis_dir = self.manifest['analysis']
+        # Analysis path -> member, for files and for images at the display level
+        self.files = {m[6:]: m for m in self.members if m.startswith('files/')}
+        display = 'pyramid/'+str(self.levels[0])+'/'
+        self.images = {m[len(display):]: m for m in self.members if m.startswith(display)}
+        self._table = None
+        self._names = None
+
+    def member(self, path):
+        path = norm(path).replace(os.sep, '/')
+        return self.files.get(path) or self.images.get(path)
+
+    def read(self, member):
+        # Contents of a member, stored members as a view of the memory map
+        info = self.members[member]
+        if info.compress_type != zipfile.ZIP_STORED:
+            return self.zip.read(info)
+        header = self.map[info.header_offset:info.header_offset+30]
+        namelen, extralen = struct.unpack('<HH', header[26:30])
+        start = info.header_offset+30+namelen+extralen
+        return memoryview(self.map)[start:start+info.file_size]
+
+    def table(self):
+        # Metadata table, read on first use
+        if self._table is None:
+            with np.load(io.BytesIO(self.read('metadata.npz'))) as saved:
+                self._table = {name: saved[name] for name in saved.files}
+            self._rows = {p: i for i, p in enumerate(self._table['path'])}
+        return self._table
+
+    def names(self):
+        if self._names is None:
+            self._names = sorted(set(self.files) | set(self.images) | set(self.table()['path']))
+        return self._names
+
+    ## As os.path.isfile, glob.glob, open, metadata.record and np.load on the analysis
+
+    def isfile(self, path):
+        self.table()
+        return self.member(path) is not None or norm(path) in self._rows
+
+    def glob(self, pattern, recursive=False):
+        return fnmatch.filter(self.names(), norm(pattern))
+
+    def open(self, path, mode='r'):
+        member = self.member(path)
+        if member is None:
+            raise FileNotFoundError(path+' is not in '+self.path)
+        data = io.BytesIO(self.read(member))
+        return data if 'b' in mode else io.TextIOWrapper(data)
+
+    def record(self, xmlfile):
+        table = self.table()
+        i = self._rows.get(norm(xmlfile))
+        if i is None:
+            raise FileNotFoundError(xmlfile+' is not in '+self.path)
+        values = {}
+        for field, (_, scale) in metadata.FIELDS.items():
+            v = table[field][i]
+            values[field] = (str(v) or None) if scale is None else (None if np.isnan(v) else float(v))
+        return values
+
+    def read_many(self, xmlfiles, fields=metadata.FIELDS):
+        records = []
+        for x in xmlfiles:
+            values = self.record(x)
+            records.append({f: values[f] for f in fields})
+        return records
+
+    def load(self, path):
+        return np.load(self.open(path, 'rb'))
+
+    def image(self, path, size=None):
+        # Image at the smallest level of at least size px, the display level by default
+        levels = sorted(self.levels)
+        level = next((l for l in levels if size is not None and l >= size), self.levels[0])
+        return Image.open(io.BytesIO(self.read('pyramid/'+str(level)+'/'+norm(path).replace(os.sep, '/'))))
+
+def is_snapshot(path):
+    return os.path.isfile(path) and zipfile.is_zipfile(path)
@@ -0,0 +1,137 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Power spectra of micrographs for quick looks at ice and drift
+# Each micrograph, the EPU jpg or the memory mapped MRC, is binned to at most 2048 px and cut
+# into 512 px boxes whose windowed FFTs are averaged, one batched np.fft call per micrograph
+#
+# EPU_analysis/spectra/spectra.npz                        exposure names, sources and radial averages
+# EPU_analysis/spectra/<square>/<exposure>.png            256 px log power spectrum thumbnails
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from epuanalysis import analysis, images, mrc
+
+SPECTRA_DIR = 'spectra'
+SPECTRA_FILE = 'spectra.npz'
+SIZE = 2048
+BOX = 512
+BINS = 128
+
+def spectra_dir(analysis_dir=analysis.ANALYSIS_DIR):
+    return os.path.join(analysis_dir, SPECTRA_DIR)
+
+def thumbnail_path(micpath, analysis_dir=analysis.ANALYSIS_DIR):
+    # EPU_analysis/squares_all/<square>_Data/<exposure>.jpg -> EPU_analysis/spectra/<square>/<exposure>.png
+    square = os.path.basename(os.path.dirname(micpath))
+    if square.endswith('_Data'):
+        square = square[:-5]
+    return os.path.join(spectra_dir(analysis_dir), square, analysis.exposure_name(micpath)+'.png')
+
+def load_image(path, size=SIZE):
+    # Greyscale float array no larger than size px, MRC block averaged from a memory map
+    if os.path.splitext(path)[1].lower() == '.mrc':
+        data = mrc.open_mrc(path)
+        return mrc.block_average(data, max(1, -(-max(data.shape)//size)))
+    return images.reduced(path, size).astype(np.float32)
+
+def power_spectrum(image, box=BOX):
+    # Mean power spectrum of the windowed boxes tiling the image, zero frequency at the centre
+    box = min(box, *image.shape)
+    ny, nx = image.shape[0]//box, image.shape[1]//box
+    stack = image[:ny*box, :nx*box].reshape(ny, box, nx, box).swapaxes(1, 2).reshape(-1, box, box)
+    stack = stack-stack.mean(axis=(1, 2), keepdims=True)
+    window = np.outer(np.hanning(box), np.hanning(box)).astype(np.float32)
+    power = np.abs(np.fft.fft2(stack*window))**2
+    return np.fft.fftshift(power.mean(axis=0))
+
+def radial_average(power, bins=BINS):
+    # Power in rings of spatial frequency from 0 to Nyquist
+    fy = np.fft.fftshift(np.fft.fftfreq(power.shape[0]))
+    fx = np.fft.fftshift(np.fft.fftfreq(power.shape[1]))
+    radius = np.hypot(fy[:, None], fx[None, :])/0.5
+    ring = (radius*bins).astype(int).ravel()
+    inside = ring < bins
+    total = np.bincount(ring[inside], weights=power.ravel()[inside], minlength=bins)
+    number = np.bincount(ring[inside], minlength=bins)
+    return total/np.maximum(number, 1)
+
+def frequencies(bins=BINS):
+    # Ring centres as a fraction of Nyquist
+    return (np.arange(bins)+0.5)/bins
+
+def thumbnail(power, size=images.THUMBNAIL):
+    # 8 bit log power spectrum of size px, contrast from the 1st to 99.5th percentile
+    logp = np.log1p(power/np.median(power))
+    factor = max(1, power.shape[0]//size)
+    logp = logp[:logp.shape[0]//factor*factor, :logp.shape[1]//factor*factor]
+    logp = logp.reshape(logp.shape[0]//factor, factor, -1, factor).mean(axis=(1, 3))
+    lo, hi = np.percentile(logp, [1, 99.5])
+    scaled = (logp-lo)*(255/(hi-lo)) if hi > lo else logp*0
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+def spectrum(job):
+    # Process pool worker, writes the thumbnail and returns the radial average
+    source, outpath, size, box, bins = job
+    try:
+        power = power_spectrum(load_image(source, size), box)
+    except (IOError, OSError, ValueError) as e:
+        print(str(source)[:80]+' could not be read: '+str(e))
+        return np.full(bins, np.nan)
+    os.makedirs(os.path.dirname(outpath), exist_ok=True)
+    Image.fromarray(thumbnail(power)).save(outpath)
+    return radial_average(power, bins)
+
+def read_spectra(analysis_dir=analysis.ANALYSIS_DIR):
+    # name -> (source, radial average) of the stored spectra
+    try:
+        with np.load(os.path.join(spectra_dir(analysis_dir), SPECTRA_FILE)) as saved:
+            return {n: (s, r) for n, s, r in zip(saved['name'], saved['source'], saved['radial'])}
+    except (IOError, KeyError):
+        return {}
+
+def compute_all(micrographs, sources, analysis_dir=analysis.ANALYSIS_DIR, size=SIZE, box=BOX, bins=BINS,
+                workers=None, force=False):
+    # Spectra of micrographs from their sources, the jpg or an MRC, skipping those already stored
+    stored = {} if force else read_spectra(analysis_dir)
+    jobs = []
+    todo = []
+    for mic, source in zip(micrographs, sources):
+        name = analysis.exposure_name(mic)
+        outpath = thumbnail_path(mic, analysis_dir)
+        done = stored.get(name)
+        if done is not None and done[0] == source and len(done[1]) == bins and os.path.isfile(outpath):
+            continue
+        jobs.append((source, outpath, size, box, bins))
+        todo.append(name)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for name, job, radial in zip(todo, jobs, pool.map(spectrum, jobs, chunksize=4)):
+            stored[name] = (job[0], radial)
+    names = sorted(stored)
+    os.makedirs(spectra_dir(analysis_dir), exist_ok=True)
+    path = os.path.join(spectra_dir(analysis_dir), SPECTRA_FILE)
+    np.savez(path, name=np.array(names, dtype=str), source=np.array([stored[n][0] for n in names], dtype=str),
+             radial=np.array([stored[n][1] for n in names], dtype=float).reshape(-1, bins), frequency=frequencies(bins))
+    return path, len(jobs)
@@ -0,0 +1,227 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+# Relion star file reading
+# Follows epu.star_data_extract.sh, the particles are the loop_ of the last data_ block
+
+import os
+from collections import Counter
+
+import numpy as np
+
+def read_loop(starfile, columns, block=None):
+    # Read the named columns of a loop_ as lists of strings, streaming line by line
+    # block=None takes the last data_ block holding the columns, as for relion 3.1 particle star files
+    data = None
+    current = None
+    index = None
+    for kind, value in lines(starfile):
+        if kind == 'data':
+            current = value
+            index = None
+        elif kind == 'names':
+            index = None
+            if block is not None and current != block:
+                continue
+            if not set(columns) <= set(value):
+                # data_optics and friends in front of the particles
+                continue
+            index = [value.index(c) for c in columns]
+            data = {c: [] for c in columns}
+            rows = [data[c] for c in columns]
+        elif index is not None:
+            for i, row in zip(index, rows):
+                row.append(value[i])
+    if data is None:
+        raise ValueError('Columns '+' '.join(columns)+' not found in '+starfile)
+    return data
+
+def lines(starfile):
+    # Tokenise a star file into ('data', block name), ('names', [loop_ column names])
+    # and ('row', [fields]) events, holding one line in memory at a time
+    names = None
+    with open(starfile) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if fields[0].startswith('data_'):
+                names = None
+                yield 'data', fields[0]
+            elif fields[0] == 'loop_':
+                names = []
+            elif names is not None and fields[0].startswith('_'):
+                names.append(fields[0])
+            elif names:
+                yield 'names', names
+                names = False
+                yield 'row', fields
+            elif names is False:
+                yield 'row', fields
+
+def read_table(starfile, columns, block=None):
+    # Named columns of a loop_ as numpy arrays, float where the values are numbers and str otherwise
+    # The loop is the last one holding columns[0], columns it lacks are left out. All rows are split
+    # in one call, for micrograph star files of tens of thousands of lines
+    with open(starfile, 'rb') as f:
+        text = f.read().splitlines()
+    current = None
+    found = None
+    i = 0
+    while i < len(text):
+        line = text[i].strip()
+        i += 1
+        if line.startswith(b'data_'):
+            current = line.split()[0].decode()
+        elif line.startswith(b'loop_'):
+            names = []
+            while i < len(text) and text[i].strip().startswith(b'_'):
+                names.append(text[i].split()[0].decode())
+                i += 1
+            while i < len(text) and not text[i].strip():
+                i += 1
+            start = i
+            while i < len(text):
+                line = text[i].strip()
+                if not line or line.startswith((b'data_', b'loop_', b'_', b'#')):
+                    break
+                i += 1
+            if columns[0] in names and block in (None, current):
+                found = names, start, i
+    if found is None:
+        raise ValueError('Column '+columns[0]+' not found in '+starfile)
+    names, start, end = found
+    fields = np.array(b' '.join(text[start:end]).split())
+    if fields.size % len(names):
+        raise ValueError('Rows of '+starfile+' do not all have '+str(len(names))+' fields')
+    fields = fields.reshape(-1, len(names))
+    table = {}
+    for c in columns:
+        if c in names:
+            value = fields[:, names.index(c)]
+            try:
+                table[c] = value.astype(float)
+            except ValueError:
+                table[c] = value.astype(str)
+    return table
+
+# Line starts that end the rows of a loop_
+ENDS = (b'data_', b'loop_', b'_', b'#')
+
+def iter_table(starfile, columns, block=None, size=1 << 24):
+    # Named columns of the first loop_ holding columns[0] in chunks of about size bytes, for particle
+    # star files too large to hold. Numbers are float, other values are left as bytes for np.unique
+    with open(starfile, 'rb') as f:
+        current = None
+        names = None
+        for line in f:
+            text = line.strip()
+            if text.startswith(b'data_'):
+                current = text.split()[0].decode()
+                names = None
+            elif text.startswith(b'loop_'):
+                names = []
+            elif names is not None and text.startswith(b'_'):
+                names.append(text.split()[0].decode())
+            elif names and text and not text.startswith(b'#'):
+                if columns[0] in names and block in (None, current):
+                    break
+                names = None
+        else:
+            raise ValueError('Column '+columns[0]+' not found in '+starfile)
+        wanted = [(c, names.index(c)) for c in columns if c in names]
+        data = line
+        while data:
+            data = data+b''.join(f.readlines(size))
+            # The loop ends at the first line starting a block, loop, label or comment, as in
+            # read_table, searched for in the whole chunk at once. Chunks start at a line start
+            ends = [e+1 for e in (data.find(b'\n'+m) for m in ENDS) if e >= 0]
+            if data.lstrip(b' \t').startswith(ENDS):
+                ends.append(0)
+            if ends:
+                data = data[:min(ends)]
+            fields = data.split()
+            data = b'' if ends else f.readline()
+            if len(fields) % len(names):
+                raise ValueError('Rows of '+starfile+' do not all have '+str(len(names))+' fields')
+            table = {}
+            for c, i in wanted:
+                value = np.array(fields[i::len(names)])
+                try:
+                    table[c] = value.astype(float)
+                except ValueError:
+                    table[c] = value
+            if fields:
+                yield table
+
+def micrograph_name(value, suffix=None):
+    # Reduce a star file micrograph entry to the EPU exposure name
+    # Movies/FoilHole_..._20210808_185028_Fractions.mrc -> FoilHole_..._20210808_185028
+    name = os.path.splitext(os.path.basename(value))[0]
+    if suffix:
+        name = name.replace(suffix, '')
+    return name
+
+def particle_counts(starfile, column='_rlnMicrographName', suffix=None):
+    # Number of particles per exposure name
+    # Each micrograph is repeated for every particle, so names are reduced once per micrograph
+    mics = Counter(read_loop(starfile, [column])[column])
+    counts = Counter()
+    for m, n in mics.items():
+        counts[micrograph_name(m, suffix)] += n
+    return counts
+
+def filter_rows(starfile, outfile, keep, column='_rlnMicrographName', block=None):
+    # Copy a star file keeping the rows of loops holding column for which keep(value) is true
+    # Every other line, data_optics and all headers included, is copied byte for byte. Lines are
+    # streamed so memory holds one line and the decision for each distinct value of column
+    decided = {}
+    current = None
+    names = None
+    index = None
+    kept = total = 0
+    with open(starfile, 'rb') as f, open(outfile, 'wb') as out:
+        for line in f:
+            text = line.lstrip()
+            header = not text or text.startswith((b'#', b'data_', b'loop_', b'_'))
+            if names and not header:
+                # First row of a loop, filter it if it holds the column
+                index = names.index(column) if column in names and block in (None, current) else None
+                names = None
+            if index is not None and not header:
+                value = text.split(None, index+1)[index]
+                ok = decided.get(value)
+                if ok is None:
+                    ok = decided[value] = bool(keep(value.decode()))
+                total += 1
+                if ok:
+                    out.write(line)
+                    kept += 1
+                continue
+            out.write(line)
+            if text.startswith(b'data_'):
+                current = text.split()[0].decode()
+                names = index = None
+            elif text.startswith(b'loop_'):
+                names = []
+                index = None
+            elif names is not None and text.startswith(b'_'):
+                names.append(text.split()[0].decode())
+    return kept, total
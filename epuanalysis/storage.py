@@ -0,0 +1,178 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Concurrent file access for EPU directories on network storage (GPFS, NFS)
+#
+# Every stat, listing and open on these mounts costs a round trip of milliseconds, so
+# reading thousands of xml and jpg files one at a time spends nearly all its time waiting.
+# Storage issues them from a bounded thread pool instead, and optionally limits the
+# operations per second issued to each mount so a busy shared filesystem is not flooded.
+#
+# Tuning, also settable per script:
+#   EPU_IO_THREADS=32                        concurrent file operations (default 16)
+#   EPU_IO_RATES=/dls=2000,/gpfs=500         operations per second per mount point (default unlimited)
+
+import os
+import glob
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+THREADS = 16
+
+class RateLimiter:
+    # Token bucket allowing rate operations per second with bursts of up to rate
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = float(rate)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens+(now-self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1-self.tokens)/self.rate
+            time.sleep(wait)
+
+def mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+def parse_rates(text):
+    # '/dls=2000,/gpfs=500' -> {'/dls': 2000.0, '/gpfs': 500.0}
+    rates = {}
+    for item in (text or '').split(','):
+        if '=' in item:
+            mount, rate = item.rsplit('=', 1)
+            rates[os.path.realpath(mount.strip())] = float(rate)
+    return rates
+
+class Storage:
+    # Bounded concurrency file access with per-mount rate limits
+    def __init__(self, threads=THREADS, rates=None):
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.limiters = {mount: RateLimiter(rate) for mount, rate in (rates or {}).items()}
+        self.mounts = {}
+
+    def limiter(self, path):
+        # Rate limiter for the mount holding path, EPU_analysis reads go through symlinks so the
+        # mount is found from the link target, and cached per link directory
+        if not self.limiters:
+            return None
+        directory = os.path.dirname(os.path.abspath(path))
+        if directory not in self.mounts:
+            target = os.path.dirname(os.path.realpath(path))
+            mount = mount_point(target)
+            # The configured mount may be a directory below the real mount point
+            match = [m for m in self.limiters if (target+os.sep).startswith(m.rstrip(os.sep)+os.sep)]
+            self.mounts[directory] = self.limiters[max(match, key=len)] if match else self.limiters.get(mount)
+        return self.mounts[directory]
+
+    def call(self, func, path, *args):
+        limiter = self.limiter(path)
+        if limiter is not None:
+            limiter.acquire()
+        return func(path, *args)
+
+    def submit(self, func, path, *args):
+        return self.pool.submit(self.call, func, path, *args)
+
+    def map(self, func, paths, *args):
+        # func(path, *args) for every path, results in order
+        jobs = [self.submit(func, path, *args) for path in paths]
+        return [job.result() for job in jobs]
+
+    def listdir(self, directories):
+        # Entry names of many directories, missing directories list as empty
+        return self.map(_listdir, directories)
+
+    def glob(self, patterns):
+        # Sorted matches of many glob patterns, as used for the EPU_analysis square directories
+        return self.map(_glob, patterns)
+
+    def read(self, paths):
+        # File contents as bytes, None for files that could not be read
+        return self.map(_read, paths)
+
+    def prefetch(self, paths, batch=64):
+        # Yield (paths, contents) in batches, reading the next batch while the caller works on this one
+        batches = [paths[i:i+batch] for i in range(0, len(paths), batch)]
+        pending = [self.submit(_read, p) for p in batches[0]] if batches else []
+        for i, current in enumerate(batches):
+            jobs = pending
+            if i+1 < len(batches):
+                pending = [self.submit(_read, p) for p in batches[i+1]]
+            yield current, [job.result() for job in jobs]
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+def _listdir(path):
+    try:
+        return sorted(entry.name for entry in os.scandir(path))
+    except (IOError, OSError):
+        return []
+
+def _glob(pattern):
+    return sorted(glob.glob(pattern))
+
+def _read(path):
+    # Missing files and broken links are reported and skipped rather than ending a bulk read
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        print(str(path)[:80]+' could not be read')
+        return None
+
+_storage = None
+
+def configure(threads=None, rates=None):
+    # Replace the shared Storage, unset values come from the environment
+    global _storage
+    if _storage is not None:
+        _storage.shutdown()
+    if threads is None:
+        threads = int(os.environ.get('EPU_IO_THREADS', THREADS))
+    if rates is None:
+        rates = parse_rates(os.environ.get('EPU_IO_RATES'))
+    elif not isinstance(rates, dict):
+        rates = parse_rates(rates)
+    _storage = Storage(threads, rates)
+    return _storage
+
+def storage():
+    # The Storage shared by the epuanalysis modules
+    if _storage is None:
+        configure()
+    return _storage
@@ -0,0 +1,180 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Time resolved collection analytics from exposure names
+# FoilHole_5871221_Data_5860229_5860231_20210808_185028 was acquired 2021-08-08 18:50:28, the
+# timestamps of every exposure in the index are decoded at once from their integer keys
+
+import csv
+import os
+
+import numpy as np
+
+from epuanalysis import analysis, keys
+
+TIMELINE_DIR = 'timeline'
+
+def name_times(names):
+    # datetime64[s] from the trailing _YYYYMMDD_HHMMSS of each exposure name, NaT for other names
+    return key_times(*keys.exposures(names))
+
+def key_times(found, valid):
+    times = keys.timestamps(found)
+    times[~valid] = np.datetime64('NaT')
+    return times
+
+def hours(times, start):
+    return (times-start)/np.timedelta64(1, 'h')
+
+class Timeline:
+    # Exposures of an index in acquisition order, with their squares and particle counts
+
+    def __init__(self, index, particles):
+        times = key_times(*index.keys())
+        known = ~np.isnat(times)
+        order = np.argsort(times[known], kind='stable')
+        self.index = index
+        self.exposure = np.flatnonzero(known)[order]
+        self.times = times[known][order]
+        self.square = index.square[self.exposure]
+        self.particles = np.asarray(particles, dtype=float)[self.exposure]
+        self.undated = int((~known).sum())
+        self.start = self.times[0] if len(self.times) else None
+
+    def __len__(self):
+        return len(self.times)
+
+    def rate(self, binwidth=1.0):
+        # Exposures and particles per bin of binwidth hours from the first exposure
+        t = hours(self.times, self.start)
+        edges = np.arange(0, t[-1]+binwidth, binwidth) if len(t) else np.zeros(1)
+        if len(edges) < 2:
+            edges = np.array([0, binwidth])
+        number, _ = np.histogram(t, edges)
+        particles, _ = np.histogram(t, edges, weights=self.particles)
+        return edges[:-1], number, particles
+
+    def dwell(self):
+        # Per square first and last exposure, exposures, visits (separate runs of exposures) and dwell hours
+        n = len(self.index.squares)
+        t = hours(self.times, self.start)
+        first = np.full(n, np.inf)
+        last = np.full(n, -np.inf)
+        np.minimum.at(first, self.square, t)
+        np.maximum.at(last, self.square, t)
+        number = np.bincount(self.square, minlength=n)
+        runstart = np.r_[True, self.square[1:] != self.square[:-1]] if len(self.square) else np.zeros(0, bool)
+        visits = np.bincount(self.square[runstart], minlength=n)
+        # Time on a square is the span of each of its runs plus one typical exposure interval
+        gap = np.median(np.diff(t)) if len(t) > 1 else 0
+        runid = np.cumsum(runstart)-1
+        runspan = np.zeros(runid[-1]+1 if len(runid) else 0)
+        if len(runid):
+            runfirst = np.full(len(runspan), np.inf)
+            runlast = np.full(len(runspan), -np.inf)
+            np.minimum.at(runfirst, runid, t)
+            np.maximum.at(runlast, runid, t)
+            runspan = runlast-runfirst+gap
+        dwell = np.bincount(self.square[runstart], weights=runspan, minlength=n)
+        particles = np.bincount(self.square, weights=self.particles, minlength=n)
+        return {'first': first, 'last': last, 'exposures': number, 'visits': visits, 'dwell': dwell,
+                'particles': particles}
+
+    def stalls(self, minimum=10.0):
+        # Gaps longer than minimum minutes between consecutive exposures
+        if len(self.times) < 2:
+            return []
+        gaps = np.diff(self.times)/np.timedelta64(1, 'm')
+        found = np.flatnonzero(gaps > minimum)
+        return [(self.times[i], self.times[i+1], gaps[i], self.square[i], self.square[i+1]) for i in found]
+
+    def rolling(self, window=60.0, step=10.0):
+        # Exposures, particles and particles per exposure in windows of window minutes every step minutes
+        t = hours(self.times, self.start)*60
+        if not len(t):
+            return np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0)
+        ends = np.arange(window, t[-1]+step, step) if t[-1] > window else np.array([max(t[-1], window)])
+        total = np.r_[0, np.cumsum(self.particles)]
+        hi = np.searchsorted(t, ends, side='right')
+        lo = np.searchsorted(t, ends-window, side='right')
+        number = hi-lo
+        particles = total[hi]-total[lo]
+        per = np.divide(particles, number, out=np.zeros(len(ends)), where=number > 0)
+        return ends/60, number, particles, per
+
+def write_csv(path, header, rows):
+    with open(path, 'w', newline='') as f:
+        out = csv.writer(f)
+        out.writerow(header)
+        out.writerows(rows)
+    return path
+
+def export(timeline, outdir, window=60.0, stall=10.0):
+    # csv files of the analytics, and a summary plot if matplotlib is available
+    os.makedirs(outdir, exist_ok=True)
+    written = []
+    start, number, particles = timeline.rate()
+    written.append(write_csv(os.path.join(outdir, 'exposures_per_hour.csv'), ['hour', 'exposures', 'particles'],
+                             [[int(h), int(n), int(p)] for h, n, p in zip(start, number, particles)]))
+    d = timeline.dwell()
+    rows = []
+    for i in np.argsort(d['first'], kind='stable'):
+        if d['exposures'][i] == 0:
+            continue
+        rows.append([analysis.square_name(timeline.index.squares[i]), '%.3f' % d['first'][i], '%.3f' % d['last'][i],
+                     '%.3f' % d['dwell'][i], d['exposures'][i], d['visits'][i], int(d['particles'][i])])
+    written.append(write_csv(os.path.join(outdir, 'square_dwell.csv'),
+                             ['square', 'first_hour', 'last_hour', 'dwell_hours', 'exposures', 'visits', 'particles'], rows))
+    stalls = timeline.stalls(stall)
+    squares = timeline.index.squares
+    written.append(write_csv(os.path.join(outdir, 'stalls.csv'),
+                             ['from', 'to', 'minutes', 'square_before', 'square_after'],
+                             [[str(a), str(b), '%.1f' % m, analysis.square_name(squares[s]), analysis.square_name(squares[e])]
+                              for a, b, m, s, e in stalls]))
+    ends, number, particles, per = timeline.rolling(window)
+    written.append(write_csv(os.path.join(outdir, 'yield_rolling.csv'),
+                             ['hour', 'exposures', 'particles', 'particles_per_exposure'],
+                             [['%.3f' % h, int(n), int(p), '%.2f' % y] for h, n, p, y in zip(ends, number, particles, per)]))
+    try:
+        written.append(plot(timeline, os.path.join(outdir, 'timeline.png'), window, stalls))
+    except ImportError:
+        print('matplotlib not found, no timeline plot')
+    return written
+
+def plot(timeline, path, window, stalls):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    start, number, _ = timeline.rate()
+    ends, _, _, per = timeline.rolling(window)
+    fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True, figsize=(12, 6))
+    ax1.bar(start, number, width=1, align='edge', color='grey')
+    ax1.set_ylabel('Exposures per hour')
+    ax2.plot(ends, per, color='k')
+    ax2.set_ylabel('Particles per exposure\n(%g min window)' % window)
+    ax2.set_xlabel('Hours from '+str(timeline.start))
+    for a, b, _, _, _ in stalls:
+        for ax in (ax1, ax2):
+            ax.axvspan(hours(a, timeline.start), hours(b, timeline.start), color='r', alpha=0.2)
+    fig.tight_layout()
+    fig.savefig(path, dpi=100)
+    plt.close(fig)
+    return path
@@ -0,0 +1,116 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Local web server for EPU_report, see epuanalysis/report.py
+# http.server with caching headers and byte range requests, so a browser on the far end of
+# an ssh tunnel fetches each thumbnail once and can resume or seek in large files
+
+import email.utils
+import os
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds browsers may reuse images without asking, pages are always revalidated
+IMAGE_MAX_AGE = 86400
+
+class ReportHandler(SimpleHTTPRequestHandler):
+
+    def etag(self, path):
+        st = os.stat(path)
+        return '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.send_head(self)
+        etag = self.etag(path)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.end_headers()
+            return None
+        size = os.path.getsize(path)
+        start, end = self.byte_range(size)
+        if start is None:
+            return SimpleHTTPRequestHandler.send_head(self)
+        if start >= size or start > end:
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.end_headers()
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        self.remaining = end-start+1
+        self.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.send_header('Content-type', self.guess_type(path))
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.send_header('Content-Length', str(self.remaining))
+        self.send_header('Last-Modified', email.utils.formatdate(os.path.getmtime(path), usegmt=True))
+        self.end_headers()
+        return f
+
+    def byte_range(self, size):
+        # (start, end) of a single 'Range: bytes=' request, (None, None) if absent or unsupported
+        header = self.headers.get('Range', '')
+        if not header.startswith('bytes=') or ',' in header:
+            return None, None
+        first, _, last = header[6:].strip().partition('-')
+        try:
+            if first == '':
+                # Suffix range, the last n bytes
+                return max(0, size-int(last)), size-1
+            return int(first), min(int(last), size-1) if last else size-1
+        except ValueError:
+            return None, None
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, 'remaining', None)
+        if remaining is None:
+            return SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+        while remaining > 0:
+            data = source.read(min(65536, remaining))
+            if not data:
+                break
+            outputfile.write(data)
+            remaining -= len(data)
+        self.remaining = None
+
+    def end_headers(self):
+        path = self.translate_path(self.path)
+        self.send_header('Accept-Ranges', 'bytes')
+        if os.path.isfile(path):
+            self.send_header('ETag', self.etag(path))
+            if path.endswith('.html') or path.endswith('.json'):
+                self.send_header('Cache-Control', 'no-cache')
+            else:
+                self.send_header('Cache-Control', 'max-age=%d' % IMAGE_MAX_AGE)
+        SimpleHTTPRequestHandler.end_headers(self)
+
+def serve(directory, port=8000, bind='127.0.0.1'):
+    # Serve until interrupted, bound to localhost by default for use through an ssh tunnel
+    handler = lambda *args, **kwargs: ReportHandler(*args, directory=directory, **kwargs)
+    httpd = ThreadingHTTPServer((bind, port), handler)
+    print('Serving '+directory+' at http://'+bind+':'+str(port)+'/')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
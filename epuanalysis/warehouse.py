@@ -0,0 +1,225 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# Cross session store of square, FoilHole and exposure aggregates, for comparing many sessions
+# Each analysis publishes its tables into a partition of its own, and never changes another's:
+#
+# <warehouse>/<table>/date=2021-08-06/session=<name>/part-<utc time>.npz     one array per column
+# <warehouse>/<table>/date=2021-08-06/session=<name>/part-<utc time>.json    rows, session constants
+#                                                                            and column min / max
+#
+# Publishing again adds a newer part, queries read the newest part of each partition. A query reads
+# only the json of every partition first, skips partitions whose constants or column ranges cannot
+# meet its predicates, and then loads only the columns it names from the npz of the rest.
+#
+# The warehouse is EPU_WAREHOUSE, or ~/epu_warehouse
+
+import glob
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+from epuanalysis import analysis, attributes, images, index, keys, layers, metadata, quality, ranking, session, storage
+from epuanalysis.selection import OPERATORS
+
+TABLES = ['squares', 'foilholes', 'exposures']
+PREDICATE = re.compile(r'^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*(.+?)\s*$')
+
+# Session constants taken from the first square's xml
+CONSTANTS = ['instrument', 'camera', 'epu_version', 'magnification']
+
+def warehouse_dir():
+    return os.environ.get('EPU_WAREHOUSE') or os.path.expanduser('~/epu_warehouse')
+
+def safe(name):
+    # Partition directory name of a session or date
+    return re.sub(r'[^\w.-]', '_', str(name))
+
+def parse_predicate(text):
+    # 'grey_mean>100' -> ('grey_mean', '>', 100.0), values that are not numbers stay strings
+    match = PREDICATE.match(text)
+    if not match:
+        raise ValueError('Predicate '+text+' is not of the form column<value, e.g. grey_mean>100')
+    column, op, value = match.groups()
+    value = value.strip('\'"')
+    try:
+        return column, op, float(value)
+    except ValueError:
+        return column, op, value
+
+def column_stats(values):
+    # min and max of a numeric column for pruning, None otherwise
+    if values.dtype.kind not in 'fiu' or not len(values):
+        return None
+    finite = values[np.isfinite(values)] if values.dtype.kind == 'f' else values
+    return [float(finite.min()), float(finite.max())] if len(finite) else None
+
+def publish_table(table, columns, constants, root=None):
+    # Write one table of a session as a new part of its partition
+    root = root or warehouse_dir()
+    part = os.path.join(root, table, 'date='+safe(constants['date']), 'session='+safe(constants['session']))
+    os.makedirs(part, exist_ok=True)
+    stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())+'%06d' % (time.time() % 1*1e6)
+    base = os.path.join(part, 'part-'+stamp)
+    rows = len(next(iter(columns.values()))) if columns else 0
+    np.savez(base+'.tmp.npz', **columns)
+    os.replace(base+'.tmp.npz', base+'.npz')
+    # The json is written last, a part without one is incomplete and never read
+    manifest = {'rows': rows, 'constants': constants, 'columns': {c: str(v.dtype) for c, v in columns.items()},
+                'stats': {c: column_stats(v) for c, v in columns.items()}}
+    with open(base+'.tmp.json', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(base+'.tmp.json', base+'.json')
+    return base+'.npz'
+
+def partitions(table, root=None):
+    # Newest complete part of every partition of a table
+    parts = {}
+    for path in sorted(glob.glob(os.path.join(root or warehouse_dir(), table, 'date=*', 'session=*', 'part-*.json'))):
+        if not path.endswith('.tmp.json'):
+            parts[os.path.dirname(path)] = path
+    return sorted(parts.values())
+
+def read_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+def may_match(manifest, predicate):
+    # Whether any row of a partition can meet a predicate, from its constants and column ranges
+    column, op, value = predicate
+    if column in manifest['constants']:
+        constant = manifest['constants'][column]
+        try:
+            return bool(OPERATORS[op](type(value)(constant), value))
+        except (TypeError, ValueError):
+            return False
+    stats = manifest['stats'].get(column)
+    if stats is None or not isinstance(value, float):
+        return True
+    lo, hi = stats
+    return {'<': lo < value, '<=': lo <= value, '>': hi > value, '>=': hi >= value,
+            '==': lo <= value <= hi, '!=': not lo == hi == value}[op]
+
+def read_part(path, manifest, columns, predicates):
+    # Columns of the rows of one part meeting the predicates, loading only the columns needed
+    rows = manifest['rows']
+    needed = set(columns) | {p[0] for p in predicates}
+    values = {}
+    with np.load(path[:-len('.json')]+'.npz') as saved:
+        for c in needed:
+            if c in manifest['constants']:
+                values[c] = np.full(rows, manifest['constants'][c])
+            elif c in saved.files:
+                values[c] = saved[c]
+            else:
+                values[c] = np.full(rows, np.nan)
+    keep = np.ones(rows, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        for column, op, value in predicates:
+            data = values[column]
+            if isinstance(value, float) and data.dtype.kind not in 'fiub':
+                keep &= False
+            else:
+                keep &= OPERATORS[op](data if isinstance(value, float) else data.astype(str), value)
+    return {c: values[c][keep] for c in columns}
+
+def query(table, columns, predicates=(), root=None):
+    # Rows of a table over all sessions as a dict of column arrays, with the partitions read and pruned
+    paths = partitions(table, root)
+    manifests = storage.storage().map(read_manifest, paths)
+    chosen = [(p, m) for p, m in zip(paths, manifests) if all(may_match(m, pr) for pr in predicates)]
+    jobs = [storage.storage().submit(read_part, p, m, columns, predicates) for p, m in chosen]
+    parts = [job.result() for job in jobs]
+    result = {}
+    for c in columns:
+        arrays = [part[c] for part in parts if len(part[c])]
+        result[c] = np.concatenate(arrays) if arrays else np.zeros(0)
+    return result, {'partitions': len(paths), 'read': len(chosen)}
+
+def sessions(root=None):
+    # Date, session and rows of every table, one entry per session
+    found = {}
+    for table in TABLES:
+        for path in partitions(table, root):
+            m = read_manifest(path)
+            key = (m['constants']['date'], m['constants']['session'])
+            found.setdefault(key, {'constants': m['constants']})[table] = m['rows']
+    return [dict(found[k], date=k[0], session=k[1]) for k in sorted(found)]
+
+def session_constants(idx, analysis_dir=analysis.ANALYSIS_DIR):
+    # Session name, date of the first exposure and instrument of an analysis
+    settings = analysis.read_settings(analysis_dir)
+    epu_dir = settings.get('EPU') or ''
+    name = session.read_session(epu_dir)['name'] if epu_dir else None
+    times = keys.timestamps(idx.keys()[0])
+    times = times[~np.isnat(times)]
+    constants = {'session': name or os.path.basename(os.path.normpath(epu_dir)) or 'unknown',
+                 'date': str(times.min().astype('datetime64[D]')) if len(times) else 'unknown',
+                 'epu_dir': os.path.abspath(epu_dir) if epu_dir else '',
+                 'star': settings.get('Star') or ''}
+    if len(idx.squares):
+        try:
+            values = metadata.read(analysis.square_xml(idx.squares[0]), CONSTANTS)
+            constants.update({c: (v if v is not None else '') for c, v in values.items()})
+        except (IOError, OSError) as e:
+            print('Square metadata could not be read: '+str(e))
+    return constants
+
+def session_tables(idx, analysis_dir=analysis.ANALYSIS_DIR):
+    # Square, FoilHole and exposure tables of an analysis, from the stores it has
+    layer = layers.default_layer(analysis_dir)
+    counts = layer.join(idx)[0] if layer is not None else np.zeros(len(idx))
+    qual = quality.load_quality(idx, analysis_dir)
+    stats = images.load_stats(analysis_dir)
+    attrs = attributes.load_attributes(idx, analysis_dir)
+    defocus = qual.columns.get('defocus_ctf') if qual is not None else None
+    sq, fh = ranking.rank_session(idx.squares, idx.names, idx.square, counts, defocus)
+
+    sq['square'] = sq['square'].astype(str)
+    fh['square'] = fh['square'].astype(str)
+    if stats is not None:
+        sq['grey_mean'] = stats.lookup(idx.squares, 'mean')
+        sq['grey_std'] = stats.lookup(idx.squares, 'std')
+        sq['ice'] = stats.lookup(idx.squares, 'ice')
+    exposures = {'name': idx.names, 'square': sq['square'][idx.square] if len(idx) else np.zeros(0, dtype=str),
+                 'foilhole': idx.foilhole, 'particles': np.asarray(counts, dtype=float),
+                 'time': keys.timestamps(idx.keys()[0])}
+    if qual is not None:
+        for c in qual.columns:
+            sq[c] = qual.per_square(c)
+            fh[c] = qual.per_foilhole(c, fh['foilhole'])
+            exposures[c] = qual.columns[c]
+    if attrs is not None:
+        for a in attrs.present:
+            sq[a] = attrs.mean('square', a)
+            fh[a] = attrs.of_foilhole(attrs.mean('foilhole', a), fh['foilhole'])
+    return {'squares': sq, 'foilholes': fh, 'exposures': exposures}
+
+def publish(analysis_dir=analysis.ANALYSIS_DIR, root=None):
+    # Publish every table of an analysis, returns the session constants and the parts written
+    idx = index.load(analysis_dir)
+    constants = session_constants(idx, analysis_dir)
+    tables = session_tables(idx, analysis_dir)
+    written = [publish_table(t, {c: np.asarray(v) for c, v in tables[t].items()}, constants, root) for t in TABLES]
+    return constants, written
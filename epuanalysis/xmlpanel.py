@@ -0,0 +1,137 @@
+############################################################################
+#
+# Author: "Kyle L. Morris"
+# eBIC Diamond Light Source 2022
+#
+# This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+# XML data inspector panel for an EPU image
+# A Toplevel window that lives in the process of whichever GUI opens it, so the browser can
+# keep one panel open and update it in place as the micrograph selection changes. Metadata
+# comes from the shared cached parser and the image is decoded at display size in draft mode.
+
+import os
+import tkinter as tk
+import xml.etree.ElementTree as ET
+from tkinter import filedialog
+
+from PIL import ImageTk, Image
+
+from epuanalysis import metadata
+
+# Label, field, format for each reported value
+ROWS = [
+    ('Data read from EPU xml file:', None, None),
+    ('Exposure (sec):', 'exposure_time', '%g'),
+    ('Acquired:', 'acquisition_time', '%s'),
+    ('Stage:', None, None),
+    ('Stage X (um):', 'stage_x', '%g'),
+    ('Stage Y (um):', 'stage_y', '%g'),
+    ('Stage Z (um):', 'stage_z', '%g'),
+    ('Optics:', None, None),
+    ('Spot:', 'spot', '%g'),
+    ('Mag:', 'magnification', '%g'),
+    ('Beam (nm):', 'beam_diameter', '%g'),
+    ('Defocus (µm):', 'defocus', '%g'),
+    ('Slit width (eV):', 'slit_width', '%g'),
+]
+
+# Display size of the image
+SIZE = 400
+
+class XmlPanel(tk.Toplevel):
+
+    def __init__(self, master=None, placeholder=None, source=None):
+        tk.Toplevel.__init__(self, master)
+        # snapshot.Snapshot to read in place of the files, when browsing a snapshot
+        self.source = source
+        self.title("XML data inspector for EPU image")
+        self.geometry('700x'+str(30+25*(len(ROWS)+3)+SIZE+20))
+        self.boxes = {}
+
+        ## File browser
+        row = 0
+        tk.Button(self, text="Browse xml", command=self.browse).grid(column=0, row=row)
+        self.box_xml = tk.Entry(self, width=60)
+        self.box_xml.grid(column=1, row=row)
+
+        ## File Information
+        row += 1
+        tk.Label(self, text='xml file:', anchor=tk.W, justify=tk.RIGHT).grid(sticky="e", column=0, row=row)
+        self.box_xmlFile = tk.Entry(self, width=60)
+        self.box_xmlFile.grid(column=1, row=row)
+        row += 1
+        tk.Label(self, text='img file:', anchor=tk.W, justify=tk.RIGHT).grid(sticky="e", column=0, row=row)
+        self.box_imgFile = tk.Entry(self, width=60)
+        self.box_imgFile.grid(column=1, row=row)
+
+        ## XML report
+        for text, field, _ in ROWS:
+            row += 1
+            if field is None:
+                tk.Label(self, text=text, anchor=tk.W, justify=tk.LEFT).grid(sticky="w", column=1, row=row)
+                continue
+            tk.Label(self, text=text, anchor=tk.W, justify=tk.RIGHT).grid(sticky="e", column=0, row=row)
+            self.boxes[field] = tk.Entry(self, width=60)
+            self.boxes[field].grid(column=1, row=row)
+
+        ## Micrograph image
+        self.imgMic = tk.Label(self)
+        self.imgMic.place(x=3, y=30+25*(row+1))
+        if placeholder:
+            self.setImage(placeholder)
+
+    def browse(self):
+        xmlin = filedialog.askopenfilename(parent=self, initialdir="~", title="Select EPU xml file")
+        if xmlin:
+            self.show(xmlin)
+
+    def show(self, path):
+        # Report the xml for an EPU jpg or xml path and display its image
+        xmlpath = os.path.splitext(path.rstrip())[0]+'.xml'
+        imgpath = os.path.splitext(xmlpath)[0]+'.jpg'
+        setEntry(self.box_xml, xmlpath)
+        setEntry(self.box_xmlFile, os.path.basename(xmlpath))
+        setEntry(self.box_imgFile, os.path.basename(imgpath))
+        try:
+            data = (self.source or metadata).record(xmlpath)
+        except (IOError, OSError, ET.ParseError) as e:
+            print(xmlpath+' could not be read: '+str(e))
+            data = {}
+        for text, field, form in ROWS:
+            if field is None:
+                continue
+            value = data.get(field)
+            setEntry(self.boxes[field], '' if value is None else form % value)
+        if self.source is not None and self.source.isfile(imgpath):
+            self.setImage(self.source.open(imgpath, 'rb'))
+        elif os.path.isfile(imgpath):
+            self.setImage(imgpath)
+
+    def setImage(self, imgpath):
+        with Image.open(imgpath) as load:
+            load.draft('RGB', (SIZE, SIZE))
+            load = load.convert('RGB')
+            width, height = load.size
+            load = load.resize((SIZE, int(SIZE*height/width)), Image.LANCZOS)
+        render = ImageTk.PhotoImage(load, master=self)
+        self.imgMic.configure(image=render)
+        self.imgMic.image = render
+
+def setEntry(entry, text):
+    entry.delete(0, tk.END)
+    entry.insert(0, text)